@@ -0,0 +1,333 @@
+#This script serves kernel and memcpy metrics over HTTP from an LRU cache.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 analysis_server.py [--host HOST] [--port PORT | --socket PATH] [--workers N] [--memory-mb MB] [--no-cache | --incremental]
+
+#Note: A long-lived server of the kernel_metrics.py and memcpy_analyze.py
+# tables, as JSON over HTTP on localhost or on a Unix socket:
+#   GET /kernel_metrics?report=R[&top=K][&rank_by=total|count|sketch]
+#       [&breakdown=1[&by_context=1]][&demangle=1][&start=T][&end=T][&skip_first=N]
+#   GET /memcpy_summary?report=R[&log2_edges=LOW:HIGH][&breakdown=1[&by_context=1]]
+#       [&start=T][&end=T][&skip_first=N]
+#   GET /status
+# The launch columns of the recently used reports, their memcpy GROUP BY
+# groups and the responses computed from them are kept in one LRU cache
+# bounded by --memory-mb, keyed by the report fingerprint (path, size,
+# mtime) so a rewritten report is read again. A value that is being loaded
+# is loaded once for all the requests that ask for it. The requests run on a pool of
+# --workers threads, NumPy and SQLite release the GIL for the heavy parts.
+# Figures are not rendered, so matplotlib is never imported.
+#########################################################################
+import os
+import sys
+import json
+import signal
+import sqlite3
+import argparse
+import traceback
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+import concurrent.futures
+import numpy as np
+import kernel_metrics
+import memcpy_analyze
+import nsys_index
+import report_cache
+import report_reader
+import table_export
+import time_window
+#######################################################
+MEMCPY_TABLE = "CUPTI_ACTIVITY_KIND_MEMCPY"
+#######################################################
+class LRUCache:
+    # Values with their size in bytes, the least recently used ones are
+    # dropped while the total is over max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load, size):
+        # The cached value of key, or load() sized by size(value). Requests
+        # for a key that is being loaded wait for that load
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            future = self.loading.get(key)
+            if future is None:
+                self.misses += 1
+                future = self.loading[key] = concurrent.futures.Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as error:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.store(key, value, size(value))
+        future.set_result(value)
+        return value
+
+    def store(self, key, value, num_bytes):
+        # A value larger than the whole cache is returned but not kept
+        if num_bytes > self.max_bytes:
+            return
+        self.entries[key] = (value, num_bytes)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted
+
+    def status(self):
+        with self.lock:
+            return {
+                "bytes": self.num_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": [{"kind": key[0], "report": key[1], "bytes": num_bytes} for key, (_, num_bytes) in self.entries.items()],
+            }
+#######################################################
+def column_bytes(columns):
+    return sum(np.asarray(values).nbytes for values in columns.values())
+#######################################################
+def encode(result):
+    # The response body, NumPy values become plain numbers
+    return json.dumps(plain_result(result)).encode()
+#######################################################
+def plain_result(value):
+    if isinstance(value, dict):
+        return {key: plain_result(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain_result(item) for item in value]
+    return table_export.plain_value(value)
+#######################################################
+def query_flag(query, name):
+    return query.get(name, "0").lower() in ("1", "true", "yes")
+#######################################################
+def query_int(query, name):
+    if name not in query:
+        return None
+    try:
+        return int(query[name])
+    except ValueError:
+        raise ValueError("%s must be an integer, not %s" % (name, query[name]))
+#######################################################
+def query_report(query):
+    # The report of a request, its indexed sidecar when there is one
+    if "report" not in query:
+        raise ValueError("the report parameter is missing")
+    report = query["report"]
+    if not os.path.exists(report):
+        raise FileNotFoundError("no report " + report)
+    return report if report_reader.is_arrow_report(report) else nsys_index.find_indexed_report(report)
+#######################################################
+def query_window(report, query):
+    skip_first = query.get("skip_first")
+    return time_window.resolve_window(report, query.get("start"), query.get("end"), time_window.parse_percent(skip_first) if skip_first is not None else None)
+#######################################################
+def query_partition(query):
+    if not query_flag(query, "breakdown"):
+        return []
+    return kernel_metrics.PARTITION_COLUMNS + ["contextId"] * query_flag(query, "by_context")
+#######################################################
+def report_key(kind, report, options=()):
+    return (kind, report, json.dumps(report_cache.report_fingerprint(report), sort_keys=True), tuple(sorted(options)))
+#######################################################
+def check_columns(report, tables):
+    missing = report_reader.missing_columns(report, tables)
+    if missing:
+        raise ValueError("the report %s lacks %s" % (report, ', '.join(missing)))
+#######################################################
+def kernel_columns(state, report):
+    # The launch columns of the whole report, from the column cache next
+    # to the report when there is one, like exact_kernel_statistics
+    load = lambda: report_cache.cached_columns(report, "kernel", kernel_metrics.extract_kernel_columns, state["use_cache"], kernel_metrics.extend_kernel_columns, kernel_metrics.KERNEL_TABLES)
+    return state["cache"].get(report_key("kernel columns", report), load, column_bytes)
+#######################################################
+def kernel_metrics_result(state, report, query):
+    check_columns(report, kernel_metrics.REPORT_TABLES)
+    top = query_int(query, "top")
+    rank_by = query.get("rank_by", "total")
+    if top is not None and top < 1:
+        raise ValueError("top needs at least one config")
+    if rank_by not in kernel_metrics.RANK_METRICS:
+        raise ValueError("rank_by must be one of " + ', '.join(kernel_metrics.RANK_METRICS))
+    demangle = query_flag(query, "demangle")
+    partition = query_partition(query)
+    window = query_window(report, query)
+
+    columns = kernel_columns(state, report)
+    if window is not None:
+        columns = kernel_metrics.window_columns(columns, window)
+    label_configs, ket_list, klo_list, slack_list, dominant_list, partitions = kernel_metrics.kernel_statistics(report, columns, top, rank_by, partition or None)
+    result = {
+        "report": report,
+        "window": window,
+        "kernels": kernel_metrics.metric_table(label_configs(range(len(ket_list)), demangle), ket_list, klo_list, slack_list, dominant_list),
+    }
+    if partitions is not None:
+        result["partitions"] = kernel_metrics.partition_rows(partitions)
+        result["partition_kernels"] = kernel_metrics.partition_kernel_rows(partitions, label_configs, demangle)
+    return result
+#######################################################
+def memcpy_groups(state, report, edges, window):
+    # The memcpy_analyze groups keyed by every partition column the report
+    # has, summary_rows merges them into the summary with and without any
+    # breakdown, so one scan serves both
+    partition = [column for column in kernel_metrics.PARTITION_COLUMNS + ["contextId"] if not report_reader.missing_columns(report, {MEMCPY_TABLE: [column]})]
+    load = lambda: (partition, memcpy_analyze.memcpy_groups(report, edges, window, partition))
+    return state["cache"].get(report_key("memcpy groups", report, [("edges", tuple(edges)), ("window", window)]), load, lambda value: len(json.dumps(value)))
+#######################################################
+def memcpy_summary_result(state, report, query):
+    partition = query_partition(query)
+    check_columns(report, {MEMCPY_TABLE: memcpy_analyze.REPORT_TABLES[MEMCPY_TABLE] + partition})
+    edges = memcpy_analyze.parse_log2_edges(query.get("log2_edges", "12:20"))
+    labels = memcpy_analyze.bucket_labels(edges)
+    window = query_window(report, query)
+
+    keys, groups = memcpy_groups(state, report, edges, window)
+    # The partition columns are the leading group keys, in keys order
+    partition = [column for column in keys if column in partition]
+    result = {
+        "report": report,
+        "window": window,
+        "summary": [dict(row, size=labels[row["bucket"]]) for row in memcpy_analyze.summary_rows(groups, len(keys))],
+    }
+    if partition:
+        result["partitions"] = [dict(row, size=labels[row["bucket"]]) for row in memcpy_analyze.summary_rows(groups, len(keys), partition)]
+    return result
+#######################################################
+def cached_response(compute):
+    # An endpoint whose encoded responses are cached per report and query
+    def endpoint(state, query):
+        report = query_report(query)
+        options = [(name, value) for name, value in query.items() if name != "report"]
+        return state["cache"].get(report_key(compute.__name__, report, options), lambda: encode(compute(state, report, query)), len)
+    return endpoint
+#######################################################
+def status_response(state, query):
+    return encode(dict(state["cache"].status(), workers=state["workers"]))
+#######################################################
+ENDPOINTS = {
+    "/kernel_metrics": cached_response(kernel_metrics_result),
+    "/memcpy_summary": cached_response(memcpy_summary_result),
+    "/status": status_response,
+}
+#######################################################
+class AnalysisHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            self.reply(404, encode({"error": "unknown endpoint " + url.path, "endpoints": sorted(ENDPOINTS)}))
+            return
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        state = self.server.state
+        try:
+            self.reply(200, state["pool"].submit(endpoint, state, query).result())
+        except FileNotFoundError as error:
+            self.reply(404, encode({"error": str(error)}))
+        except (ValueError, argparse.ArgumentTypeError) as error:
+            self.reply(400, encode({"error": str(error)}))
+        except (sqlite3.Error, OSError) as error:
+            self.reply(500, encode({"error": str(error)}))
+        except Exception as error:
+            # Anything else is a bug, the client still gets an answer
+            self.log_error("error answering %s", self.path)
+            traceback.print_exc()
+            self.reply(500, encode({"error": "%s: %s" % (type(error).__name__, error)}))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client did not wait for the answer
+            pass
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+#######################################################
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+#######################################################
+def make_server(args, state):
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, AnalysisHandler)
+        address = args.socket
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), AnalysisHandler)
+        address = "http://%s:%d" % server.server_address[:2]
+    server.state = state
+    return server, address
+#######################################################
+def stop(signum, frame):
+    raise KeyboardInterrupt
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on, default 127.0.0.1 (this machine only)")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port, default 8765")
+    parser.add_argument("--socket", metavar="PATH", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 8), help="requests analysed at the same time, default the CPU count up to 8")
+    parser.add_argument("--memory-mb", type=float, default=2048, help="bound of the cached columns and responses, default 2048 MB")
+    report_cache.add_cache_arguments(parser)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers needs at least one worker")
+
+    state = {
+        "cache": LRUCache(int(args.memory_mb * (1 << 20))),
+        "use_cache": report_cache.cache_mode(args),
+        "pool": concurrent.futures.ThreadPoolExecutor(max_workers=args.workers),
+        "workers": args.workers,
+    }
+    server, address = make_server(args, state)
+    signal.signal(signal.SIGTERM, stop)
+    print("Serving kernel and memcpy metrics on", address, "with", args.workers, "workers")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        state["pool"].shutdown(wait=False, cancel_futures=True)
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
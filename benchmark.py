@@ -0,0 +1,161 @@
+#This script times the stages of every script on synthetic reports.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 benchmark.py [--rows 1e4,1e5,1e6] [--cases NAME,...] [--output results.json] [--baseline results.json [--tolerance 0.2]] [--work-dir DIR]
+
+#Note: Times the stages of every script on synthetic reports (see
+# synthetic_report.py) of growing size and records the peak RSS. Every
+# case runs in a fresh process so the RSS is its own, the caches are not
+# used and nothing is plotted (the figures do not depend on the row count).
+# With --baseline the stages that got slower than the tolerance are listed.
+#########################################################################
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import synthetic_report
+#######################################################
+def kernel_exact(database_file, stage):
+    import kernel_metrics
+    columns = stage("query", kernel_metrics.extract_kernel_columns, database_file)
+    stage("statistics", kernel_metrics.column_statistics, columns)
+#######################################################
+def kernel_sketch(database_file, stage):
+    import kernel_metrics
+    config_keys, names, ket, klo, slack = stage("sketch scan", kernel_metrics.sketch_kernel_configs, database_file, 0.01)
+    stage("statistics", kernel_metrics.sketch_statistics, len(config_keys), ket, klo, slack)
+#######################################################
+def memcpy_script(module_name, **options):
+    def run(database_file, stage):
+        import importlib
+        import report_cache
+        module = importlib.import_module(module_name)
+        stage("load", report_cache.load_memcpy_columns, database_file, False)
+        stage("total", module.extract_host_to_device_transfers, database_file, False, {"plot": False}, **options)
+    return run
+#######################################################
+def memcpy_summary(database_file, stage):
+    import memcpy_analyze
+    stage("summary", memcpy_analyze.summarize_memcpy, database_file, memcpy_analyze.size_edges())
+#######################################################
+def gpu_utilization(database_file, stage):
+    import report_cache
+    import gpu_utilization
+    columns = stage("load", report_cache.load_kernel_intervals, database_file, False)
+    stage("sweep", gpu_utilization.gpu_utilization, columns)
+#######################################################
+def memcpy_overlap(database_file, stage):
+    import report_cache
+    import memcpy_overlap
+    kernels = stage("load kernels", report_cache.load_kernel_intervals, database_file, False)
+    transfers = stage("load memcpy", report_cache.load_memcpy_columns, database_file, False)
+    stage("overlap", memcpy_overlap.hidden_transfer_time, kernels, transfers)
+#######################################################
+CASES = {
+    "kernel_metrics": kernel_exact,
+    "kernel_metrics_sketch": kernel_sketch,
+    "memcpy_HtoD": memcpy_script("memcpy_HtoD"),
+    "memcpy_DtoH": memcpy_script("memcpy_DtoH"),
+    "memcpy_HtoD_bw": memcpy_script("memcpy_HtoD_bw"),
+    "memcpy_HtoD_bw_histogram": memcpy_script("memcpy_HtoD_bw", histogram=True),
+    "memcpy_analyze": memcpy_summary,
+    "gpu_utilization": gpu_utilization,
+    "memcpy_overlap": memcpy_overlap,
+}
+#######################################################
+def run_case(case, database_file):
+    # Runs in the child process, the last line printed is the result
+    timings = {}
+    def stage(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings[name] = time.perf_counter() - start
+        return result
+    CASES[case](database_file, stage)
+    # ru_maxrss is in kilobytes on Linux
+    print(json.dumps({"stages": timings, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+#######################################################
+def report_path(work_dir, rows):
+    return os.path.join(work_dir, "synthetic_%d.sqlite" % rows)
+#######################################################
+def benchmark(row_counts, cases, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for rows in row_counts:
+        database_file = report_path(work_dir, rows)
+        if not os.path.exists(database_file):
+            print("Generating", database_file)
+            synthetic_report.generate_report(database_file, num_kernels=rows, num_memcpy=rows)
+        for case in cases:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", case, database_file], capture_output=True, text=True, cwd=work_dir)
+            if process.returncode != 0:
+                print("Case", case, "failed on", rows, "rows:", process.stderr.strip().splitlines()[-1:])
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            result.update({"case": case, "rows": rows})
+            results.append(result)
+            stages = ' '.join("%s %.3fs" % item for item in result["stages"].items())
+            print("%-26s %12d rows  %9.1f MB  %s" % (case, rows, result["peak_rss_mb"], stages))
+    return results
+#######################################################
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    # Stages at least tolerance (relative) slower than in the baseline,
+    # stages shorter than min_seconds are too noisy to compare
+    previous = {(item["case"], item["rows"], name): seconds for item in baseline for name, seconds in item["stages"].items()}
+    regressions = []
+    for item in results:
+        for name, seconds in item["stages"].items():
+            before = previous.get((item["case"], item["rows"], name))
+            if before is not None and seconds > max(before, min_seconds) * (1 + tolerance):
+                regressions.append((item["case"], item["rows"], name, before, seconds))
+    if regressions:
+        print("Slower than the baseline:")
+        for case, rows, name, before, seconds in regressions:
+            print("%-26s %12d rows  %-12s %.3fs -> %.3fs" % (case, rows, name, before, seconds))
+    else:
+        print("No stage is slower than the baseline")
+    return regressions
+#######################################################
+def parse_rows(value):
+    return [int(float(item)) for item in value.split(",")]
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=parse_rows, default=parse_rows("1e4,1e5,1e6"), help="comma separated kernel (and transfer) counts, e.g. 1e4,1e5,1e6,1e7,1e8")
+    parser.add_argument("--cases", default=','.join(CASES), help="comma separated cases, default all of " + ','.join(CASES))
+    parser.add_argument("--work-dir", default="benchmark_reports", help="where the synthetic reports are kept between runs")
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="stages shorter than this are not compared")
+    parser.add_argument("--run-case", nargs=2, metavar=("CASE", "REPORT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(*args.run_case)
+        sys.exit(0)
+
+    results = benchmark(args.rows, args.cases.split(","), args.work_dir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,109 @@
+#This module keeps streaming bandwidth histograms per transfer size bucket.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Streaming bandwidth distribution for the memcpy_*_bw scripts.
+# Every transfer size bucket keeps a fixed log-spaced histogram of the
+# bandwidth plus its exact count, sum, minimum and maximum, so the memory
+# only depends on the number of bins and not on the number of transfers.
+# The median is read from the histogram, within one bin (about 2.3% with
+# the default 100 bins per decade).
+#########################################################################
+import numpy as np
+#######################################################
+# Upper bounds of the transfer size buckets, the last bucket is open
+SIZE_EDGES = np.array([4, 8, 16, 32, 64, 128, 256, 512, 1024], dtype=np.int64) * 1024
+# Bandwidth bins in MB/s, values outside are counted in the first/last bin
+BW_EDGES = np.logspace(-3, 8, 11 * 100 + 1)
+#######################################################
+def new_histograms(num_buckets=len(SIZE_EDGES) + 1, bw_edges=BW_EDGES):
+    return {
+        "edges": bw_edges,
+        "counts": np.zeros((num_buckets, len(bw_edges) - 1), dtype=np.int64),
+        "n": np.zeros(num_buckets, dtype=np.int64),
+        "sum": np.zeros(num_buckets),
+        "min": np.full(num_buckets, np.inf),
+        "max": np.full(num_buckets, -np.inf),
+    }
+#######################################################
+def update_histograms(state, transfer_bytes, start, end):
+    # Transfers without a duration have no bandwidth and are skipped
+    time = end - start
+    valid = time > 0
+    bandwidth = transfer_bytes[valid] * 953.674 / time[valid]
+    bucket = np.searchsorted(SIZE_EDGES, transfer_bytes[valid], side='left')
+
+    num_buckets, num_bins = state["counts"].shape
+    bins = np.clip(np.searchsorted(state["edges"], bandwidth, side='right') - 1, 0, num_bins - 1)
+    state["counts"] += np.bincount(bucket * num_bins + bins, minlength=num_buckets * num_bins).reshape(num_buckets, num_bins)
+    state["n"] += np.bincount(bucket, minlength=num_buckets)
+    state["sum"] += np.bincount(bucket, weights=bandwidth, minlength=num_buckets)
+    np.minimum.at(state["min"], bucket, bandwidth)
+    np.maximum.at(state["max"], bucket, bandwidth)
+#######################################################
+def histogram_median(counts, edges, low, high):
+    cumulative = np.cumsum(counts)
+    half = cumulative[-1] / 2
+    index = np.searchsorted(cumulative, half, side='left')
+    before = cumulative[index - 1] if index > 0 else 0
+    fraction = (half - before) / counts[index]
+    # Interpolate inside the bin on the log scale the bins are spaced on
+    median = edges[index] * (edges[index + 1] / edges[index]) ** fraction
+    return min(max(median, low), high)
+#######################################################
+def violin_stats(state):
+    edges = state["edges"]
+    stats = []
+    for bucket in range(len(state["n"])):
+        n = state["n"][bucket]
+        if n == 0:
+            stats.append({"coords": [0], "vals": [0], "mean": 0, "median": 0, "min": 0, "max": 0})
+            continue
+        counts = state["counts"][bucket]
+        low = state["min"][bucket]
+        high = state["max"][bucket]
+        used = np.flatnonzero(counts)
+        first, last = used[0], used[-1] + 1
+        density = counts[first:last] / (n * np.diff(edges[first:last + 1]))
+        centers = np.sqrt(edges[first:last] * edges[first + 1:last + 1])
+        coords = np.concatenate(([low], np.clip(centers, low, high), [high]))
+        vals = np.concatenate((density[:1], density, density[-1:]))
+        stats.append({
+            "coords": coords,
+            "vals": vals,
+            "mean": state["sum"][bucket] / n,
+            "median": histogram_median(counts[first:last], edges[first:last + 1], low, high),
+            "min": low,
+            "max": high,
+        })
+    return stats
+#######################################################
+def bucket_row(count, mean, median, low, high):
+    return {"count": int(count), "bw_mean": float(mean), "bw_median": float(median), "bw_min": float(low), "bw_max": float(high)}
+#######################################################
+def histogram_table(state, vpstats):
+    # Per size bucket bandwidth summary in MB/s, the median is the
+    # histogram estimate and the rest is exact
+    return [bucket_row(n, stats["mean"], stats["median"], stats["min"], stats["max"]) for n, stats in zip(state["n"], vpstats)]
+#######################################################
+def list_table(array_lists):
+    # Same summary from the bandwidths of every transfer
+    rows = []
+    for values in array_lists:
+        if len(values) == 0:
+            rows.append(bucket_row(0, 0, 0, 0, 0))
+        else:
+            rows.append(bucket_row(len(values), np.mean(values), np.median(values), np.min(values), np.max(values)))
+    return rows
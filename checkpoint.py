@@ -0,0 +1,127 @@
+#This module saves and restores checkpoints for --resume.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Checkpoints of long runs in <report>.checkpoint/, next to the
+# report. A run saves named parts (NumPy arrays, e.g. the launches of one
+# rowid range of the scan) as they are finished and, every
+# CHECKPOINT_SECONDS, the per-config results computed so far. Every file
+# is written under a temporary name and renamed, and state.json, which
+# lists the finished parts, is always written last, so a run that is
+# killed at any point leaves the last consistent checkpoint behind.
+# SIGTERM (a node timeout or preemption) is turned into KeyboardInterrupt
+# so the running step can save its results before the run exits.
+# --resume reuses the checkpoint of a run with the same report (see
+# report_cache.report_fingerprint) and options, anything else starts over.
+# The checkpoint is removed when the run finishes.
+#########################################################################
+import os
+import json
+import time
+import shutil
+import signal
+import hashlib
+import numpy as np
+import report_cache
+#######################################################
+CHECKPOINT_SECONDS = 60
+#######################################################
+def checkpoint_dir(database_file):
+    return database_file + ".checkpoint"
+#######################################################
+def save_state(checkpoint):
+    state_file = os.path.join(checkpoint["directory"], "state.json")
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(checkpoint["state"], f)
+    os.replace(state_file + ".tmp", state_file)
+#######################################################
+def open_checkpoint(database_file, options, resume=False):
+    # options are the json-able options the saved results depend on
+    directory = checkpoint_dir(database_file)
+    key = {"fingerprint": report_cache.report_fingerprint(database_file), "options": options}
+    state = None
+    if resume and os.path.exists(os.path.join(directory, "state.json")):
+        with open(os.path.join(directory, "state.json")) as f:
+            state = json.load(f)
+        if state["key"] != json.loads(json.dumps(key)):
+            print("The checkpoint in", directory, "is of another report or other options, starting over")
+            state = None
+        else:
+            print("Resuming from", directory + ":", len(state["parts"]), "parts and", ', '.join("%d %s" % (item["done"], name) for name, item in state["results"].items()) or "no results")
+    elif resume:
+        print("No checkpoint in", directory, "starting over")
+    if state is None:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        state = {"key": key, "parts": [], "results": {}}
+    checkpoint = {"directory": directory, "state": state, "saved": time.perf_counter()}
+    save_state(checkpoint)
+    return checkpoint
+#######################################################
+def part_file(checkpoint, name):
+    return os.path.join(checkpoint["directory"], name + ".npy")
+#######################################################
+def has_part(checkpoint, name):
+    return name in checkpoint["state"]["parts"]
+#######################################################
+def load_part(checkpoint, name):
+    return np.load(part_file(checkpoint, name))
+#######################################################
+def save_part(checkpoint, name, values):
+    np.save(part_file(checkpoint, name) + ".tmp.npy", np.asarray(values))
+    os.replace(part_file(checkpoint, name) + ".tmp.npy", part_file(checkpoint, name))
+    checkpoint["state"]["parts"].append(name)
+    save_state(checkpoint)
+#######################################################
+def results_digest(keys):
+    # Tells the configs the results were computed for
+    keys = np.ascontiguousarray(keys)
+    return hashlib.sha1(str(keys.shape).encode() + keys.tobytes()).hexdigest()
+#######################################################
+def load_results(checkpoint, name, keys):
+    # The columns of the results of the first configs of keys, {} when
+    # there are none for these keys
+    item = checkpoint["state"]["results"].get(name)
+    if item is None or item["digest"] != results_digest(keys):
+        return {}
+    return {column: np.load(part_file(checkpoint, "%s.%s" % (name, column)))[:item["done"]] for column in item["columns"]}
+#######################################################
+def save_results(checkpoint, name, keys, results, force=False):
+    # results maps columns to the lists of the configs done so far, they
+    # are saved at most every CHECKPOINT_SECONDS unless force is set
+    now = time.perf_counter()
+    if not force and now - checkpoint["saved"] < CHECKPOINT_SECONDS:
+        return
+    done = min(len(values) for values in results.values())
+    for column, values in results.items():
+        file_name = part_file(checkpoint, "%s.%s" % (name, column))
+        np.save(file_name + ".tmp.npy", np.asarray(values[:done], dtype=np.float64))
+        os.replace(file_name + ".tmp.npy", file_name)
+    checkpoint["state"]["results"][name] = {"digest": results_digest(keys), "done": done, "columns": list(results)}
+    save_state(checkpoint)
+    checkpoint["saved"] = now
+#######################################################
+def remove_checkpoint(checkpoint):
+    shutil.rmtree(checkpoint["directory"], ignore_errors=True)
+#######################################################
+def interrupt(signum, frame):
+    raise KeyboardInterrupt("signal %d" % signum)
+#######################################################
+def interrupt_on_termination():
+    signal.signal(signal.SIGTERM, interrupt)
+#######################################################
+def add_checkpoint_arguments(parser):
+    parser.add_argument("--checkpoint", action="store_true", help="save the finished scan ranges and per-config results to <report>.checkpoint as the run goes")
+    parser.add_argument("--resume", action="store_true", help="continue the checkpoint of an interrupted run with the same options (implies --checkpoint)")
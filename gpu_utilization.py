@@ -0,0 +1,371 @@
+#This script computes the GPU utilization, kernel concurrency and idle gaps.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 gpu_utilization.py [--build-index [--sidecar]] [--no-cache | --incremental] [--top-gaps K] [--bins N] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
+
+#Note: How busy the GPUs were, from the kernel intervals of
+# CUPTI_ACTIVITY_KIND_KERNEL. The kernels are sorted once by device,
+# stream and start, and a running maximum of the end times merges the
+# intervals of every stream into busy periods and idle gaps. Per device
+# the kernel starts and ends are sorted together as +1/-1 events, and the
+# cumulative sum of the events is the number of kernels running at every
+# moment (the concurrency), from which the busy time, the time spent at
+# every concurrency level, the idle gaps and a concurrency timeline
+# follow. All of it is NumPy sorting and cumulative sums, O(n log n) with
+# no Python loop over the kernels.
+#########################################################################
+import sys
+import argparse
+import numpy as np
+import sqlite3
+import nsys_index
+import report_cache
+import report_reader
+import render
+import table_export
+import profiling
+import time_window
+#######################################################
+# Upper bounds (ns) of the idle gap buckets, the last bucket is open
+GAP_EDGES = [1000, 10000, 100000, 1000000, 10000000, 100000000]
+GAP_LABELS = ["<1us", "1-10us", "10-100us", "100us-1ms", "1-10ms", "10-100ms", "100ms+"]
+#######################################################
+def gap_buckets(lengths):
+    return np.searchsorted(GAP_EDGES, lengths, side="right")
+#######################################################
+def stream_sweep(start, end, group, num_groups):
+    # start, end and the dense group ids sorted by group and then start.
+    # Returns the busy time of every group and the (start, length, group)
+    # of the idle gaps between its kernels
+    num = len(start)
+    first = np.ones(num, dtype=bool)
+    first[1:] = group[1:] != group[:-1]
+    first_index = np.flatnonzero(first)
+
+    # Running maximum of the end times within every group: the ends are
+    # made relative to the first start of their group and shifted by the
+    # spans of the groups before it, so one global running maximum never
+    # carries over from one group into the next
+    base = start[first_index][group]
+    relative_end = end - base
+    span = np.maximum.reduceat(relative_end, first_index) + 1
+    offset = np.concatenate(([0], np.cumsum(span)[:-1]))[group]
+    reach = np.maximum.accumulate(relative_end + offset) - offset + base
+
+    # A kernel starting after everything before it in its stream ended
+    # begins a new busy period, the time in between is an idle gap
+    new = first.copy()
+    new[1:] |= start[1:] > reach[:-1]
+    gap = np.flatnonzero(new & ~first)
+    gap_start = reach[gap - 1]
+    gap_length = start[gap] - gap_start
+
+    period = np.flatnonzero(new)
+    period_end = reach[np.append(period[1:] - 1, num - 1)]
+    busy = np.bincount(group[period], weights=period_end - start[period], minlength=num_groups)
+    return busy, gap_start, gap_length, group[gap]
+#######################################################
+def busy_periods(start, end):
+    # The union of intervals sorted by start, as sorted disjoint periods
+    reach = np.maximum.accumulate(end)
+    new = np.ones(len(start), dtype=bool)
+    new[1:] = start[1:] > reach[:-1]
+    period = np.flatnonzero(new)
+    return start[period], reach[np.append(period[1:] - 1, len(start) - 1)]
+#######################################################
+def concurrency_sweep(start, end, num_bins):
+    # The starts and ends of one device as +1/-1 events. The times are
+    # doubled and the starts made odd, so one sort orders the events by time
+    # with the ends first: back to back kernels do not count as overlapping
+    events = np.concatenate((end * 2, start * 2 + 1))
+    events.sort()
+    times = events >> 1
+    level = np.cumsum((events & 1).astype(np.int32) * 2 - 1, dtype=np.int32)[:-1]
+    duration = np.diff(times)
+    del events
+    # The end of an instantaneous kernel comes before its start, the dip
+    # below the true level lasts no time
+    np.maximum(level, 0, out=level)
+
+    time_at_level = np.bincount(level, weights=duration)
+    idle = np.flatnonzero((level == 0) & (duration > 0))
+    gap_start = times[idle]
+    gap_length = duration[idle]
+
+    # Mean concurrency and busy fraction in equal time bins, from the
+    # integrals of the concurrency and of concurrency > 0 over time
+    relative = (times - times[0]).astype(np.float64)
+    concurrency_integral = np.concatenate(([0.0], np.cumsum(level * duration, dtype=np.float64)))
+    busy_integral = np.concatenate(([0.0], np.cumsum((level > 0) * duration, dtype=np.float64)))
+    edges = np.linspace(0.0, relative[-1], num_bins + 1)
+    width = relative[-1] / num_bins if relative[-1] > 0 else 1.0
+    timeline = {
+        "time": (edges[:-1] + edges[1:]) / 2 + times[0],
+        "concurrency": np.diff(np.interp(edges, relative, concurrency_integral)) / width,
+        "busy": np.diff(np.interp(edges, relative, busy_integral)) / width,
+    }
+    return {
+        "span": int(times[-1] - times[0]),
+        "time_at_level": time_at_level,
+        "max_concurrency": int(level.max()),
+        "gap_start": gap_start,
+        "gap_length": gap_length,
+        "timeline": timeline,
+    }
+#######################################################
+def largest_gaps(gap_start, gap_length, top):
+    if len(gap_length) > top:
+        index = np.argpartition(gap_length, len(gap_length) - top)[len(gap_length) - top:]
+    else:
+        index = np.arange(len(gap_length))
+    index = index[np.argsort(-gap_length[index], kind="stable")]
+    return gap_start[index], gap_length[index]
+#######################################################
+def stream_groups(device, stream):
+    # Dense ids of the (device, stream) pairs in device and stream order,
+    # and the device and stream of every id
+    device = device.astype(np.int64)
+    stream = stream.astype(np.int64)
+    stream_min = int(stream.min())
+    stream_range = int(stream.max()) - stream_min + 1
+    device_min = int(device.min())
+    key = (device - device_min) * stream_range + (stream - stream_min)
+    if (int(device.max()) - device_min + 1) * stream_range <= 1 << 24:
+        present = np.bincount(key) > 0
+        keys = np.flatnonzero(present)
+        dense = np.cumsum(present) - 1
+        group = dense[key]
+    else:
+        keys, group = np.unique(key, return_inverse=True)
+    return group, keys // stream_range + device_min, keys % stream_range + stream_min
+#######################################################
+def gpu_utilization(columns, top_gaps=20, num_bins=1000):
+    start = np.asarray(columns["start"])
+    # A kernel ending before it started is taken as instantaneous
+    end = np.maximum(np.asarray(columns["end"]), start)
+    device = np.asarray(columns["deviceId"])
+    stream = np.asarray(columns["streamId"])
+    profiling.add_rows(len(start))
+    if len(start) == 0:
+        return {"devices": [], "streams": []}
+
+    with profiling.stage("sort"):
+        group, group_device, group_stream = stream_groups(device, stream)
+        num_groups = len(group_device)
+        # A stable sort of the starts (the report is mostly in time order
+        # already) and then a stable sort of the few group ids, which NumPy
+        # does as a radix sort when they fit in 16 bits
+        order = np.argsort(start, kind="stable")
+        group = group[order]
+        by_group = np.argsort(group.astype(np.uint16) if num_groups <= 1 << 16 else group, kind="stable")
+        order = order[by_group]
+        group = group[by_group]
+        start = start[order]
+        end = end[order]
+        del order, by_group
+
+    with profiling.stage("stream sweep"):
+        first = np.ones(len(start), dtype=bool)
+        first[1:] = group[1:] != group[:-1]
+        first_index = np.flatnonzero(first)
+        busy, gap_start, gap_length, gap_group = stream_sweep(start, end, group, num_groups)
+        kernel_time = np.bincount(group, weights=end - start, minlength=num_groups)
+        counts = np.bincount(group, minlength=num_groups)
+        span = np.maximum.reduceat(end, first_index) - start[first_index]
+        bucket = gap_buckets(gap_length)
+        bucket_counts = np.bincount(gap_group * len(GAP_LABELS) + bucket, minlength=num_groups * len(GAP_LABELS)).reshape(num_groups, -1)
+        bucket_time = np.bincount(gap_group * len(GAP_LABELS) + bucket, weights=gap_length, minlength=num_groups * len(GAP_LABELS)).reshape(num_groups, -1)
+        # The gaps come out in group order
+        gap_first = np.searchsorted(gap_group, np.arange(num_groups))
+        has_gaps = np.bincount(gap_group, minlength=num_groups) > 0
+        largest = np.zeros(num_groups)
+        if len(gap_length):
+            largest[has_gaps] = np.maximum.reduceat(gap_length, gap_first[has_gaps])
+        streams = []
+        for i in range(num_groups):
+            streams.append({
+                "device": int(group_device[i]),
+                "stream": int(group_stream[i]),
+                "kernels": int(counts[i]),
+                "span": int(span[i]),
+                "busy": float(busy[i]),
+                "kernel_time": float(kernel_time[i]),
+                "gaps": int(bucket_counts[i].sum()),
+                "largest_gap": float(largest[i]),
+                "gap_counts": bucket_counts[i],
+                "gap_time": bucket_time[i],
+            })
+        del group, gap_start, gap_length, gap_group, bucket
+
+    # The streams of a device are next to each other after the sort
+    devices = []
+    device_groups = np.flatnonzero(np.concatenate(([True], group_device[1:] != group_device[:-1])))
+    device_first = first_index[device_groups]
+    device_last = np.append(device_first[1:], len(start))
+    for device_id, low, high in zip(group_device[device_groups], device_first, device_last):
+        with profiling.stage("device sweep"):
+            sweep = concurrency_sweep(start[low:high], end[low:high], num_bins)
+            bucket = gap_buckets(sweep["gap_length"])
+            top_start, top_length = largest_gaps(sweep["gap_start"], sweep["gap_length"], top_gaps)
+            devices.append({
+                "device": int(device_id),
+                "kernels": int(high - low),
+                "span": sweep["span"],
+                "busy": float(sweep["time_at_level"][1:].sum()),
+                "kernel_time": float((end[low:high] - start[low:high]).sum()),
+                "max_concurrency": sweep["max_concurrency"],
+                "time_at_level": sweep["time_at_level"],
+                "gaps": len(sweep["gap_length"]),
+                "largest_gap": float(top_length[0]) if len(top_length) else 0.0,
+                "gap_counts": np.bincount(bucket, minlength=len(GAP_LABELS)),
+                "gap_time": np.bincount(bucket, weights=sweep["gap_length"], minlength=len(GAP_LABELS)),
+                "largest_gaps": list(zip(top_start.tolist(), top_length.tolist())),
+                "timeline": sweep["timeline"],
+            })
+    return {"devices": devices, "streams": streams}
+#######################################################
+def utilization_rows(result):
+    rows = []
+    for item in result["devices"] + result["streams"]:
+        rows.append({
+            "device": item["device"],
+            "stream": item.get("stream", "all"),
+            "kernels": item["kernels"],
+            "span_us": item["span"] / 1000,
+            "busy_us": item["busy"] / 1000,
+            "utilization": item["busy"] / item["span"] if item["span"] > 0 else 0.0,
+            # Average number of kernels running while the GPU (or stream) is busy
+            "mean_concurrency": item["kernel_time"] / item["busy"] if item["busy"] > 0 else 0.0,
+            # Only known per device, the stream sweep merges the intervals
+            "max_concurrency": item.get("max_concurrency"),
+            "idle_gaps": item["gaps"],
+            "idle_us": float(item["gap_time"].sum()) / 1000,
+            "largest_gap_us": item["largest_gap"] / 1000,
+        })
+    return rows
+#######################################################
+def concurrency_rows(result):
+    rows = []
+    for item in result["devices"]:
+        for level, duration in enumerate(item["time_at_level"]):
+            rows.append({"device": item["device"], "concurrency": level, "time_us": duration / 1000, "fraction": duration / item["span"] if item["span"] > 0 else 0.0})
+    return rows
+#######################################################
+def gap_rows(result):
+    rows = []
+    for item in result["devices"] + result["streams"]:
+        for label, count, duration in zip(GAP_LABELS, item["gap_counts"], item["gap_time"]):
+            rows.append({"device": item["device"], "stream": item.get("stream", "all"), "gap": label, "count": int(count), "time_us": duration / 1000})
+    return rows
+#######################################################
+def largest_gap_rows(result):
+    rows = []
+    for item in result["devices"]:
+        for gap_start, gap_length in item["largest_gaps"]:
+            rows.append({"device": item["device"], "start_ns": gap_start, "end_ns": gap_start + gap_length, "gap_us": gap_length / 1000})
+    return rows
+#######################################################
+def print_utilization(rows, largest):
+    print("%-7s %-7s %10s %14s %14s %7s %8s %6s %10s %14s" % ("device", "stream", "kernels", "span (us)", "busy (us)", "util", "mean cc", "max cc", "gaps", "largest (us)"))
+    for row in rows:
+        print("%-7s %-7s %10d %14.1f %14.1f %6.1f%% %8.2f %6s %10d %14.1f" % (row["device"], row["stream"], row["kernels"], row["span_us"], row["busy_us"], 100 * row["utilization"],
+            row["mean_concurrency"], row["max_concurrency"] if row["max_concurrency"] is not None else "-", row["idle_gaps"], row["largest_gap_us"]))
+    if largest:
+        print("Largest idle gaps:")
+        for row in largest:
+            print("    device %d  [%d, %d) ns  %.1f us" % (row["device"], row["start_ns"], row["end_ns"], row["gap_us"]))
+#######################################################
+def draw_concurrency_timeline(plt, devices, times, concurrency, busy):
+    fig, (ax_concurrency, ax_busy) = plt.subplots(2, figsize=(14, 10), sharex=True)
+    for device, x_values, y_concurrency, y_busy in zip(devices, times, concurrency, busy):
+        ax_concurrency.plot(x_values, y_concurrency, linewidth=0.8, label="device %d" % device)
+        ax_busy.plot(x_values, 100 * y_busy, linewidth=0.8, label="device %d" % device)
+    ax_concurrency.set_ylabel("Mean concurrent kernels")
+    ax_busy.set_ylabel("Busy (%)")
+    ax_busy.set_xlabel("Time (s)")
+    for ax in (ax_concurrency, ax_busy):
+        ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+        ax.legend()
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+#######################################################
+def draw_gap_histogram(plt, devices, counts, labels):
+    width = 0.8 / len(devices)
+    x_values = np.arange(1, len(labels) + 1)
+    fig, ax = plt.subplots(1, figsize=(12, 10))
+    for i, (device, values) in enumerate(zip(devices, counts)):
+        ax.bar(x_values - 0.4 + width * (i + 0.5), values, width=width, edgecolor='black', label="device %d" % device)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=45)
+    ax.set_yscale('log')
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Idle gap length")
+    ax.set_ylabel("Instances")
+    ax.legend()
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+#######################################################
+def plot_utilization(result, render_options=None):
+    devices = result["devices"]
+    if len(devices) == 0:
+        return
+    first = min(item["timeline"]["time"][0] for item in devices)
+    figures = [
+        ("gpu_concurrency", draw_concurrency_timeline, ([item["device"] for item in devices], [(item["timeline"]["time"] - first) / 1e9 for item in devices],
+            [item["timeline"]["concurrency"] for item in devices], [item["timeline"]["busy"] for item in devices])),
+        ("hist_gpu_idle_gaps", draw_gap_histogram, ([item["device"] for item in devices], [item["gap_counts"] for item in devices], GAP_LABELS)),
+    ]
+    render.render_figures(figures, render_options)
+#######################################################
+def analyze_utilization(database_file, use_cache=True, top_gaps=20, num_bins=1000, render_options=None, window=None):
+    try:
+        columns = report_cache.load_kernel_intervals(database_file, use_cache, window)
+    except sqlite3.Error as error:
+        print("Error reading data from SQLite table:", error)
+        sys.exit(1)
+    with profiling.stage("sweep"):
+        result = gpu_utilization(columns, top_gaps, num_bins)
+    rows = utilization_rows(result)
+    largest = largest_gap_rows(result)
+    print_utilization(rows, largest)
+    table_export.export_table("gpu_utilization", rows, render_options)
+    table_export.export_table("gpu_concurrency", concurrency_rows(result), render_options)
+    table_export.export_table("gpu_idle_gaps", gap_rows(result), render_options)
+    table_export.export_table("gpu_largest_gaps", largest, render_options)
+    plot_utilization(result, render_options)
+    return result
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    report_cache.add_cache_arguments(parser)
+    parser.add_argument("--top-gaps", type=int, default=20, help="number of largest idle gaps listed per device")
+    parser.add_argument("--bins", type=int, default=1000, help="number of time bins of the concurrency timeline")
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    database_file = nsys_index.resolve_report(args)
+    report_reader.check_report(database_file, report_cache.KERNEL_INTERVAL_TABLES)
+    profiling.start_profile(args.profile, args.cprofile)
+    with profiling.stage("analyze_utilization"):
+        analyze_utilization(database_file, report_cache.cache_mode(args), args.top_gaps, args.bins, render.render_options(args), time_window.window_arguments(database_file, args, parser))
+    profiling.finish_profile()
@@ -14,34 +14,40 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #########################################################################
-#Usage: python3 kernel_metrics.py <sqlite file>
+#Usage: python3 kernel_metrics.py [--build-index [--sidecar]] [--no-cache | --incremental] [--sketch ERROR] [-j JOBS] [--top K [--rank-by total|count|sketch]] [--breakdown [--by-context]] [--demangle] [--sample FRACTION [--seed S]] [--checkpoint | --resume] [--progress | --no-progress] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
 
 #Note: It may take from a few minutes to multiple hours for the script
 # to finish producing the figures based on the <sqlite file> size
 #########################################################################
 import os
 import sys 
-import matplotlib
-matplotlib.use("pgf")
-matplotlib.rcParams.update({
-    "pgf.texsystem": "pdflatex",
-    'font.family': 'serif',
-    'font.size': 14, 
-    'text.usetex': True,
-    'pgf.rcfonts': False,
-})
-import matplotlib.pyplot as plt 
+import argparse
 import numpy as np
 import re
 import math
 import heapq
+import shutil
 import sqlite3
-from matplotlib.ticker import MultipleLocator
+import functools
+import subprocess
+import concurrent.futures
+import nsys_index
+import report_cache
+import report_reader
+import quantile_sketch
+import render
+import table_export
+import profiling
+import progress
+import checkpoint
+import time_window
 ######################################################################
 def calculate_median(lst):
     return np.median(lst)
 ######################################################################
 def remove_outliers(data):
+    data = np.asarray(data)
+
     # Calculate the first and third quartiles
     Q1 = np.percentile(data, 25) 
     Q3 = np.percentile(data, 75) 
@@ -54,137 +60,1004 @@ def remove_outliers(data):
     upper_bound = Q3 + 1.5 * IQR 
 
     # Remove outliers
-    clean_data = [x for x in data if (x >= lower_bound) and (x <= upper_bound)]
+    clean_data = data[(data >= lower_bound) & (data <= upper_bound)]
 
     return clean_data
 ######################################################################
-def extract_metrics(database_file):
-    conn = sqlite3.connect(database_file)
+# A single joined scan returns every launch together with its config and
+# the kernel/runtime start and end, instead of three queries per config
+SQL_QUERY_LAUNCHES = """
+SELECT
+    cuda_gpu.shortName,
+    cuda_gpu.gridX,
+    cuda_gpu.gridY,
+    cuda_gpu.gridZ,
+    cuda_gpu.blockX,
+    cuda_gpu.blockY,
+    cuda_gpu.blockZ,
+    cuda_gpu.start,
+    cuda_gpu.end,
+    RUNTIME.start,
+    RUNTIME.end,
+    cuda_gpu.deviceId,
+    cuda_gpu.streamId,
+    cuda_gpu.contextId
+FROM StringIds
+JOIN CUPTI_ACTIVITY_KIND_KERNEL AS cuda_gpu ON cuda_gpu.shortName = StringIds.id
+JOIN CUPTI_ACTIVITY_KIND_RUNTIME AS RUNTIME ON RUNTIME.correlationId = cuda_gpu.correlationId
+"""
+# Restricts the scan to a range of kernel rows, for the parallel workers
+SQL_ROWID_RANGE = "cuda_gpu.rowid BETWEEN ? AND ?"
+# The launches added to a report since the watermarks of an incremental
+# run: new kernels, and old kernels whose runtime call is new
+SQL_NEW_KERNELS = " WHERE cuda_gpu.rowid > ? AND cuda_gpu.rowid <= ? AND RUNTIME.rowid <= ?"
+SQL_NEW_RUNTIME = " WHERE cuda_gpu.rowid <= ? AND RUNTIME.rowid > ? AND RUNTIME.rowid <= ?"
+KERNEL_TABLES = ["CUPTI_ACTIVITY_KIND_KERNEL", "CUPTI_ACTIVITY_KIND_RUNTIME"]
+# The kernel columns of the launch scan, in its order, and correlationId
+KERNEL_LAUNCH_COLUMNS = ["shortName", "gridX", "gridY", "gridZ", "blockX", "blockY", "blockZ", "start", "end", "deviceId", "streamId", "contextId", "correlationId"]
+NUM_LAUNCH_COLUMNS = 14
+# The per-launch columns of the kernel cache, columns 7 to 13 of the scan
+LAUNCH_COLUMNS = ["kernel_start", "kernel_end", "runtime_start", "runtime_end", "deviceId", "streamId", "contextId"]
+# Keys of the --breakdown partitions
+PARTITION_COLUMNS = ["deviceId", "streamId"]
+# Cheap dominance estimates that rank the configs for --top
+RANK_METRICS = ("total", "count", "sketch")
+RANK_SKETCH_ERROR = 0.01
+# Metrics with confidence intervals under --sample
+SAMPLE_METRICS = ("ket", "klo", "slack", "dominance")
+# Fewest values whose median gets a 95% interval, with fewer even the
+# smallest and largest value miss the median more than 5% of the time
+MIN_INTERVAL_VALUES = 6
+# Dominant configs printed under --sample
+NUM_SAMPLE_PRINTED = 10
+# Kernel rows per saved range of the scan under --checkpoint
+CHECKPOINT_RANGE_ROWS = 1 << 20
+REPORT_TABLES = {
+    "StringIds": ["id", "value"],
+    "CUPTI_ACTIVITY_KIND_KERNEL": KERNEL_LAUNCH_COLUMNS,
+    "CUPTI_ACTIVITY_KIND_RUNTIME": ["correlationId", "start", "end"],
+}
+######################################################################
+def launch_query(rowid_range=None, window=None):
+    # The launch scan restricted to a rowid range and/or a time window,
+    # returns the query and its parameters
+    conditions = []
+    params = []
+    if rowid_range is not None:
+        conditions.append(SQL_ROWID_RANGE)
+        params.extend(rowid_range)
+    if window is not None:
+        conditions.append(time_window.window_condition("cuda_gpu.start"))
+        params.extend(window)
+    if len(conditions) == 0:
+        return SQL_QUERY_LAUNCHES, ()
+    return SQL_QUERY_LAUNCHES + " WHERE " + " AND ".join(conditions), tuple(params)
+######################################################################
+def fetch_kernel_launches(cursor, rowid_range=None, window=None):
+    query, params = launch_query(rowid_range, window)
+    if rowid_range is None:
+        nsys_index.report_query_plan(cursor, "kernel launches", query, params)
+    return report_reader.fetch_int_columns(cursor, query, NUM_LAUNCH_COLUMNS, params=params)
+######################################################################
+def pack_config_keys(keys):
+    # One int64 per row: every column is offset by its minimum and gets the
+    # bits its range needs, the first column in the highest bits so that the
+    # packed keys sort like the rows. None if they need more than 63 bits
+    low = keys.min(axis=0)
+    widths = [int(span).bit_length() for span in (keys.max(axis=0) - low).tolist()]
+    if sum(widths) > 63:
+        return None
+    packed = np.zeros(len(keys), dtype=np.int64)
+    for column, width in enumerate(widths):
+        if width > 0:
+            packed <<= width
+            packed |= keys[:, column] - low[column]
+    return packed
+######################################################################
+def config_key(keys):
+    # The kernel identity (shortName id and launch dimensions) as a single
+    # integer. Columns with a wide range are replaced by their dense ranks,
+    # which keeps the order, and None is left for the lexsort fallback
+    packed = pack_config_keys(keys)
+    if packed is None:
+        ranks = np.column_stack([np.unique(keys[:, column], return_inverse=True)[1].ravel() for column in range(keys.shape[1])])
+        packed = pack_config_keys(ranks)
+    return packed
+######################################################################
+def unique_configs(keys):
+    # np.unique of the rows with the index of their first appearance and
+    # the inverse, on the packed keys when they fit
+    packed = config_key(keys) if len(keys) > 0 else None
+    if packed is None:
+        keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        return keys, first, inverse.ravel()
+    _, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+    return keys[first], first, inverse.ravel()
+######################################################################
+def group_kernel_configs(keys):
+    # Sort launches by config and cut the sorted keys at every change, the
+    # configs are then numbered in the order they first appear in the scan
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, keys.shape[1]), dtype=np.int64)
+    packed = config_key(keys)
+    if packed is None:
+        order = np.lexsort(keys.T[::-1])
+        sorted_keys = keys[order]
+        change = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    else:
+        order = np.argsort(packed, kind='stable')
+        sorted_keys = packed[order]
+        change = sorted_keys[1:] != sorted_keys[:-1]
+    del sorted_keys
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1)).astype(np.int64)
+    # Both sorts are stable, the first launch of a config starts its segment
+    first_seen = order[starts]
+    rank = np.empty(len(starts), dtype=np.int64)
+    rank[np.argsort(first_seen, kind='stable')] = np.arange(len(starts))
+
+    config_ids = np.empty(len(keys), dtype=np.int64)
+    config_ids[order] = np.repeat(rank, np.diff(np.append(starts, len(keys))))
+    config_keys = np.empty((len(starts), keys.shape[1]), dtype=np.int64)
+    config_keys[rank] = keys[first_seen]
+    return config_ids, config_keys
+######################################################################
+def split_positive(values, config_ids, num_configs):
+    # Keep the positive durations only, sorted by (config, value), and
+    # return the segment bounds of every config in the sorted array
+    mask = values > 0
+    values = values[mask]
+    config_ids = config_ids[mask]
+    order = np.lexsort((values, config_ids))
+    bounds = np.searchsorted(config_ids[order], np.arange(num_configs + 1))
+    return values[order], bounds
+######################################################################
+def canonical_name_ids(database_file, name_ids):
+    # Configs are told apart by the kernel name, not by the StringIds id,
+    # so every id is mapped to the smallest id with the same name. Returns
+    # the ids found in StringIds and their canonical ids, the names are
+    # only read when two of the ids share one
+    name_ids, duplicates = report_reader.string_ids(database_file, name_ids)
+    if not duplicates:
+        return name_ids, name_ids
+    names = report_reader.read_strings(database_file, name_ids)
+    canonical_ids = {}
+    for name_id in name_ids.tolist():
+        canonical_ids.setdefault(names[name_id], name_id)
+    canonical = np.array([canonical_ids[names[x]] for x in name_ids.tolist()], dtype=np.int64)
+    return name_ids, canonical
+######################################################################
+def demangle_names(names):
+    # Itanium C++ names (_Z...) go through one c++filt call
+    names = list(names)
+    mangled = [i for i, name in enumerate(names) if name.startswith("_Z")]
+    if len(mangled) == 0:
+        return names
+    tool = shutil.which("c++filt")
+    if tool is None:
+        print("c++filt was not found, the kernel names are not demangled")
+        return names
+    result = subprocess.run([tool], input="\n".join(names[i] for i in mangled), capture_output=True, text=True)
+    demangled = result.stdout.split("\n")
+    if result.returncode != 0 or len(demangled) < len(mangled):
+        print("c++filt failed, the kernel names are not demangled")
+        return names
+    for i, name in zip(mangled, demangled):
+        names[i] = name
+    return names
+######################################################################
+def unique_labels(labels, ranks):
+    # Configs whose truncated labels are equal get their rank among the
+    # configs sorted by full name and launch dimensions appended, which does
+    # not depend on the order the scan found them in (the query plan, -j).
+    # The clashes are found with one np.unique over the labels that are
+    # printed, ranks() is only called when there is one
+    if len(labels) == 0:
+        return []
+    _, inverse, counts = np.unique(np.array(labels, dtype=str), return_inverse=True, return_counts=True)
+    clash = (counts[inverse.ravel()] > 1).tolist()
+    if not any(clash):
+        return labels
+    return [label + "#%d" % (rank + 1) if twin else label for label, rank, twin in zip(labels, ranks(), clash)]
+######################################################################
+def identity_ranks(identities):
+    rank = np.empty(len(identities), dtype=np.int64)
+    rank[sorted(range(len(identities)), key=identities.__getitem__)] = np.arange(len(identities))
+    return rank
+######################################################################
+def config_labels(config_keys, strings, indices, demangle=False):
+    # Labels of some configs only, their names are decoded here from the
+    # id-indexed StringIds array of the report (the names of every config
+    # only when two labels clash)
+    indices = np.asarray(indices, dtype=np.int64)
+    keys = config_keys[indices]
+    names = report_reader.decode_strings(strings, keys[:, 0])
+    if demangle:
+        names = demangle_names(names)
+    labels = []
+    for name, item in zip(names, keys.tolist()):
+        label_tmp = name+','+str(item[1])+','+str(item[2])+','+str(item[3])+','+str(item[4])+','+str(item[5])+','+str(item[6])
+        labels.append(label_tmp[0:min(9,len(label_tmp))])
+    return unique_labels(labels, lambda: identity_ranks(config_identities(config_keys, strings))[indices].tolist())
+######################################################################
+def join_kernel_launches(database_file, window=None, rows=None):
+    # The launches of SQL_QUERY_LAUNCHES from an Arrow/Parquet report, or
+    # of the kernel rows drawn by --sample: the projected kernel and runtime
+    # columns are joined on correlationId by searching the kernels in the
+    # sorted runtime calls. For a sample only the runtime calls of its
+    # kernels are kept, they are looked up in the correlationId index of
+    # --build-index. Without it SQLite reads the whole runtime table, the
+    # preview then takes about as long as that read
+    kernels = report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_KERNEL", KERNEL_LAUNCH_COLUMNS, ranges={"start": window} if window is not None else None,
+        rows=rows, label="sampled kernels" if rows is not None else None)
+    correlation = {"correlationId": np.unique(kernels["correlationId"])} if rows is not None else None
+    if rows is not None and not report_reader.is_arrow_report(database_file):
+        cursor = report_reader.connect(database_file).cursor()
+        if not nsys_index.has_leading_index(cursor, "CUPTI_ACTIVITY_KIND_RUNTIME", "correlationId"):
+            print("Warning: CUPTI_ACTIVITY_KIND_RUNTIME has no correlationId index, --sample reads the whole table to find the runtime calls of the sampled kernels."
+                " Run once with --build-index [--sidecar] for quick previews")
+    runtime = report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_RUNTIME", ["correlationId", "start", "end"], where=correlation,
+        label="sampled runtime calls" if rows is not None else None)
+    with profiling.stage("join"):
+        order = np.argsort(runtime["correlationId"], kind="stable")
+        runtime_ids = runtime["correlationId"][order]
+        low = np.searchsorted(runtime_ids, kernels["correlationId"], side="left")
+        matches = np.searchsorted(runtime_ids, kernels["correlationId"], side="right") - low
+        # Every kernel is repeated once per runtime call with its
+        # correlationId, as the SQL join does
+        kernel_index = np.repeat(np.arange(len(matches)), matches)
+        runtime_index = order[np.arange(len(kernel_index)) - np.repeat(np.cumsum(matches) - matches - low, matches)]
+        launches = np.column_stack([kernels[column][kernel_index] for column in KERNEL_LAUNCH_COLUMNS[:9]] + [runtime["start"][runtime_index], runtime["end"][runtime_index]]
+            + [kernels[column][kernel_index] for column in PARTITION_COLUMNS + ["contextId"]]).astype(np.int64)
+        profiling.add_rows(len(launches))
+    # The unknown names are dropped by kernel_columns_from_launches, as the
+    # SQL scan does by joining StringIds
+    return launches
+######################################################################
+def extract_kernel_columns(database_file, window=None, rows=None):
+    if report_reader.is_arrow_report(database_file) or rows is not None:
+        return kernel_columns_from_launches(database_file, join_kernel_launches(database_file, window, rows))
+    conn = report_reader.connect(database_file)
     cursor = conn.cursor()
-    ############################################################
-    sql_query_kernel_list = """ 
-    SELECT DISTINCT
-        StringIds.value,
-        cuda_gpu.gridX,
-        cuda_gpu.gridY,
-        cuda_gpu.gridZ,
-        cuda_gpu.blockX,
-        cuda_gpu.blockY,
-        cuda_gpu.blockZ
-    FROM StringIds 
-    JOIN CUPTI_ACTIVITY_KIND_KERNEL AS cuda_gpu ON cuda_gpu.shortName = StringIds.id
-    JOIN CUPTI_ACTIVITY_KIND_RUNTIME ON CUPTI_ACTIVITY_KIND_RUNTIME.correlationId = cuda_gpu.correlationId
-    """
-    ############################################################
-    sql_query_ket = """
-    SELECT KERNEL.end - KERNEL.start AS klo
-    FROM CUPTI_ACTIVITY_KIND_RUNTIME AS RUNTIME
-    JOIN CUPTI_ACTIVITY_KIND_KERNEL AS KERNEL
-    ON RUNTIME.correlationId = KERNEL.correlationId
-    JOIN StringIds AS StringIds
-    ON KERNEL.shortName = StringIds.id
-    WHERE StringIds.value = ?
-    AND KERNEL.gridX = ?
-    AND KERNEL.gridY = ?
-    AND KERNEL.gridZ = ?
-    AND KERNEL.blockX = ?
-    AND KERNEL.blockY = ?
-    AND KERNEL.blockZ = ?
-    """
-    ############################################################
-    sql_query_klo = """ 
-    SELECT RUNTIME.end - RUNTIME.start AS klo
-    FROM CUPTI_ACTIVITY_KIND_RUNTIME AS RUNTIME
-    JOIN CUPTI_ACTIVITY_KIND_KERNEL AS KERNEL
-    ON RUNTIME.correlationId = KERNEL.correlationId
-    JOIN StringIds AS StringIds
-    ON KERNEL.shortName = StringIds.id
-    WHERE StringIds.value = ?
-    AND KERNEL.gridX = ?
-    AND KERNEL.gridY = ?
-    AND KERNEL.gridZ = ?
-    AND KERNEL.blockX = ?
-    AND KERNEL.blockY = ?
-    AND KERNEL.blockZ = ?
-    """
-    ############################################################
-    sql_query_slack = """ 
-    SELECT KERNEL.start - RUNTIME.end AS time_difference
-    FROM CUPTI_ACTIVITY_KIND_RUNTIME AS RUNTIME
-    JOIN CUPTI_ACTIVITY_KIND_KERNEL AS KERNEL
-    ON RUNTIME.correlationId = KERNEL.correlationId
-    JOIN StringIds AS StringIds
-    ON KERNEL.shortName = StringIds.id
-    WHERE StringIds.value = ?
-    AND KERNEL.gridX = ?
-    AND KERNEL.gridY = ?
-    AND KERNEL.gridZ = ?
-    AND KERNEL.blockX = ?
-    AND KERNEL.blockY = ?
-    AND KERNEL.blockZ = ?
-    """
+    progress.phase("kernel scan", kernel_rows(database_file, window))
+    launches = fetch_kernel_launches(cursor, window=window)
+    progress.end_phase()
+    conn.close()
+    return kernel_columns_from_launches(database_file, launches)
+######################################################################
+def kernel_rows(database_file, window=None):
+    # The rows the launch scan returns about, for the progress; unknown
+    # inside a window
+    if window is not None:
+        return None
+    low, high = report_reader.row_range(database_file, KERNEL_TABLES[0])
+    return high - low + 1 if low is not None else 0
+######################################################################
+def kernel_rowid_ranges(database_file, num_ranges):
+    conn = report_reader.connect(database_file)
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(rowid), MAX(rowid) FROM CUPTI_ACTIVITY_KIND_KERNEL")
+    low, high = cursor.fetchone()
+    conn.close()
+    if low is None:
+        return []
+    bounds = np.linspace(low, high + 1, num_ranges + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i + 1]) - 1) for i in range(num_ranges) if bounds[i + 1] > bounds[i]]
+######################################################################
+def fetch_launch_range(database_file, rowid_range, window=None):
+    # Worker of parallel_kernel_columns, returns the raw launches of its
+    # rows so the parent can still compute the exact medians
+    conn = report_reader.connect(database_file)
+    cursor = conn.cursor()
+    launches = fetch_kernel_launches(cursor, rowid_range, window)
+    conn.close()
+    return launches
+######################################################################
+def parallel_kernel_columns(database_file, jobs, window=None):
+    # Disjoint rowid ranges are scanned by the workers and concatenated in
+    # rowid order, which is the order the serial scan returns them in
+    ranges = kernel_rowid_ranges(database_file, jobs * 4)
+    conn = report_reader.connect(database_file)
+    nsys_index.report_query_plan(conn.cursor(), "kernel launches per worker", *launch_query((0, 0), window))
+    conn.close()
+    results = {}
+    progress.phase("kernel scan", kernel_rows(database_file))
+    scan_ranges(ranges, jobs, functools.partial(fetch_launch_range, database_file, window=window), results.__setitem__)
+    progress.end_phase()
+    launches = np.concatenate([np.empty((0, NUM_LAUNCH_COLUMNS), dtype=np.int64)] + [results[rowid_range] for rowid_range in ranges])
+    return kernel_columns_from_launches(database_file, launches)
+######################################################################
+def scan_ranges(ranges, jobs, scan, finished):
+    # Calls finished(range, scan(range)) as the ranges are scanned, here or
+    # in jobs worker processes. The progress of the workers is reported by
+    # range, and an interrupt cancels the ranges they have not started
+    if jobs <= 1:
+        for rowid_range in ranges:
+            finished(rowid_range, scan(rowid_range))
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = {executor.submit(scan, rowid_range): rowid_range for rowid_range in ranges}
+        for future in concurrent.futures.as_completed(futures):
+            rowid_range = futures[future]
+            finished(rowid_range, future.result())
+            progress.advance(rowid_range[1] - rowid_range[0] + 1)
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+######################################################################
+def checkpoint_ranges(database_file, jobs):
+    # Ranges of about CHECKPOINT_RANGE_ROWS kernel rows, at least four per
+    # worker as in parallel_kernel_columns
+    num_rows = kernel_rows(database_file)
+    return kernel_rowid_ranges(database_file, max(-(-num_rows // CHECKPOINT_RANGE_ROWS), jobs * 4, 1))
+######################################################################
+def checkpointed_kernel_columns(database_file, run_checkpoint, jobs=1, window=None):
+    # The scan of parallel_kernel_columns in ranges of checkpoint_ranges,
+    # every range is saved to the checkpoint once scanned, and a resumed
+    # run loads the ranges it finished before instead of scanning them
+    ranges = checkpoint_ranges(database_file, jobs)
+    conn = report_reader.connect(database_file)
+    nsys_index.report_query_plan(conn.cursor(), "kernel launches per range", *launch_query((0, 0), window))
+    conn.close()
+    names = {rowid_range: "launches.%d-%d" % rowid_range for rowid_range in ranges}
+    results = {rowid_range: checkpoint.load_part(run_checkpoint, name) for rowid_range, name in names.items() if checkpoint.has_part(run_checkpoint, name)}
+    def finished(rowid_range, launches):
+        checkpoint.save_part(run_checkpoint, names[rowid_range], launches)
+        results[rowid_range] = launches
+    done = sum(high - low + 1 for low, high in results)
+    progress.phase("kernel scan", kernel_rows(database_file), done=done)
+    scan_ranges([rowid_range for rowid_range in ranges if rowid_range not in results], jobs, functools.partial(fetch_launch_range, database_file, window=window), finished)
+    progress.end_phase()
+    launches = np.concatenate([np.empty((0, NUM_LAUNCH_COLUMNS), dtype=np.int64)] + [results[rowid_range] for rowid_range in ranges])
+    return kernel_columns_from_launches(database_file, launches)
+######################################################################
+def canonical_launches(launches, ids, name_ids, canonical):
+    # Drops the launches of unknown names (ids holds the distinct ids of
+    # the launches) and maps the others to the canonical name ids, nothing
+    # is copied when there is nothing to do
+    if len(name_ids) < len(ids):
+        launches = launches[np.isin(launches[:, 0], name_ids)]
+    if not np.array_equal(name_ids, canonical):
+        launches[:, 0] = canonical[np.searchsorted(name_ids, launches[:, 0])]
+    return launches
+######################################################################
+def launch_columns(launches):
+    # The per-launch columns of the cache from the columns of the scan
+    return {column: launches[:, 7 + i].astype(report_cache.COLUMN_TYPES.get(column, np.int64)) for i, column in enumerate(LAUNCH_COLUMNS)}
+######################################################################
+def kernel_columns_from_launches(database_file, launches):
+    # Only the integer ids of the names are kept, the names themselves are
+    # decoded for the labels that are printed
+    with profiling.stage("grouping"):
+        ids = np.unique(launches[:, 0])
+        name_ids, canonical = canonical_name_ids(database_file, ids)
+        launches = canonical_launches(launches, ids, name_ids, canonical)
+        config_ids, config_keys = group_kernel_configs(launches[:, 0:7])
+        profiling.add_rows(len(launches))
+    return dict(config_ids=config_ids, config_keys=config_keys, name_ids=name_ids, **launch_columns(launches))
+######################################################################
+def new_launch_queries(old_watermarks, watermarks):
+    kernel_low, kernel_high = old_watermarks[KERNEL_TABLES[0]]["rowid"], watermarks[KERNEL_TABLES[0]]["rowid"]
+    runtime_low, runtime_high = old_watermarks[KERNEL_TABLES[1]]["rowid"], watermarks[KERNEL_TABLES[1]]["rowid"]
+    return [(SQL_QUERY_LAUNCHES + SQL_NEW_KERNELS, (kernel_low, kernel_high, runtime_high)),
+            (SQL_QUERY_LAUNCHES + SQL_NEW_RUNTIME, (kernel_low, runtime_low, runtime_high))]
+######################################################################
+def extend_kernel_columns(database_file, columns, old_watermarks, watermarks):
+    # Only the new launches are grouped, against the configs of the cache,
+    # and new configs are numbered after the old ones as in a full scan
+    conn = report_reader.connect(database_file)
+    cursor = conn.cursor()
+    launches = np.concatenate([report_reader.fetch_int_columns(cursor, query, NUM_LAUNCH_COLUMNS, params=params) for query, params in new_launch_queries(old_watermarks, watermarks)])
+    conn.close()
+
+    with profiling.stage("grouping"):
+        ids = np.unique(np.concatenate((columns["name_ids"], launches[:, 0])))
+        name_ids, canonical = canonical_name_ids(database_file, ids)
+        launches = canonical_launches(launches, ids, name_ids, canonical)
+        new_ids, new_keys = group_kernel_configs(launches[:, 0:7])
+        config_index = {key: i for i, key in enumerate(map(tuple, columns["config_keys"].tolist()))}
+        mapping = np.array([config_index.setdefault(key, len(config_index)) for key in map(tuple, new_keys.tolist())], dtype=np.int64)
+        profiling.add_rows(len(launches))
+    new_columns = launch_columns(launches)
+    return dict({
+        "config_ids": np.concatenate((columns["config_ids"], mapping[new_ids])),
+        "config_keys": np.array(list(config_index), dtype=np.int64).reshape(-1, 7),
+        "name_ids": name_ids,
+    }, **{column: np.concatenate((columns[column], new_columns[column])) for column in LAUNCH_COLUMNS})
+######################################################################
+def window_columns(columns, window):
+    # Cuts cached columns to the launches starting in the window, the
+    # configs are grouped again so the ones without launches disappear
+    mask = time_window.window_mask(columns["kernel_start"], window)
+    keys = np.asarray(columns["config_keys"])[np.asarray(columns["config_ids"])[mask]].reshape(-1, 7)
+    # The cached name ids are canonical already
+    with profiling.stage("grouping"):
+        config_ids, config_keys = group_kernel_configs(keys)
+        profiling.add_rows(len(keys))
+    return dict(config_ids=config_ids, config_keys=config_keys, **{column: np.asarray(columns[column])[mask] for column in LAUNCH_COLUMNS})
+######################################################################
+def dominance_scores(config_ids, durations, num_configs, rank_by):
+    # One vectorised pass over the positive durations: the launches, the
+    # summed duration or the sketched median duration times the launches
+    positive = durations > 0
+    config_ids = config_ids[positive]
+    durations = durations[positive]
+    if rank_by == "count":
+        return np.bincount(config_ids, minlength=num_configs).astype(np.float64)
+    if rank_by == "total":
+        return np.bincount(config_ids, weights=durations, minlength=num_configs)
+    sketch = quantile_sketch.new_sketch(RANK_SKETCH_ERROR)
+    quantile_sketch.update_sketch(sketch, config_ids, durations / 1000)
+    return sketch_dominance(sketch, num_configs, rank_by)
+######################################################################
+def sketch_dominance(sketch, num_configs, rank_by):
+    # The same estimates read from the ket sketch of the configs
+    counts = quantile_sketch.group_counts(sketch, num_configs)
+    if rank_by == "count":
+        return counts.astype(np.float64)
+    if rank_by == "total":
+        return np.bincount(sketch["keys"] >> quantile_sketch.BIN_BITS, weights=quantile_sketch.bin_values(sketch) * sketch["counts"], minlength=num_configs)
+    return counts * quantile_sketch.group_medians(sketch, num_configs)
+######################################################################
+def top_configs(scores, top):
+    # Indices of the top configs by score, in config order
+    return np.sort(np.argsort(-scores, kind="stable")[:top])
+######################################################################
+def top_columns(columns, top, rank_by):
+    # The launches of the top configs only, renumbered in config order, so
+    # that column_statistics sorts and filters nothing else
+    config_ids = np.asarray(columns["config_ids"])
+    config_keys = np.asarray(columns["config_keys"])
+    num_configs = len(config_keys)
+    if top >= num_configs:
+        return columns
+    with profiling.stage("ranking"):
+        scores = dominance_scores(config_ids, columns["kernel_end"] - columns["kernel_start"], num_configs, rank_by)
+        configs = top_configs(scores, top)
+        mapping = np.full(num_configs, -1, dtype=np.int64)
+        mapping[configs] = np.arange(len(configs))
+        config_ids = mapping[config_ids]
+        mask = config_ids >= 0
+        profiling.add_rows(len(config_ids))
+    return dict(config_ids=config_ids[mask], config_keys=config_keys[configs], **{column: np.asarray(columns[column])[mask] for column in LAUNCH_COLUMNS})
+######################################################################
+def top_sketch_configs(num_configs, sketches, top, rank_by):
+    # The top configs by their ket sketch; the sketches are remapped so the
+    # other configs share group `top`, which sketch_statistics never reads
+    if top is None or top >= num_configs:
+        return np.arange(num_configs), sketches
+    with profiling.stage("ranking"):
+        configs = top_configs(sketch_dominance(sketches[0], num_configs, rank_by), top)
+        mapping = np.full(num_configs, top, dtype=np.int64)
+        mapping[configs] = np.arange(top)
+        for sketch in sketches:
+            quantile_sketch.remap_groups(sketch, mapping)
+    return configs, sketches
+######################################################################
+def partition_keys(columns, partition):
+    # Dense partition id of every launch, and the partition keys sorted
+    keys = np.column_stack([np.asarray(columns[column], dtype=np.int64) for column in partition])
+    partitions, _, partition_ids = unique_configs(keys)
+    return partition_ids, partitions
+######################################################################
+def breakdown_statistics(columns, partition, run_checkpoint=None):
+    # column_statistics per partition over all the kernels, and per config
+    # and partition, with the partition as one more group key of the same
+    # launch columns rather than another scan of the report
+    config_ids = np.asarray(columns["config_ids"])
+    with profiling.stage("partitions"):
+        partition_ids, partitions = partition_keys(columns, partition)
+        groups, group_ids = np.unique(config_ids * len(partitions) + partition_ids, return_inverse=True)
+        group_ids = group_ids.ravel()
+        group_keys = np.column_stack((groups // max(len(partitions), 1), groups % max(len(partitions), 1)))
+        profiling.add_rows(len(config_ids))
+    launches = {column: columns[column] for column in LAUNCH_COLUMNS[:4]}
+    return {
+        "partition": partition,
+        "partitions": column_statistics(dict(launches, config_ids=partition_ids, config_keys=partitions), run_checkpoint, "partition statistics"),
+        "partition_launches": np.bincount(partition_ids, minlength=len(partitions)),
+        "kernels": column_statistics(dict(launches, config_ids=group_ids, config_keys=group_keys), run_checkpoint, "partition kernel statistics"),
+        "kernel_launches": np.bincount(group_ids, minlength=len(groups)),
+    }
+######################################################################
+def kernel_statistics(database_file, columns, top=None, rank_by="total", breakdown=None, run_checkpoint=None):
+    # Returns the label function of the configs (see config_labels) first,
+    # and the breakdown_statistics of the partition columns in breakdown
+    # (None without) last. With top only the top configs by the rank_by
+    # estimate are analysed. The columns themselves are not modified
+    if top is not None:
+        columns = top_columns(columns, top, rank_by)
+    partitions = breakdown_statistics(columns, breakdown, run_checkpoint) if breakdown else None
+    config_keys, *results = column_statistics(columns, run_checkpoint)
+    return (functools.partial(config_labels, config_keys, report_reader.string_table(database_file)), *results, partitions)
+######################################################################
+def exact_kernel_statistics(database_file, use_cache=True, jobs=1, window=None, top=None, rank_by="total", breakdown=None, run_checkpoint=None):
+    # kernel_statistics of the launch columns of the report, from the
+    # column cache when there is one. With a run_checkpoint the scan and
+    # the statistics are saved to it as they go, and resumed from it
+    statistics = functools.partial(kernel_statistics, database_file, top=top, rank_by=rank_by, breakdown=breakdown, run_checkpoint=run_checkpoint)
+    if run_checkpoint is not None and not report_reader.is_arrow_report(database_file):
+        extract = functools.partial(checkpointed_kernel_columns, run_checkpoint=run_checkpoint, jobs=jobs, window=window)
+    elif jobs > 1:
+        extract = functools.partial(parallel_kernel_columns, jobs=jobs, window=window)
+    else:
+        extract = functools.partial(extract_kernel_columns, window=window)
+    if window is not None:
+        # A slice is cut from the cached columns when they exist, otherwise
+        # only the slice is read from the report and it is not cached
+        columns = report_cache.load_columns(database_file, "kernel") if use_cache else None
+        if columns is not None:
+            return statistics(window_columns(columns, window))
+        return statistics(extract(database_file))
+    # Passed on directly so column_statistics can free the columns early
+    return statistics(report_cache.cached_columns(database_file, "kernel", extract, use_cache, extend_kernel_columns, KERNEL_TABLES))
+######################################################################
+def column_statistics(columns, run_checkpoint=None, name="kernel statistics"):
 ################################################################################
-    labels = []
-    ket_tmp = []
-    klo_tmp = []
-    slack_tmp = []
     ket = []
     klo = []
     slack = []
     ket_list = []
     klo_list = []
     slack_list = []
-    kernels_list = []
     dominant_list = []
 ################################################################################
-    cursor.execute(sql_query_kernel_list)
-    results = cursor.fetchall()
-    for item in results:
-        kernels_list.append(item)
-        label_tmp = item[0]+','+str(item[1])+','+str(item[2])+','+str(item[3])+','+str(item[4])+','+str(item[5])+','+str(item[6])
-        labels.append(label_tmp[0:min(9,len(label_tmp))])
+    config_ids = columns["config_ids"]
+    config_keys = np.asarray(columns["config_keys"])
+    num_configs = len(config_keys)
+
+    # The configs of a resumed run that were done already are skipped, the
+    # results are saved under name every checkpoint.CHECKPOINT_SECONDS and
+    # when the run is interrupted
+    results = {"ket": ket_list, "klo": klo_list, "slack": slack_list, "dominant": dominant_list}
+    if run_checkpoint is not None:
+        for column, values in checkpoint.load_results(run_checkpoint, name, config_keys).items():
+            results[column].extend(values.tolist())
+
+    with profiling.stage("aggregation"):
+        ket_values, ket_bounds = split_positive(columns["kernel_end"] - columns["kernel_start"], config_ids, num_configs)
+        klo_values, klo_bounds = split_positive(columns["runtime_end"] - columns["runtime_start"], config_ids, num_configs)
+        slack_values, slack_bounds = split_positive(columns["kernel_start"] - columns["runtime_end"], config_ids, num_configs)
+        profiling.add_rows(len(config_ids))
+    del columns, config_ids
 ################################################################################
-    for kernel_name in kernels_list:
-        cursor.execute(sql_query_ket, (kernel_name[0],kernel_name[1],kernel_name[2],kernel_name[3],kernel_name[4],kernel_name[5],kernel_name[6]))
-        ket_tmp = cursor.fetchall()
-        ket = []
-        for ind in ket_tmp:
-            if (ind[0] > 0):
-                ket.append(ind[0] / 1000)
-        if (len(ket) == 0):
-            ket.append(0)
+    progress.phase(name, num_configs, "configs", done=len(ket_list))
+    try:
+        for config in range(len(ket_list), num_configs):
+            ket = ket_values[ket_bounds[config]:ket_bounds[config+1]] / 1000
+            if (len(ket) == 0):
+                ket = np.zeros(1)
 
-        ket_list.append(math.log10(calculate_median(ket)))
-        dominant_list.append(len(ket) * calculate_median(ket))
-        #################################################
-        cursor.execute(sql_query_klo, (kernel_name[0],kernel_name[1],kernel_name[2],kernel_name[3],kernel_name[4],kernel_name[5],kernel_name[6]))
-        klo_tmp = cursor.fetchall()
-        klo = []
-        for ind in klo_tmp:
-            if (ind[0] > 0): 
-                klo.append(ind[0] / 1000)
-        if (len(klo) == 0): 
-            klo.append(0)
+            ket_list.append(math.log10(calculate_median(ket)))
+            dominant_list.append(len(ket) * calculate_median(ket))
+            #################################################
+            klo = klo_values[klo_bounds[config]:klo_bounds[config+1]] / 1000
+            if (len(klo) == 0): 
+                klo = np.zeros(1)
 
-        klo_list.append(math.log10(calculate_median(remove_outliers(klo))))
-        #################################################
-        cursor.execute(sql_query_slack, (kernel_name[0],kernel_name[1],kernel_name[2],kernel_name[3],kernel_name[4],kernel_name[5],kernel_name[6]))
-        slack_tmp = cursor.fetchall()
-        slack = []
-        for ind in slack_tmp:
-            if (ind[0] > 0):
-                slack.append(ind[0] / 1000)
-        if (len(slack) == 0):
-            slack.append(0)
+            with profiling.stage("outlier filtering"):
+                klo = remove_outliers(klo)
+            klo_list.append(math.log10(calculate_median(klo)))
+            #################################################
+            slack = slack_values[slack_bounds[config]:slack_bounds[config+1]] / 1000
+            if (len(slack) == 0):
+                slack = np.zeros(1)
+
+            if len(slack) == 1 and slack[0] == 0:
+                slack_list.append(0)
+            else:
+                with profiling.stage("outlier filtering"):
+                    slack = remove_outliers(slack)
+                slack_list.append(math.log10(calculate_median(slack)))
+            progress.advance()
+            if run_checkpoint is not None:
+                checkpoint.save_results(run_checkpoint, name, config_keys, results)
+    except KeyboardInterrupt:
+        if run_checkpoint is not None:
+            checkpoint.save_results(run_checkpoint, name, config_keys, results, force=True)
+        raise
+    progress.end_phase()
+
+    return config_keys, ket_list, klo_list, slack_list, dominant_list
+######################################################################
+def median_interval(values, z=report_reader.SAMPLE_Z):
+    # Distribution-free confidence interval of the median of the sorted
+    # values, between the order statistics around n/2 given by the normal
+    # approximation of the binomial, in log10 like the medians. NaN, i.e.
+    # no interval, for fewer than MIN_INTERVAL_VALUES values
+    n = len(values)
+    if n < MIN_INTERVAL_VALUES:
+        return math.nan, math.nan
+    low = max(int(math.floor(n / 2 - z * math.sqrt(n) / 2)), 1)
+    high = min(int(math.ceil(1 + n / 2 + z * math.sqrt(n) / 2)), n)
+    return math.log10(values[low - 1]), math.log10(values[high - 1])
+######################################################################
+def sample_intervals(columns, fraction):
+    # Confidence intervals of the log10 medians of column_statistics, from
+    # the same positive and IQR filtered values of the sampled launches, and
+    # of the dominance scaled to all the launches
+    config_ids = columns["config_ids"]
+    num_configs = len(columns["config_keys"])
+    intervals = {metric: np.zeros((num_configs, 2)) for metric in SAMPLE_METRICS}
+    with profiling.stage("intervals"):
+        ket_values, ket_bounds = split_positive(columns["kernel_end"] - columns["kernel_start"], config_ids, num_configs)
+        klo_values, klo_bounds = split_positive(columns["runtime_end"] - columns["runtime_start"], config_ids, num_configs)
+        slack_values, slack_bounds = split_positive(columns["kernel_start"] - columns["runtime_end"], config_ids, num_configs)
+        for config in range(num_configs):
+            ket = ket_values[ket_bounds[config]:ket_bounds[config+1]] / 1000
+            klo = klo_values[klo_bounds[config]:klo_bounds[config+1]] / 1000
+            slack = slack_values[slack_bounds[config]:slack_bounds[config+1]] / 1000
+            intervals["ket"][config] = median_interval(ket)
+            intervals["klo"][config] = median_interval(remove_outliers(klo) if len(klo) else klo)
+            intervals["slack"][config] = median_interval(remove_outliers(slack) if len(slack) else slack)
+            _, count_low, count_high = report_reader.count_interval(len(ket), fraction)
+            intervals["dominance"][config] = (count_low * 10 ** intervals["ket"][config, 0], count_high * 10 ** intervals["ket"][config, 1])
+        profiling.add_rows(len(config_ids))
+    return dict(intervals, fraction=fraction)
+######################################################################
+def select_intervals(intervals, indices):
+    if intervals is None:
+        return None
+    return dict(intervals, **{metric: intervals[metric][list(indices)] for metric in SAMPLE_METRICS})
+######################################################################
+def sample_kernel_statistics(database_file, fraction, seed=None, window=None, top=None, rank_by="total"):
+    # The statistics of the launches of random blocks of kernel rows (see
+    # report_reader.sample_rows), with the dominance scaled by the fraction
+    # of the rows drawn and the sample_intervals of every config last
+    rows, fraction = report_reader.sample_rows(database_file, "CUPTI_ACTIVITY_KIND_KERNEL", fraction, seed)
+    print("Sampling %.3g%% of the kernel rows (%d rows)" % (100 * fraction, len(rows)))
+    columns = extract_kernel_columns(database_file, window, rows)
+    if top is not None:
+        columns = top_columns(columns, top, rank_by)
+    intervals = sample_intervals(columns, fraction)
+    config_keys, ket_list, klo_list, slack_list, dominant_list = column_statistics(columns)
+    return (functools.partial(config_labels, config_keys, report_reader.string_table(database_file)), ket_list, klo_list, slack_list,
+        [dominance / fraction for dominance in dominant_list], intervals)
+######################################################################
+def interval_text(bounds, low_format, high_format):
+    if np.isnan(bounds).any():
+        return "%*s" % (len(low_format % 0) + 4 + len(high_format % 0), "-")
+    return (low_format + " .. " + high_format) % tuple(bounds)
+######################################################################
+def print_sample(labels, ket_list, dominant_list, intervals):
+    # The dominant configs of the sample with their confidence intervals,
+    # "-" for the configs with too few sampled launches for one
+    print("%-40s %12s %25s %16s %35s" % ("kernel", "ket (us)", "95% CI", "dominance (us)", "95% CI"))
+    for i, label in enumerate(labels):
+        print("%-40s %12.2f %s %16.1f %s" % (label[:40], 10 ** ket_list[i], interval_text(10 ** intervals["ket"][i], "%12.2f", "%9.2f"),
+            dominant_list[i], interval_text(intervals["dominance"][i], "%16.1f", "%15.1f")))
+######################################################################
+def sketch_kernel_configs(database_file, relative_error, fetch_size=1000000, rowid_range=None, queries=None, window=None):
+    # Streams the launches once with fetchmany into one quantile sketch per
+    # metric, the memory per config only depends on the spread of its values
+    ket_sketch = quantile_sketch.new_sketch(relative_error)
+    klo_sketch = quantile_sketch.new_sketch(relative_error)
+    slack_sketch = quantile_sketch.new_sketch(relative_error)
+    config_index = {}
+
+    if rowid_range is not None:
+        conn = report_reader.connect(database_file)
+        queries = [launch_query(rowid_range, window)]
+    else:
+        conn = report_reader.connect(database_file)
+        if queries is None:
+            queries = [launch_query(None, window)]
+            nsys_index.report_query_plan(conn.cursor(), "kernel launches", *queries[0])
+            progress.phase("kernel scan", kernel_rows(database_file, window))
+    cursor = conn.cursor()
+    for query, params in queries:
+        with profiling.stage("query"):
+            cursor.execute(query, params)
+        while True:
+            with profiling.stage("fetch"):
+                rows = cursor.fetchmany(fetch_size)
+                profiling.add_rows(len(rows))
+                progress.advance(len(rows))
+                if not rows:
+                    break
+                batch = np.array(rows, dtype=np.int64)
+            with profiling.stage("sketch update"):
+                keys, first, inverse = unique_configs(batch[:, 0:7])
+                # Configs are numbered in the order they first appear in the scan
+                for j in np.argsort(first):
+                    config_index.setdefault(tuple(keys[j].tolist()), len(config_index))
+                config_ids = np.array([config_index[tuple(key)] for key in keys.tolist()], dtype=np.int64)[inverse]
+
+                for sketch, values in ((ket_sketch, batch[:, 8] - batch[:, 7]), (klo_sketch, batch[:, 10] - batch[:, 9]), (slack_sketch, batch[:, 7] - batch[:, 10])):
+                    mask = values > 0
+                    quantile_sketch.update_sketch(sketch, config_ids[mask], values[mask] / 1000)
+
+    conn.close()
+    progress.end_phase()
+    raw_keys = np.array(list(config_index), dtype=np.int64).reshape(-1, 7)
 
-        if len(slack) == 1 and slack[0] == 0:
+    # Merge the configs whose kernel names only differ in their StringIds id
+    name_ids, canonical = canonical_name_ids(database_file, raw_keys[:, 0])
+    raw_keys[:, 0] = canonical[np.searchsorted(name_ids, raw_keys[:, 0])]
+    config_keys, first, inverse = unique_configs(raw_keys)
+    order = np.argsort(first)
+    config_keys = config_keys[order]
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    mapping = rank[inverse]
+    for sketch in (ket_sketch, klo_sketch, slack_sketch):
+        quantile_sketch.remap_groups(sketch, mapping)
+
+    # The names stay undecoded in the StringIds array of the report
+    return config_keys, report_reader.string_table(database_file), ket_sketch, klo_sketch, slack_sketch
+######################################################################
+def sketch_statistics(num_configs, ket_sketch, klo_sketch, slack_sketch):
+    ket_list = []
+    klo_list = []
+    slack_list = []
+    dominant_list = []
+    progress.phase("kernel statistics", num_configs, "configs")
+    for config in range(num_configs):
+        progress.advance()
+        values, counts = quantile_sketch.group_bins(ket_sketch, config)
+        if (len(values) == 0):
+            values, counts = np.zeros(1), np.ones(1, dtype=np.int64)
+        median = quantile_sketch.quantile(values, counts, 0.5)
+        ket_list.append(math.log10(median))
+        dominant_list.append(counts.sum() * median)
+        #################################################
+        values, counts = quantile_sketch.group_bins(klo_sketch, config)
+        if (len(values) == 0):
+            values, counts = np.zeros(1), np.ones(1, dtype=np.int64)
+        klo_list.append(math.log10(quantile_sketch.quantile(*quantile_sketch.iqr_filtered(values, counts), 0.5)))
+        #################################################
+        values, counts = quantile_sketch.group_bins(slack_sketch, config)
+        if (len(values) == 0):
             slack_list.append(0)
         else:
-            slack_list.append(math.log10(calculate_median(remove_outliers(slack))))
+            slack_list.append(math.log10(quantile_sketch.quantile(*quantile_sketch.iqr_filtered(values, counts), 0.5)))
+    progress.end_phase()
+
+    return ket_list, klo_list, slack_list, dominant_list
+######################################################################
+def sketch_state_columns(identities, sketches, relative_error):
+    # The merged sketches of an incremental run as cache columns
+    columns = {
+        "config_names": np.array([identity[0] for identity in identities], dtype=str),
+        "config_dims": np.array([identity[1:] for identity in identities], dtype=np.int64).reshape(-1, 6),
+        "relative_error": np.array(relative_error),
+    }
+    for metric, sketch in zip(("ket", "klo", "slack"), sketches):
+        columns[metric + "_keys"] = sketch["keys"]
+        columns[metric + "_counts"] = sketch["counts"]
+    return columns
+######################################################################
+def sketch_state(columns):
+    identities = [(name,) + tuple(dims) for name, dims in zip(columns["config_names"].tolist(), columns["config_dims"].tolist())]
+    sketches = []
+    for metric in ("ket", "klo", "slack"):
+        sketch = quantile_sketch.new_sketch(float(columns["relative_error"]))
+        sketch["keys"] = np.array(columns[metric + "_keys"])
+        sketch["counts"] = np.array(columns[metric + "_counts"])
+        sketches.append(sketch)
+    return identities, sketches
+######################################################################
+def extract_sketch_state(database_file, relative_error):
+    identities, sketches = merge_sketch_configs([sketch_launch_range(database_file, relative_error, None)], relative_error)
+    return sketch_state_columns(identities, sketches, relative_error)
+######################################################################
+def extend_sketch_state(database_file, columns, old_watermarks, watermarks):
+    # The new launches are sketched on their own and merged into the stored
+    # sketches by config identity, so the cost only depends on the new rows
+    relative_error = float(columns["relative_error"])
+    config_keys, strings, *sketches = sketch_kernel_configs(database_file, relative_error, queries=new_launch_queries(old_watermarks, watermarks))
+    identities, old_sketches = sketch_state(columns)
+    identities, merged = merge_sketch_configs([(identities, *old_sketches), (config_identities(config_keys, strings), *sketches)], relative_error)
+    return sketch_state_columns(identities, merged, relative_error)
+######################################################################
+def incremental_sketch_statistics(database_file, relative_error, use_cache):
+    columns = report_cache.cached_columns(database_file, "kernel_sketch_%g" % relative_error, functools.partial(extract_sketch_state, relative_error=relative_error), use_cache, extend_sketch_state, KERNEL_TABLES)
+    return sketch_state(columns)
+######################################################################
+def sketch_kernel_statistics(database_file, relative_error, jobs=1, use_cache=False, window=None, top=None, rank_by="total"):
+    # The sketches are only kept next to the report for --incremental, and
+    # only for the whole report
+    if use_cache == "incremental" and window is None:
+        identities, sketches = incremental_sketch_statistics(database_file, relative_error, use_cache)
+    elif jobs > 1:
+        identities, sketches = parallel_sketch_configs(database_file, relative_error, jobs, window)
+    else:
+        config_keys, strings, *sketches = sketch_kernel_configs(database_file, relative_error, window=window)
+        configs, sketches = top_sketch_configs(len(config_keys), sketches, top, rank_by)
+        ket_list, klo_list, slack_list, dominant_list = sketch_statistics(len(configs), *sketches)
+        return functools.partial(config_labels, config_keys[configs], strings), ket_list, klo_list, slack_list, dominant_list
+    configs, sketches = top_sketch_configs(len(identities), sketches, top, rank_by)
+    ket_list, klo_list, slack_list, dominant_list = sketch_statistics(len(configs), *sketches)
+    return functools.partial(identity_labels, [identities[i] for i in configs]), ket_list, klo_list, slack_list, dominant_list
+######################################################################
+def config_identities(config_keys, strings):
+    # Full kernel name and launch dimensions, comparable between reports
+    # and between workers, unlike the StringIds ids
+    names = report_reader.decode_strings(strings, config_keys[:, 0])
+    return [(name,) + tuple(key[1:]) for name, key in zip(names, config_keys.tolist())]
+######################################################################
+def identity_label(identity):
+    label_tmp = ','.join(str(item) for item in identity)
+    return label_tmp[0:min(9,len(label_tmp))]
+######################################################################
+def identity_labels(identities, indices, demangle=False):
+    indices = list(indices)
+    labelled = [identities[i] for i in indices]
+    if demangle:
+        labelled = [(name,) + identity[1:] for name, identity in zip(demangle_names(identity[0] for identity in labelled), labelled)]
+    return unique_labels([identity_label(identity) for identity in labelled], lambda: identity_ranks(identities)[indices].tolist())
+######################################################################
+def merge_sketch_configs(results, relative_error):
+    # results holds (identities, ket, klo, slack sketches) per report or
+    # worker, the merged configs are numbered in order of first appearance
+    config_index = {}
+    merged = [quantile_sketch.new_sketch(relative_error) for _ in range(3)]
+    for identities, *sketches in results:
+        mapping = np.array([config_index.setdefault(identity, len(config_index)) for identity in identities], dtype=np.int64)
+        for total, sketch in zip(merged, sketches):
+            quantile_sketch.remap_groups(sketch, mapping)
+            total["keys"], total["counts"] = quantile_sketch.merge_keys(np.concatenate((total["keys"], sketch["keys"])), np.concatenate((total["counts"], sketch["counts"])))
+    return list(config_index), merged
+######################################################################
+def sketch_launch_range(database_file, relative_error, rowid_range, window=None):
+    config_keys, strings, ket_sketch, klo_sketch, slack_sketch = sketch_kernel_configs(database_file, relative_error, rowid_range=rowid_range, window=window)
+    return config_identities(config_keys, strings), ket_sketch, klo_sketch, slack_sketch
+######################################################################
+def parallel_sketch_configs(database_file, relative_error, jobs, window=None):
+    ranges = kernel_rowid_ranges(database_file, jobs * 4)
+    results = {}
+    progress.phase("kernel scan", kernel_rows(database_file))
+    scan_ranges(ranges, jobs, functools.partial(sketch_launch_range, database_file, relative_error, window=window), results.__setitem__)
+    progress.end_phase()
+    return merge_sketch_configs([results[rowid_range] for rowid_range in ranges], relative_error)
+######################################################################
+def extract_metrics(database_file, use_cache=True, sketch_error=None, jobs=1, render_options=None, window=None, demangle=False, top=None, rank_by="total", breakdown=None, sample=None, seed=None, checkpoints=False, resume=False):
+    if (checkpoints or resume) and (sample is not None or sketch_error is not None):
+        print("--checkpoint and --resume apply to the exact statistics, they are ignored with --sample and --sketch")
+        checkpoints = resume = False
+    if sample is not None and (sketch_error is not None or jobs > 1 or breakdown):
+        print("--sample reads the sampled rows directly, --sketch, -j and --breakdown are ignored")
+        sketch_error, jobs, breakdown = None, 1, None
+    if report_reader.is_arrow_report(database_file) and (sketch_error is not None or jobs > 1):
+        print("--sketch and -j only apply to SQLite reports, reading the columns of", database_file, "directly")
+        sketch_error, jobs = None, 1
+    if breakdown and sketch_error is not None:
+        print("--breakdown needs the exact statistics, it is skipped with --sketch")
+    intervals = None
+    # The saved results depend on these options, the scan ranges on the
+    # report only
+    run_checkpoint = None
+    if checkpoints or resume:
+        run_checkpoint = checkpoint.open_checkpoint(database_file, {"window": window, "top": top, "rank_by": rank_by, "breakdown": breakdown}, resume)
+    with profiling.stage("statistics"):
+        if sample is not None:
+            label_configs, ket_list, klo_list, slack_list, dominant_list, intervals = sample_kernel_statistics(database_file, sample, seed, window, top, rank_by)
+            partitions = None
+        elif sketch_error is None:
+            label_configs, ket_list, klo_list, slack_list, dominant_list, partitions = exact_kernel_statistics(database_file, use_cache, jobs, window, top, rank_by, breakdown, run_checkpoint)
+        else:
+            label_configs, ket_list, klo_list, slack_list, dominant_list = sketch_kernel_statistics(database_file, sketch_error, jobs, use_cache, window, top, rank_by)
+            partitions = None
+    if run_checkpoint is not None:
+        checkpoint.remove_checkpoint(run_checkpoint)
+    if not ket_list:
+        print("No kernels in the window, nothing to report")
+        return
+    # Names are decoded for the exported table and the plotted configs only
+    options = render_options or {}
+    if options.get("table_format") is not None:
+        labels = label_configs(range(len(ket_list)), demangle)
+        table_export.export_table("metric_table", metric_table(labels, ket_list, klo_list, slack_list, dominant_list, intervals), render_options)
+    if intervals is not None:
+        indices = heapq.nlargest(NUM_SAMPLE_PRINTED, range(len(dominant_list)), key=lambda i: dominant_list[i])
+        print_sample(label_configs(indices, demangle), [ket_list[i] for i in indices], [dominant_list[i] for i in indices], select_intervals(intervals, indices))
+    if options.get("plot", True):
+        indices = dominant_indices(dominant_list)
+        plot_metrics(label_configs(indices, demangle), *[[values[i] for i in indices] for values in (ket_list, klo_list, slack_list, dominant_list)], render_options=render_options,
+            intervals=select_intervals(intervals, indices))
+    if partitions is not None:
+        report_partitions(partitions, label_configs, render_options, demangle)
+######################################################################
+def metric_table(labels, ket_list, klo_list, slack_list, dominant_list, intervals=None):
+    # Every kernel config (not only the plotted top 50; with --top the top
+    # configs of the ranking), with the same log10
+    # values as the figures and the dominance (launches * median duration).
+    # Under --sample the bounds of the confidence intervals follow
+    rows = []
+    for i in range(len(labels)):
+        rows.append({
+            "kernel": labels[i],
+            "ket_log10_us": ket_list[i],
+            "klo_log10_us": klo_list[i],
+            "slack_log10_us": slack_list[i],
+            "ratio_log10": math.log10((10 ** ket_list[i]) / (10 ** klo_list[i])),
+            "dominance_us": dominant_list[i],
+        })
+        if intervals is not None:
+            for metric, column in zip(SAMPLE_METRICS, ("ket_log10_us", "klo_log10_us", "slack_log10_us", "dominance_us")):
+                rows[-1][column + "_low"], rows[-1][column + "_high"] = [None if math.isnan(bound) else bound for bound in intervals[metric][i].tolist()]
+            rows[-1]["sample_fraction"] = intervals["fraction"]
+    return rows
+######################################################################
+def partition_label(partition, key):
+    return ' '.join("%s%d" % (column[0], value) for column, value in zip(partition, key))
+######################################################################
+def partition_rows(partitions):
+    # metric_table rows of the partitions, keyed by the partition columns
+    partition = partitions["partition"]
+    keys, *summary = partitions["partitions"]
+    rows = []
+    for key, launches, row in zip(keys.tolist(), partitions["partition_launches"].tolist(), metric_table(keys.tolist(), *summary)):
+        del row["kernel"]
+        rows.append(dict(zip(partition, key), launches=launches, **row))
+    return rows
+######################################################################
+def partition_kernel_rows(partitions, label_configs, demangle=False):
+    # The same per (partition, config), the labels of every config are
+    # decoded once
+    partition = partitions["partition"]
+    group_keys, *summary = partitions["kernels"]
+    keys = np.asarray(partitions["partitions"][0])[group_keys[:, 1]]
+    configs, inverse = np.unique(group_keys[:, 0], return_inverse=True)
+    labels = label_configs(configs, demangle)
+    rows = []
+    for key, launches, row in zip(keys.tolist(), partitions["kernel_launches"].tolist(), metric_table([labels[i] for i in inverse.ravel().tolist()], *summary)):
+        rows.append(dict(zip(partition, key), launches=launches, **row))
+    return rows
+######################################################################
+def print_partitions(partition, rows):
+    print(' '.join("%10s" % column for column in partition), "%10s %12s %12s %12s %16s" % ("launches", "ket (us)", "klo (us)", "slack (us)", "dominance (us)"))
+    for row in rows:
+        print(' '.join("%10d" % row[column] for column in partition), "%10d %12.2f %12.2f %12.2f %16.1f" % (row["launches"], 10 ** row["ket_log10_us"], 10 ** row["klo_log10_us"], 10 ** row["slack_log10_us"], row["dominance_us"]))
+######################################################################
+def report_partitions(partitions, label_configs, render_options=None, demangle=False):
+    partition = partitions["partition"]
+    rows = partition_rows(partitions)
+    print_partitions(partition, rows)
+    table_export.export_table("metric_partition_table", rows, render_options)
+    # The per-config table is only built when it is written
+    if (render_options or {}).get("table_format") is not None:
+        table_export.export_table("metric_partition_kernel_table", partition_kernel_rows(partitions, label_configs, demangle), render_options)
+    labels = [partition_label(partition, [row[column] for column in partition]) for row in rows]
+    render.render_figures([
+        ('metric_partition_ket_bar', draw_metric_bar, ([row["ket_log10_us"] for row in rows], labels, "Kernel Duration (us) - Log Base 10")),
+        ('metric_partition_klo_bar', draw_metric_bar, ([row["klo_log10_us"] for row in rows], labels, "Kernel Launch Overhead (us) - Log Base 10")),
+        ('metric_partition_slack_bar', draw_metric_bar, ([row["slack_log10_us"] for row in rows], labels, "Slack (us) - Log Base 10")),
+    ], render_options)
+######################################################################
+def draw_metric_bar(plt, values, labels, ylabel, errors=None):
+    from matplotlib.ticker import MultipleLocator
+    fig, ax = plt.subplots(1, figsize=(18, 12))
+    # errors are the (low, high) bounds of every value
+    yerr = None if errors is None else [np.asarray(values) - errors[:, 0], errors[:, 1] - np.asarray(values)]
+    ax.bar(range(1, len(values)+1), values, width=1, edgecolor='black', yerr=yerr, capsize=2)
+    x_values = np.arange(1,len(values)+1)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=90)
+    max_items_in_bin = np.max(values)
+    min_items_in_bin = np.min(values)
+    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
+    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Kernel Name")
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+######################################################################
+def dominant_indices(dominant_list, num_dominating_kernels=50):
+    if (len(dominant_list) > num_dominating_kernels):
+        return heapq.nlargest(num_dominating_kernels, range(len(dominant_list)), key=lambda i: dominant_list[i])
+    return list(range(len(dominant_list)))
+######################################################################
+def plot_metrics(labels, ket_list, klo_list, slack_list, dominant_list, prefix="metric", render_options=None, intervals=None):
 ##########################################################################
     num_dominating_kernels = 50
     if (len(ket_list) > num_dominating_kernels):
-        largest_indices = heapq.nlargest(num_dominating_kernels, range(len(dominant_list)), key=lambda i: dominant_list[i])
+        largest_indices = dominant_indices(dominant_list, num_dominating_kernels)
+        intervals = select_intervals(intervals, largest_indices)
         ket_list_bar = [ket_list[i] for i in largest_indices]
         klo_list_bar = [klo_list[i] for i in largest_indices]
         slack_list_bar = [slack_list[i] for i in largest_indices]
@@ -195,60 +1068,6 @@ def extract_metrics(database_file):
         slack_list_bar = slack_list
         labels_bar = labels
 ###########################################################################
-    fig, ax = plt.subplots(1, figsize=(18, 12))
-    ax.bar(range(1, len(ket_list_bar)+1), ket_list_bar, width=1, edgecolor='black')
-    x_values = np.arange(1,len(ket_list_bar)+1)
-    ax.xaxis.set_ticks(x_values)
-    ax.xaxis.set_ticklabels(labels_bar)
-    ax.tick_params(axis='x', rotation=90)
-    max_items_in_bin = np.max(ket_list_bar)
-    min_items_in_bin = np.min(ket_list_bar)
-    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
-    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-    ax.set_xlabel("Kernel Name")
-    ax.set_ylabel("Kernel Duration (us) - Log Base 10")
-    fig.tight_layout()
-    fig.subplots_adjust(top=0.95)
-    fig.savefig('metric_ket_bar.pgf', bbox_inches='tight')
-    fig.savefig('metric_ket_bar.png', bbox_inches='tight')
-    ########################################################
-    fig, ax = plt.subplots(1, figsize=(18, 12))
-    ax.bar(range(1, len(klo_list_bar)+1), klo_list_bar, width=1, edgecolor='black')
-    x_values = np.arange(1,len(klo_list_bar)+1)
-    ax.xaxis.set_ticks(x_values)
-    ax.xaxis.set_ticklabels(labels_bar)
-    ax.tick_params(axis='x', rotation=90)
-    max_items_in_bin = np.max(klo_list_bar)
-    min_items_in_bin = np.min(klo_list_bar)
-    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
-    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-    ax.set_xlabel("Kernel Name")
-    ax.set_ylabel("Kernel Launch Overhead (us) - Log Base 10")
-    fig.tight_layout()
-    fig.subplots_adjust(top=0.95)
-    fig.savefig('metric_klo_bar.pgf', bbox_inches='tight')
-    fig.savefig('metric_klo_bar.png', bbox_inches='tight')
-    ########################################################
-    fig, ax = plt.subplots(1, figsize=(18, 12))
-    ax.bar(range(1, len(slack_list_bar)+1), slack_list_bar, width=1, edgecolor='black')
-    x_values = np.arange(1,len(slack_list_bar)+1)
-    ax.xaxis.set_ticks(x_values)
-    ax.xaxis.set_ticklabels(labels_bar)
-    ax.tick_params(axis='x', rotation=90)
-    max_items_in_bin = np.max(slack_list_bar)
-    min_items_in_bin = np.min(slack_list_bar)
-    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
-    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-    ax.set_xlabel("Kernel Name")
-    ax.set_ylabel("Slack (us) - Log Base 10")
-    fig.tight_layout()
-    fig.subplots_adjust(top=0.95)
-    fig.savefig('metric_slack_bar.pgf', bbox_inches='tight')
-    fig.savefig('metric_slack_bar.png', bbox_inches='tight')
-    ########################################################
     ratio = []
     for item in range(len(ket_list_bar)):
         ratio.append((10 ** ket_list_bar[item]) / (10 ** klo_list_bar[item]))
@@ -256,33 +1075,57 @@ def extract_metrics(database_file):
     for item in range(len(ratio)):
         ratio[item] = math.log10(ratio[item])
 
-    fig, ax = plt.subplots(1, figsize=(18, 12))
-    ax.bar(range(1, len(ratio)+1), ratio, width=1, edgecolor='black')
-    x_values = np.arange(1,len(ratio)+1)
-    ax.xaxis.set_ticks(x_values)
-    ax.xaxis.set_ticklabels(labels_bar)
-    ax.tick_params(axis='x', rotation=90)
-    max_items_in_bin = np.max(ratio)
-    min_items_in_bin = np.min(ratio)
-    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
-    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-    ax.set_xlabel("Kernel Name")
-    ax.set_ylabel("Ratio of Duration to Launch - log base 10")
-    fig.tight_layout()
-    fig.subplots_adjust(top=0.95)
-    fig.savefig('metric_ratio.pgf', bbox_inches='tight')
-    fig.savefig('metric_ratio.png', bbox_inches='tight')
+    # A sample shows its fraction and the confidence intervals of the medians
+    sample = "" if intervals is None else " - %.3g%% sample, 95%% CI" % (100 * intervals["fraction"])
+    errors = intervals or {}
+    render.render_figures([
+        (prefix + '_ket_bar', draw_metric_bar, (ket_list_bar, labels_bar, "Kernel Duration (us) - Log Base 10" + sample, errors.get("ket"))),
+        (prefix + '_klo_bar', draw_metric_bar, (klo_list_bar, labels_bar, "Kernel Launch Overhead (us) - Log Base 10" + sample, errors.get("klo"))),
+        (prefix + '_slack_bar', draw_metric_bar, (slack_list_bar, labels_bar, "Slack (us) - Log Base 10" + sample, errors.get("slack"))),
+        (prefix + '_ratio', draw_metric_bar, (ratio, labels_bar, "Ratio of Duration to Launch - log base 10" + sample)),
+    ], render_options)
 ###########################################################################
 if __name__ == "__main__":
-    # Check if the correct number of arguments are provided
-    if len(sys.argv) != 2:
-        print("Usage: python program_name.py database_file.db")
-        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    report_cache.add_cache_arguments(parser)
+    parser.add_argument("--sketch", type=quantile_sketch.parse_relative_error, metavar="ERROR", help="estimate medians and IQR filtering with quantile sketches of this relative error (e.g. 0.01) in constant memory per kernel")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="scan disjoint row ranges of the kernel table in this many worker processes")
+    parser.add_argument("--top", type=int, metavar="K", help="rank the configs with a cheap pass first and only compute the statistics of the top K")
+    parser.add_argument("--rank-by", choices=RANK_METRICS, default="total", help="ranking of --top: summed duration (default), launch count, or sketched median duration times launches")
+    parser.add_argument("--breakdown", action="store_true", help="also compute every metric per deviceId and streamId, from the same launch columns")
+    parser.add_argument("--by-context", action="store_true", help="with --breakdown, also partition by contextId")
+    parser.add_argument("--demangle", action="store_true", help="demangle the C++ kernel names of the labels with c++filt")
+    report_reader.add_sample_arguments(parser)
+    checkpoint.add_checkpoint_arguments(parser)
+    progress.add_progress_arguments(parser)
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.top is not None and args.top < 1:
+        parser.error("--top needs at least one config")
 
-    # Get the SQLite file from command line argument
-    database_file = sys.argv[1]
+    # Use the indexed sidecar of the report when there is an up to date one
+    database_file = nsys_index.resolve_report(args)
+    report_reader.check_report(database_file, REPORT_TABLES)
 
     # Calculate time differences
-    extract_metrics(database_file)
+    profiling.start_profile(args.profile, args.cprofile)
+    progress.start_progress(progress.progress_mode(args))
+    checkpoint.interrupt_on_termination()
+    try:
+        with profiling.stage("extract_metrics"):
+            extract_metrics(database_file, report_cache.cache_mode(args), args.sketch, args.jobs, render.render_options(args), time_window.window_arguments(database_file, args, parser), args.demangle, args.top, args.rank_by,
+                PARTITION_COLUMNS + ["contextId"] * args.by_context if args.breakdown else None, args.sample, args.seed, args.checkpoint, args.resume)
+    except KeyboardInterrupt:
+        progress.finish_progress()
+        if args.checkpoint or args.resume:
+            print("Interrupted, continue with --resume from", checkpoint.checkpoint_dir(database_file))
+        else:
+            print("Interrupted")
+        sys.exit(130)
+    progress.finish_progress()
+    profiling.finish_profile()
 
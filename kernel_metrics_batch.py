@@ -0,0 +1,142 @@
+#This script runs kernel_metrics on many per-rank reports in parallel.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 kernel_metrics_batch.py [-j JOBS] [--sketch ERROR] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <directory or glob>
+
+#Note: Analyzes one report per rank (e.g. the .sqlite files of an MPI job)
+# in a process pool. Every rank is reduced to per-kernel quantile sketches,
+# which are merged across ranks by kernel name and launch config. The
+# aggregate figures are written as batch_metric_*, the per-rank ones as
+# batch_rank_*, and the ranks with the worst slack are printed.
+#########################################################################
+import os
+import sys
+import glob
+import argparse
+import concurrent.futures
+import numpy as np
+import kernel_metrics
+import report_reader
+import quantile_sketch
+import render
+import table_export
+import profiling
+#######################################################
+def find_reports(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.sqlite")
+    # Sidecar copies built by nsys_index are not reports of their own
+    return sorted(f for f in glob.glob(pattern) if not f.endswith(".idx.sqlite"))
+#######################################################
+def analyze_rank(database_file, relative_error):
+    # Runs in a worker process, only the sketches and the config identities
+    # (full kernel name and launch dimensions) are sent back
+    config_keys, names, ket_sketch, klo_sketch, slack_sketch = kernel_metrics.sketch_kernel_configs(database_file, relative_error)
+    return kernel_metrics.config_identities(config_keys, names), ket_sketch, klo_sketch, slack_sketch
+#######################################################
+def rank_table(reports, rank_statistics, rank_identities, num_worst):
+    # A rank's slack is the launch weighted mean of its per-kernel median
+    # slacks, which is what the ranks are ordered by
+    rows = []
+    for rank, (report, statistics, identities) in enumerate(zip(reports, rank_statistics, rank_identities)):
+        dominant_list, launches, slack = statistics
+        weighted_slack = np.average(slack, weights=launches) if sum(launches) > 0 else 0
+        worst = max(range(len(slack)), key=lambda i: slack[i]) if slack else None
+        rows.append({
+            "rank": rank,
+            "report": os.path.basename(report),
+            "configs": len(identities),
+            "launches": int(sum(launches)),
+            "kernel_time": float(sum(dominant_list)),
+            "slack": float(weighted_slack),
+            "worst_kernel": identities[worst] if worst is not None else None,
+            "worst_slack": float(slack[worst]) if worst is not None else 0.0,
+        })
+    rows.sort(key=lambda row: row["slack"], reverse=True)
+
+    print("Ranks with the worst slack:")
+    print("%5s %-30s %8s %12s %16s %12s  %s" % ("rank", "report", "configs", "launches", "kernel time(us)", "slack(us)", "worst kernel (median slack us)"))
+    for row in rows[:num_worst]:
+        worst = ','.join(str(item) for item in row["worst_kernel"]) if row["worst_kernel"] else "-"
+        print("%5d %-30s %8d %12d %16.1f %12.2f  %s (%.2f)" % (row["rank"], row["report"][:30], row["configs"], row["launches"], row["kernel_time"], row["slack"], worst[:60], row["worst_slack"]))
+    return rows
+#######################################################
+def draw_rank_bar(plt, values, ylabel):
+    x_values = np.arange(1, len(values) + 1)
+    fig, ax = plt.subplots(1, figsize=(18, 8))
+    ax.bar(x_values, values, width=1, edgecolor='black')
+    ax.xaxis.set_ticks(x_values[::max(1, len(values) // 32)])
+    ax.tick_params(axis='x', rotation=90)
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Rank")
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+#######################################################
+def plot_ranks(rows, render_options=None):
+    rows = sorted(rows, key=lambda row: row["rank"])
+    figures = []
+    for metric, ylabel, file_name in (("kernel_time", "Total Kernel Time (us)", "batch_rank_kernel_time"), ("slack", "Mean Slack (us)", "batch_rank_slack")):
+        figures.append((file_name, draw_rank_bar, ([row[metric] for row in rows], ylabel)))
+    render.render_figures(figures, render_options)
+#######################################################
+def launch_counts(num_configs, ket_sketch):
+    counts = np.zeros(num_configs, dtype=np.int64)
+    np.add.at(counts, ket_sketch["keys"] >> quantile_sketch.BIN_BITS, ket_sketch["counts"])
+    return counts.tolist()
+#######################################################
+def analyze_batch(reports, relative_error=0.01, jobs=None, num_worst=10, render_options=None):
+    with profiling.stage("rank sketches"), concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(analyze_rank, reports, [relative_error] * len(reports)))
+
+    rank_statistics = []
+    for identities, ket_sketch, klo_sketch, slack_sketch in results:
+        dominant_list = kernel_metrics.sketch_statistics(len(identities), ket_sketch, klo_sketch, slack_sketch)[3]
+        slack = quantile_sketch.filtered_medians(slack_sketch, len(identities)).tolist()
+        rank_statistics.append((dominant_list, launch_counts(len(identities), ket_sketch), slack))
+    rows = rank_table(reports, rank_statistics, [result[0] for result in results], num_worst)
+    table_export.export_table("batch_rank_table", rows, render_options)
+    plot_ranks(rows, render_options)
+
+    identities, merged = kernel_metrics.merge_sketch_configs(results, relative_error)
+    ket_list, klo_list, slack_list, dominant_list = kernel_metrics.sketch_statistics(len(identities), *merged)
+    labels = kernel_metrics.identity_labels(identities, range(len(identities)))
+    table_export.export_table("batch_metric_table", kernel_metrics.metric_table(labels, ket_list, klo_list, slack_list, dominant_list), render_options)
+    kernel_metrics.plot_metrics(labels, ket_list, klo_list, slack_list, dominant_list, prefix="batch_metric", render_options=render_options)
+    return identities, (ket_list, klo_list, slack_list, dominant_list), rows
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("reports", help="directory with one .sqlite report per rank, or a glob")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--sketch", type=quantile_sketch.parse_relative_error, default=0.01, metavar="ERROR", help="relative error of the per-kernel quantile sketches")
+    parser.add_argument("--worst", type=int, default=10, help="number of ranks listed in the worst slack table")
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    reports = find_reports(args.reports)
+    if len(reports) == 0:
+        print("No reports found in", args.reports)
+        sys.exit(1)
+    for database_file in reports:
+        report_reader.check_report(database_file, kernel_metrics.REPORT_TABLES)
+    print("Analyzing", len(reports), "reports")
+    profiling.start_profile(args.profile, args.cprofile)
+    with profiling.stage("analyze_batch"):
+        analyze_batch(reports, args.sketch, args.jobs, args.worst, render.render_options(args))
+    profiling.finish_profile()
@@ -14,100 +14,102 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #########################################################################
-#Usage: python3 memcpy_DtoH.py <sqlite file>
+#Usage: python3 memcpy_DtoH.py [--build-index [--sidecar]] [--no-cache | --incremental] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
 
 #Note: It may take from a few minutes to multiple hours for the script
 # to finish producing the figures based on the <sqlite file> size
 #########################################################################
 import os
 import sys 
-import matplotlib
-matplotlib.use("pgf")
-matplotlib.rcParams.update({
-    "pgf.texsystem": "pdflatex",
-    'font.family': 'serif',
-    'font.size': 14, 
-    'text.usetex': True,
-    'pgf.rcfonts': False,
-})
-import matplotlib.pyplot as plt 
+import argparse
 import numpy as np
 import re
 import math
 import sqlite3
-from matplotlib.ticker import MultipleLocator
+import nsys_index
+import report_cache
+import report_reader
+import render
+import table_export
+import profiling
+import time_window
 ###################################################
-def extract_host_to_device_transfers(database_file):
+def draw_transfer_histogram(plt, bin_array, labels):
+    from matplotlib.ticker import MultipleLocator
+    fig, ax = plt.subplots(1, figsize=(10, 10))
+    ax.bar(range(1, 11), bin_array, width=1, edgecolor='black')
+    x_values = np.arange(1,len(bin_array)+1)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=45)
+    max_items_in_bin = np.max(bin_array)
+    min_items_in_bin = np.min(bin_array)
+    y_step_size = (max_items_in_bin - min_items_in_bin) / 10
+    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Transfer Size Range")
+    ax.set_ylabel("Frequency")
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+###################################################
+def extract_host_to_device_transfers(database_file, use_cache=True, render_options=None, window=None):
     try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(database_file)
-        cursor = connection.cursor()
-
-        # Execute SQL query to fetch host-to-device transfers and their sizes
-        cursor.execute("SELECT bytes FROM CUPTI_ACTIVITY_KIND_MEMCPY WHERE copyKind = 2")
-
-        # Fetch all the rows
-        transfers = cursor.fetchall()
+        # Load the transfer columns, from the column cache when there is one
+        columns = report_cache.load_memcpy_columns(database_file, use_cache, window, 2)
 
-        # Extract transfer sizes
-        transfer_sizes = [transfer[0] for transfer in transfers]
+        # Extract the sizes of the device-to-host transfers
+        transfer_sizes = columns["bytes"][columns["copyKind"] == 2].tolist()
+        if not transfer_sizes:
+            print("No device-to-host transfers%s, nothing to report" % (" in the window" if window is not None else ""))
+            return
 
         labels = ["4KB","8KB","16KB","32KB","64KB","128KB","256KB","512KB","1MB","1MB+"]
-        bin_array = np.zeros(10)
-        for num in transfer_sizes:
-            if (num <= 4096):
-                bin_array[0] += 1
-            elif (num <= 8192):
-                bin_array[1] += 1
-            elif (num <= 16384):
-                bin_array[2] += 1
-            elif (num <= 32768):
-                bin_array[3] += 1
-            elif (num <= 65536):
-                bin_array[4] += 1
-            elif (num <= 131072):
-                bin_array[5] += 1
-            elif (num <= 262144):
-                bin_array[6] += 1
-            elif (num <= 524288):
-                bin_array[7] += 1
-            elif (num <= 1048576):
-                bin_array[8] += 1
-            else:
-                bin_array[9] += 1
+        with profiling.stage("binning"):
+            bin_array = np.zeros(10)
+            for num in transfer_sizes:
+                if (num <= 4096):
+                    bin_array[0] += 1
+                elif (num <= 8192):
+                    bin_array[1] += 1
+                elif (num <= 16384):
+                    bin_array[2] += 1
+                elif (num <= 32768):
+                    bin_array[3] += 1
+                elif (num <= 65536):
+                    bin_array[4] += 1
+                elif (num <= 131072):
+                    bin_array[5] += 1
+                elif (num <= 262144):
+                    bin_array[6] += 1
+                elif (num <= 524288):
+                    bin_array[7] += 1
+                elif (num <= 1048576):
+                    bin_array[8] += 1
+                else:
+                    bin_array[9] += 1
+            profiling.add_rows(len(transfer_sizes))
 
-
-        fig, ax = plt.subplots(1, figsize=(10, 10))
-        ax.bar(range(1, 11), bin_array, width=1, edgecolor='black')
-        x_values = np.arange(1,len(bin_array)+1)
-        ax.xaxis.set_ticks(x_values)
-        ax.xaxis.set_ticklabels(labels)
-        ax.tick_params(axis='x', rotation=45)
-        max_items_in_bin = np.max(bin_array)
-        min_items_in_bin = np.min(bin_array)
-        y_step_size = (max_items_in_bin - min_items_in_bin) / 10
-        ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-        ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-        ax.set_xlabel("Transfer Size Range")
-        ax.set_ylabel("Frequency")
-        fig.tight_layout()
-        fig.subplots_adjust(top=0.95)
-        fig.savefig('hist_DtoH.pgf', bbox_inches='tight')
-        fig.savefig('hist_DtoH.png', bbox_inches='tight')
+        table_export.export_table('memcpy_DtoH', [{"size": label, "count": int(count)} for label, count in zip(labels, bin_array)], render_options)
+        render.render_figures([('hist_DtoH', draw_transfer_histogram, (bin_array, labels))], render_options)
 
     except sqlite3.Error as error:
         print("Error reading data from SQLite table:", error)
 
-    finally:
-        # Close the database connection
-        if connection:
-            connection.close()
-
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python program_name.py <database_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    report_cache.add_cache_arguments(parser)
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
 
-    database_file = sys.argv[1]
-    extract_host_to_device_transfers(database_file)
+    database_file = nsys_index.resolve_report(args)
+    report_reader.check_report(database_file, report_cache.MEMCPY_TABLES)
+    profiling.start_profile(args.profile, args.cprofile)
+    with profiling.stage("extract_host_to_device_transfers"):
+        extract_host_to_device_transfers(database_file, report_cache.cache_mode(args), render.render_options(args), time_window.window_arguments(database_file, args, parser))
+    profiling.finish_profile()
 
@@ -14,139 +14,169 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #########################################################################
-#Usage: python3 memcpy_DtoH_bw.py <sqlite file>
+#Usage: python3 memcpy_DtoH_bw.py [--build-index [--sidecar]] [--no-cache | --incremental] [--histogram] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
 
 #Note: It may take from a few minutes to multiple hours for the script
 # to finish producing the figures based on the <sqlite file> size
 #########################################################################
 import os
 import sys 
-import matplotlib
-matplotlib.use("pgf")
-matplotlib.rcParams.update({
-    "pgf.texsystem": "pdflatex",
-    'font.family': 'serif',
-    'font.size': 14, 
-    'text.usetex': True,
-    'pgf.rcfonts': False,
-})
-import matplotlib.pyplot as plt 
+import argparse
 import numpy as np
 import re
 import math
 import sqlite3
-from matplotlib.ticker import MultipleLocator
+import nsys_index
+import report_cache
+import report_reader
+import render
+import table_export
+import profiling
+import time_window
+import bw_histogram
 ####################################################
-def extract_host_to_device_transfers(database_file):
-    try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(database_file)
-        cursor = connection.cursor()
+def draw_bandwidth_violins(plt, labels, array_lists, vpstats):
+    # Either the bandwidths of every transfer or the precomputed histogram
+    # statistics (--histogram) are given, the other one is None
+    from matplotlib.ticker import MultipleLocator
+    x_values = np.arange(1,11)
+    fig, ax = plt.subplots(1, figsize=(10, 10))
+    if vpstats is not None:
+        parts = ax.violin(vpstats, showmeans=True, showmedians=True)
+    else:
+        parts = ax.violinplot(array_lists, showmeans=True, showmedians=True)
+    # Customizing violin parts
+    for pc in parts['bodies']:
+        pc.set_facecolor('skyblue')
+        pc.set_edgecolor('black')
+        pc.set_alpha(0.7)
 
-        # Execute SQL query to fetch host-to-device transfers and their sizes
-        cursor.execute("SELECT start, end, bytes FROM CUPTI_ACTIVITY_KIND_MEMCPY WHERE copyKind = 2")
+    # Customizing median line
+    parts['cmedians'].set_color('blue')
+    parts['cmedians'].set_linewidth(2)
+    # Customizing whiskers and caps
+    parts['cmins'].set_color('red')
+    parts['cmins'].set_linestyle('--')
+    parts['cmaxes'].set_color('green')
+    parts['cmaxes'].set_linestyle('--')
+    # Customizing caps
+    parts['cbars'].set_color('black')
 
-        # Fetch all the rows
-        transfers = cursor.fetchall()
-        num_arr = 10
-        array_lists = [[] for _ in range(num_arr)]
-        for data in transfers:
-            if (data[2] <= (4*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[0].append(byte_tmp / time)
-            elif (data[2] <= (8*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[1].append(byte_tmp / time)
-            elif (data[2] <= (16*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[2].append(byte_tmp / time)
-            elif (data[2] <= (32*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[3].append(byte_tmp / time)
-            elif (data[2] <= (64*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[4].append(byte_tmp / time)
-            elif (data[2] <= (128*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[5].append(byte_tmp / time)
-            elif (data[2] <= (256*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[6].append(byte_tmp / time)
-            elif (data[2] <= (512*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[7].append(byte_tmp / time)
-            elif (data[2] <= (1024*1024)):
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[8].append(byte_tmp / time)
-            else:
-                byte_tmp = data[2] * 953.674
-                time = data[1] - data[0]
-                array_lists[9].append(byte_tmp / time)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=45)
+    if vpstats is not None:
+        max_value = max(stats["max"] for stats in vpstats)
+        min_value = min(stats["min"] for stats in vpstats)
+    else:
+        max_value = max(max(sublist) for sublist in array_lists)
+        min_value = min(min(sublist) for sublist in array_lists)
+    y_step_size = (max_value - min_value) / 10
+    ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Transfer size range (B)")
+    ax.set_ylabel("Bandwidth (MB/s)")
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+####################################################
+def extract_host_to_device_transfers(database_file, use_cache=True, render_options=None, histogram=False, window=None):
+    try:
+        if histogram:
+            # Stream the device-to-host transfers in chunks into per-bucket histograms
+            state = bw_histogram.new_histograms()
+            for transfer_bytes, start, end in report_cache.iter_memcpy_chunks(database_file, 2, use_cache, window=window):
+                with profiling.stage("histogram update"):
+                    bw_histogram.update_histograms(state, transfer_bytes, start, end)
+                    profiling.add_rows(len(transfer_bytes))
+            if not state["n"].any():
+                print("No device-to-host transfers%s, nothing to report" % (" in the window" if window is not None else ""))
+                return
+            vpstats = bw_histogram.violin_stats(state)
+            table = bw_histogram.histogram_table(state, vpstats)
+        else:
+            # Load the transfer columns, from the column cache when there is one
+            columns = report_cache.load_memcpy_columns(database_file, use_cache, window, 2)
+            mask = columns["copyKind"] == 2
 
+            # Keep the device-to-host transfers
+            transfers = zip(columns["start"][mask].tolist(), columns["end"][mask].tolist(), columns["bytes"][mask].tolist())
+            with profiling.stage("bandwidth"):
+                num_arr = 10
+                array_lists = [[] for _ in range(num_arr)]
+                for data in transfers:
+                    if (data[2] <= (4*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[0].append(byte_tmp / time)
+                    elif (data[2] <= (8*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[1].append(byte_tmp / time)
+                    elif (data[2] <= (16*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[2].append(byte_tmp / time)
+                    elif (data[2] <= (32*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[3].append(byte_tmp / time)
+                    elif (data[2] <= (64*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[4].append(byte_tmp / time)
+                    elif (data[2] <= (128*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[5].append(byte_tmp / time)
+                    elif (data[2] <= (256*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[6].append(byte_tmp / time)
+                    elif (data[2] <= (512*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[7].append(byte_tmp / time)
+                    elif (data[2] <= (1024*1024)):
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[8].append(byte_tmp / time)
+                    else:
+                        byte_tmp = data[2] * 953.674
+                        time = data[1] - data[0]
+                        array_lists[9].append(byte_tmp / time)
+                profiling.add_rows(sum(len(item) for item in array_lists))
 
-        for item in array_lists:
-            if (len(item) == 0):
-                item.append(0)
+            if not any(array_lists):
+                print("No device-to-host transfers%s, nothing to report" % (" in the window" if window is not None else ""))
+                return
+            table = bw_histogram.list_table(array_lists)
+            for item in array_lists:
+                if (len(item) == 0):
+                    item.append(0)
 
-        
         labels = ["4KB","8KB","16KB","32KB","64KB","128KB","256KB","512KB","1MB","1MB+"]
-        x_values = np.arange(1,len(array_lists)+1)
-        fig, ax = plt.subplots(1, figsize=(10, 10))
-        parts = ax.violinplot(array_lists, showmeans=True, showmedians=True)
-        # Customizing violin parts
-        for pc in parts['bodies']:
-            pc.set_facecolor('skyblue')
-            pc.set_edgecolor('black')
-            pc.set_alpha(0.7)
-
-        # Customizing median line
-        parts['cmedians'].set_color('blue')
-        parts['cmedians'].set_linewidth(2)
-        # Customizing whiskers and caps
-        parts['cmins'].set_color('red')
-        parts['cmins'].set_linestyle('--')
-        parts['cmaxes'].set_color('green')
-        parts['cmaxes'].set_linestyle('--')
-        # Customizing caps
-        parts['cbars'].set_color('black')
-
-        ax.xaxis.set_ticks(x_values)
-        ax.xaxis.set_ticklabels(labels)
-        ax.tick_params(axis='x', rotation=45)
-        max_value = max(max(sublist) for sublist in array_lists)
-        min_value = min(min(sublist) for sublist in array_lists)
-        y_step_size = (max_value - min_value) / 10
-        ax.yaxis.set_major_locator(MultipleLocator(y_step_size))
-        ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
-        ax.set_xlabel("Transfer size range (B)")
-        ax.set_ylabel("Bandwidth (MB/s)")
-        fig.tight_layout()
-        fig.subplots_adjust(top=0.95)
-        fig.savefig('hist_DtoH_bw.pgf', bbox_inches='tight')
-        fig.savefig('hist_DtoH_bw.png', bbox_inches='tight')
+        table_export.export_table('memcpy_DtoH_bw', [dict({"size": label}, **row) for label, row in zip(labels, table)], render_options)
+        render.render_figures([('hist_DtoH_bw', draw_bandwidth_violins, (labels, None if histogram else array_lists, vpstats if histogram else None))], render_options)
 
     except sqlite3.Error as error:
         print("Error reading data from SQLite table:", error)
 
-    finally:
-        # Close the database connection
-        if connection:
-            connection.close()
-
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python program_name.py <database_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    report_cache.add_cache_arguments(parser)
+    parser.add_argument("--histogram", action="store_true", help="stream the bandwidths into log-spaced histograms instead of keeping every transfer")
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
 
-    database_file = sys.argv[1]
-    extract_host_to_device_transfers(database_file)
+    database_file = nsys_index.resolve_report(args)
+    report_reader.check_report(database_file, report_cache.MEMCPY_TABLES)
+    profiling.start_profile(args.profile, args.cprofile)
+    with profiling.stage("extract_host_to_device_transfers"):
+        extract_host_to_device_transfers(database_file, report_cache.cache_mode(args), render.render_options(args), args.histogram, time_window.window_arguments(database_file, args, parser))
+    profiling.finish_profile()
 
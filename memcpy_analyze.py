@@ -0,0 +1,321 @@
+#This script analyzes the memcpy transfers of every copy kind in a single scan.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 memcpy_analyze.py [--build-index [--sidecar]] [--log2-edges LOW:HIGH] [--breakdown [--by-context]] [--sample FRACTION [--seed S]] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
+
+#Note: Unlike the memcpy_* scripts, this reads CUPTI_ACTIVITY_KIND_MEMCPY
+# once for all the copy kinds (HtoD, DtoH, DtoD and PtoP) and lets SQLite
+# do the size bucketing with GROUP BY, so only a few dozen rows come back.
+# Host transfers are also split into pinned and pageable memory.
+#########################################################################
+import sys
+import json
+import argparse
+import numpy as np
+import math
+import sqlite3
+import nsys_index
+import report_reader
+import render
+import table_export
+import profiling
+import time_window
+#######################################################
+# CUPTI_ACTIVITY_MEMCPY_KIND values
+COPY_KINDS = {1: "HtoD", 2: "DtoH", 8: "DtoD", 10: "PtoP"}
+REPORT_TABLES = {"CUPTI_ACTIVITY_KIND_MEMCPY": ["copyKind", "srcKind", "dstKind", "bytes", "start", "end"]}
+# Keys of the --breakdown partitions
+PARTITION_COLUMNS = ["deviceId", "streamId"]
+# CUPTI_ACTIVITY_MEMORY_KIND values of the host side of a transfer
+MEMORY_KINDS = {0: "unknown", 1: "pageable", 2: "pinned", 3: "device", 4: "array", 5: "managed", 6: "device static", 7: "managed static"}
+#######################################################
+def size_edges(log2_low=12, log2_high=20):
+    # Upper bounds of the size buckets, the default is the 4KB ... 1MB set
+    # of the memcpy_* scripts, the last bucket is open
+    return [2 ** i for i in range(log2_low, log2_high + 1)]
+#######################################################
+def size_label(num_bytes):
+    for unit, scale in (("GB", 1 << 30), ("MB", 1 << 20), ("KB", 1 << 10)):
+        if num_bytes >= scale:
+            return "%d%s" % (num_bytes // scale, unit)
+    return "%dB" % num_bytes
+#######################################################
+def bucket_labels(edges):
+    return [size_label(edge) for edge in edges] + [size_label(edges[-1]) + "+"]
+#######################################################
+def bucket_expression(edges, column="bytes"):
+    cases = " ".join("WHEN %s <= %d THEN %d" % (column, edge, i) for i, edge in enumerate(edges))
+    return "CASE %s ELSE %d END" % (cases, len(edges))
+#######################################################
+def host_memory_kind(copy_kind, src_kind, dst_kind):
+    if copy_kind == 1:
+        return MEMORY_KINDS.get(src_kind, "unknown")
+    if copy_kind == 2:
+        return MEMORY_KINDS.get(dst_kind, "unknown")
+    return "device"
+#######################################################
+def memcpy_groups(database_file, edges, window=None, partition=(), rows=None):
+    # (partition columns..., copyKind, srcKind, dstKind, bucket, count,
+    # bytes, time, timed, bandwidth sum, squared sum, min and max) per
+    # group, from SQLite. The partition columns are extra GROUP BY keys,
+    # rows restricts the groups to the rows drawn by --sample
+    if report_reader.is_arrow_report(database_file):
+        return memcpy_column_groups(database_file, edges, window, partition, rows)
+    keys = ''.join(column + ", " for column in partition)
+    bandwidth = "(bytes * 953.674 / (end - start))"
+    query = """
+    SELECT
+        %scopyKind,
+        srcKind,
+        dstKind,
+        %s AS bucket,
+        COUNT(*),
+        SUM(bytes),
+        SUM(end - start),
+        SUM(CASE WHEN end > start THEN 1 ELSE 0 END),
+        SUM(CASE WHEN end > start THEN %s END),
+        SUM(CASE WHEN end > start THEN %s * %s END),
+        MIN(CASE WHEN end > start THEN %s END),
+        MAX(CASE WHEN end > start THEN %s END)
+    FROM CUPTI_ACTIVITY_KIND_MEMCPY
+    WHERE copyKind IN (%s)%s%s
+    GROUP BY %scopyKind, srcKind, dstKind, bucket
+    """ % (keys, bucket_expression(edges), bandwidth, bandwidth, bandwidth, bandwidth, bandwidth, ','.join(str(k) for k in COPY_KINDS),
+           " AND " + time_window.window_condition("start") if window is not None else "", " AND " + report_reader.SQL_ROWS if rows is not None else "", keys)
+    params = tuple(window) if window is not None else ()
+    if rows is not None:
+        params += (json.dumps(np.asarray(rows).tolist()),)
+
+    connection = report_reader.connect(database_file)
+    cursor = connection.cursor()
+    try:
+        nsys_index.report_query_plan(cursor, "memcpy summary", query, params)
+        with profiling.stage("query"):
+            cursor.execute(query, params)
+        with profiling.stage("fetch"):
+            results = cursor.fetchall()
+            profiling.add_rows(len(results))
+    finally:
+        connection.close()
+    return results
+#######################################################
+def memcpy_column_groups(database_file, edges, window=None, partition=(), rows=None):
+    # The same groups as the SQL GROUP BY, from the projected columns of an
+    # Arrow/Parquet report with copyKind and the window pushed into the scan
+    columns = report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", list(partition) + ["copyKind", "srcKind", "dstKind", "bytes", "start", "end"],
+        where={"copyKind": list(COPY_KINDS)}, ranges={"start": window} if window is not None else None, rows=rows)
+    with profiling.stage("grouping"):
+        bucket = np.searchsorted(edges, columns["bytes"], side="left")
+        keys, inverse = np.unique(np.column_stack([columns[column] for column in partition] + [columns["copyKind"], columns["srcKind"], columns["dstKind"], bucket]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        duration = columns["end"] - columns["start"]
+        timed = duration > 0
+        bandwidth = columns["bytes"][timed] * 953.674 / duration[timed]
+        timed_groups = inverse[timed]
+        counts = np.bincount(inverse, minlength=len(keys))
+        total_bytes = np.bincount(inverse, weights=columns["bytes"], minlength=len(keys))
+        total_time = np.bincount(inverse, weights=duration, minlength=len(keys))
+        num_timed = np.bincount(timed_groups, minlength=len(keys))
+        bw_sum = np.bincount(timed_groups, weights=bandwidth, minlength=len(keys))
+        bw_sq_sum = np.bincount(timed_groups, weights=bandwidth * bandwidth, minlength=len(keys))
+        bw_min = np.full(len(keys), np.inf)
+        bw_max = np.full(len(keys), -np.inf)
+        if len(bandwidth):
+            order = np.argsort(timed_groups, kind="stable")
+            present = np.flatnonzero(num_timed)
+            first = np.searchsorted(timed_groups[order], present)
+            bw_min[present] = np.minimum.reduceat(bandwidth[order], first)
+            bw_max[present] = np.maximum.reduceat(bandwidth[order], first)
+        profiling.add_rows(len(inverse))
+    return [(*key, int(counts[i]), int(total_bytes[i]), int(total_time[i]), int(num_timed[i]), float(bw_sum[i]), float(bw_sq_sum[i]), float(bw_min[i]), float(bw_max[i]))
+        for i, key in enumerate(keys.tolist())]
+#######################################################
+def summarize_memcpy(database_file, edges, window=None, rows=None, fraction=None):
+    return summary_rows(memcpy_groups(database_file, edges, window, rows=rows), fraction=fraction)
+#######################################################
+def summarize_memcpy_partitions(database_file, edges, window=None, partition=PARTITION_COLUMNS, rows=None, fraction=None):
+    # The summary of all the transfers and the one per partition, both from
+    # the groups of a single scan
+    results = memcpy_groups(database_file, edges, window, partition, rows)
+    return summary_rows(results, len(partition), fraction=fraction), summary_rows(results, len(partition), partition, fraction)
+#######################################################
+def sample_estimates(row, timed, fraction):
+    # The counts of a --sample scaled to all the transfers, and the 95%
+    # confidence intervals of the count and of the mean bandwidth
+    count, count_low, count_high = report_reader.count_interval(row["count"], fraction)
+    error = report_reader.SAMPLE_Z * row["bw_std"] / math.sqrt(timed) if timed else 0.0
+    return {
+        "count_estimate": count,
+        "count_low": count_low,
+        "count_high": count_high,
+        "bytes_estimate": row["bytes"] / fraction,
+        "bw_mean_low": max(row["bw_mean"] - error, 0.0),
+        "bw_mean_high": row["bw_mean"] + error,
+        "sample_fraction": fraction,
+    }
+#######################################################
+def summary_rows(results, num_keys=0, partition=(), fraction=None):
+    # Merge the (copyKind, srcKind, dstKind) groups into (direction, host
+    # memory kind) and also into (direction, "all"), per partition when the
+    # num_keys partition columns of the groups are named in partition. The
+    # groups of a sample of the fraction of the rows get sample_estimates
+    summary = {}
+    for group in results:
+        copy_kind, src_kind, dst_kind, bucket, count, total_bytes, total_time, timed, bw_sum, bw_sq_sum, bw_min, bw_max = group[num_keys:]
+        direction = COPY_KINDS[copy_kind]
+        for memory in (host_memory_kind(copy_kind, src_kind, dst_kind), "all"):
+            key = tuple(group[:len(partition)]) + (direction, memory, bucket)
+            if key not in summary:
+                summary[key] = {"count": 0, "bytes": 0, "time": 0, "timed": 0, "bw_sum": 0.0, "bw_sq_sum": 0.0, "bw_min": math.inf, "bw_max": -math.inf}
+            item = summary[key]
+            item["count"] += count
+            item["bytes"] += total_bytes
+            item["time"] += total_time
+            item["timed"] += timed
+            if timed:
+                item["bw_sum"] += bw_sum
+                item["bw_sq_sum"] += bw_sq_sum
+                item["bw_min"] = min(item["bw_min"], bw_min)
+                item["bw_max"] = max(item["bw_max"], bw_max)
+
+    rows = []
+    for key, item in sorted(summary.items()):
+        direction, memory, bucket = key[len(partition):]
+        timed = item["timed"]
+        mean = item["bw_sum"] / timed if timed else 0.0
+        variance = max(item["bw_sq_sum"] / timed - mean * mean, 0.0) if timed else 0.0
+        rows.append(dict(zip(partition, key), **{
+            "direction": direction,
+            "memory": memory,
+            "bucket": bucket,
+            "count": item["count"],
+            "bytes": item["bytes"],
+            "bw_mean": mean,
+            "bw_std": math.sqrt(variance),
+            "bw_min": item["bw_min"] if timed else 0.0,
+            "bw_max": item["bw_max"] if timed else 0.0,
+            # Total bytes over total time, in the same MB/s as the others
+            "bw_aggregate": item["bytes"] * 953.674 / item["time"] if item["time"] > 0 else 0.0,
+        }))
+        if fraction is not None:
+            rows[-1].update(sample_estimates(rows[-1], timed, fraction))
+    return rows
+#######################################################
+def print_summary(rows, labels, partition=()):
+    # A sample also prints the estimated count and the mean interval
+    sampled = len(rows) > 0 and "sample_fraction" in rows[0]
+    print(''.join("%10s " % column for column in partition) + "%-5s %-15s %-7s %10s %14s %12s %12s %12s %12s" % ("kind", "host memory", "size", "count", "bytes", "mean MB/s", "std MB/s", "max MB/s", "total MB/s")
+        + (" %25s %25s" % ("est. count (95% CI)", "mean MB/s (95% CI)") if sampled else ""))
+    for row in rows:
+        print(''.join("%10d " % row[column] for column in partition) + "%-5s %-15s %-7s %10d %14d %12.1f %12.1f %12.1f %12.1f" % (row["direction"], row["memory"], labels[row["bucket"]], row["count"], row["bytes"], row["bw_mean"], row["bw_std"], row["bw_max"], row["bw_aggregate"])
+            + (" %11d .. %11d %11.1f .. %11.1f" % (row["count_low"], row["count_high"], row["bw_mean_low"], row["bw_mean_high"]) if sampled else ""))
+#######################################################
+def draw_direction_bars(plt, labels, directions, series, ylabel, errors=None):
+    # errors are the (low, high) bounds of every series, if any
+    width = 0.8 / len(directions)
+    x_values = np.arange(1, len(labels) + 1)
+    fig, ax = plt.subplots(1, figsize=(12, 10))
+    for i, (direction, values) in enumerate(zip(directions, series)):
+        yerr = None if errors is None else [values - errors[i][0], errors[i][1] - values]
+        ax.bar(x_values - 0.4 + width * (i + 0.5), values, width=width, edgecolor='black', label=direction, yerr=yerr, capsize=2)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=45)
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Transfer size range (B)")
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+#######################################################
+def plot_summary(rows, labels, render_options=None):
+    directions = [d for d in COPY_KINDS.values() if any(row["direction"] == d for row in rows)]
+    if len(directions) == 0:
+        return
+    # A sample plots the estimated counts, with the confidence intervals
+    fraction = rows[0].get("sample_fraction")
+    sample = "" if fraction is None else " - %.3g%% sample, 95%% CI" % (100 * fraction)
+    figures = []
+    for metric, ylabel, file_name in (("count", "Instances", "hist_memcpy_count"), ("bw_mean", "Bandwidth (MB/s)", "hist_memcpy_bw")):
+        value = "count_estimate" if fraction is not None and metric == "count" else metric
+        bounds = (metric + "_low", metric + "_high")
+        series = []
+        errors = []
+        for direction in directions:
+            values = np.zeros(len(labels))
+            low = np.zeros(len(labels))
+            high = np.zeros(len(labels))
+            for row in rows:
+                if row["direction"] == direction and row["memory"] == "all":
+                    values[row["bucket"]] = row[value]
+                    if fraction is not None:
+                        low[row["bucket"]], high[row["bucket"]] = row[bounds[0]], row[bounds[1]]
+            series.append(values)
+            errors.append((low, high))
+        figures.append((file_name, draw_direction_bars, (labels, directions, series, ylabel + sample, errors if fraction is not None else None)))
+    render.render_figures(figures, render_options)
+#######################################################
+def parse_log2_edges(value):
+    # LOW:HIGH with 0 <= LOW <= HIGH < 63, the byte counts are int64
+    try:
+        low, high = (int(item) for item in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LOW:HIGH powers of two, e.g. 12:20, not %r" % value)
+    if not 0 <= low <= high < 63:
+        raise argparse.ArgumentTypeError("LOW:HIGH needs 0 <= LOW <= HIGH < 63, not %r" % value)
+    return size_edges(low, high)
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    parser.add_argument("--log2-edges", type=parse_log2_edges, default=size_edges(), help="size bucket bounds as LOW:HIGH powers of two, default 12:20 (4KB ... 1MB)")
+    parser.add_argument("--breakdown", action="store_true", help="also summarize the transfers per deviceId and streamId, in the same scan")
+    parser.add_argument("--by-context", action="store_true", help="with --breakdown, also partition by contextId")
+    report_reader.add_sample_arguments(parser)
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    database_file = nsys_index.resolve_report(args)
+    partition = PARTITION_COLUMNS + ["contextId"] * args.by_context if args.breakdown else []
+    report_reader.check_report(database_file, {table: columns + partition for table, columns in REPORT_TABLES.items()})
+    edges = args.log2_edges
+    labels = bucket_labels(edges)
+    profiling.start_profile(args.profile, args.cprofile)
+    try:
+        sample_rows, fraction = None, None
+        if args.sample is not None:
+            sample_rows, fraction = report_reader.sample_rows(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", args.sample, args.seed)
+            print("Sampling %.3g%% of the transfer rows (%d rows)" % (100 * fraction, len(sample_rows)))
+        with profiling.stage("summarize_memcpy"):
+            if partition:
+                rows, partition_rows = summarize_memcpy_partitions(database_file, edges, time_window.window_arguments(database_file, args, parser), partition, sample_rows, fraction)
+            else:
+                rows = summarize_memcpy(database_file, edges, time_window.window_arguments(database_file, args, parser), sample_rows, fraction)
+    except sqlite3.Error as error:
+        print("Error reading data from SQLite table:", error)
+        sys.exit(1)
+    print_summary(rows, labels)
+    table_export.export_table("memcpy_summary", [dict(row, size=labels[row["bucket"]]) for row in rows], render.render_options(args))
+    plot_summary(rows, labels, render.render_options(args))
+    if partition:
+        # Only the rows of all host memory kinds are printed per partition
+        print_summary([row for row in partition_rows if row["memory"] == "all"], labels, partition)
+        table_export.export_table("memcpy_partition_summary", [dict(row, size=labels[row["bucket"]]) for row in partition_rows], render.render_options(args))
+    profiling.finish_profile()
@@ -0,0 +1,160 @@
+#This script measures how much of the memcpy time is hidden behind kernels on the same device.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 memcpy_overlap.py [--build-index [--sidecar]] [--no-cache | --incremental] [--log2-edges LOW:HIGH] [--start T] [--end T] [--skip-first N%] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <sqlite file | Arrow/Parquet dir>
+
+#Note: How much of the transfer time of CUPTI_ACTIVITY_KIND_MEMCPY was
+# hidden behind kernels of CUPTI_ACTIVITY_KIND_KERNEL running on the same
+# device. The kernels of every device are sorted by start and merged into
+# disjoint busy periods, with a running sum of their lengths. The
+# transfers are sorted by start as well and located among the periods
+# with one vectorised merge (searchsorted of sorted values), after which
+# the busy time inside a transfer is the difference of the running sum at
+# its end and at its start. No SQL range join is used and both sides are
+# O(n log n) to sort and linear to merge.
+#########################################################################
+import sys
+import argparse
+import numpy as np
+import sqlite3
+import nsys_index
+import report_cache
+import report_reader
+import render
+import table_export
+import profiling
+import time_window
+import memcpy_analyze
+import gpu_utilization
+#######################################################
+def covered_time(period_start, period_end, times):
+    # Busy time of the sorted disjoint periods before every time
+    cumulative = np.concatenate(([0], np.cumsum(period_end - period_start)))
+    index = np.searchsorted(period_start, times, side="right")
+    previous = np.maximum(index - 1, 0)
+    partial = np.clip(times - period_start[previous], 0, period_end[previous] - period_start[previous])
+    return np.where(index > 0, cumulative[previous] + partial, 0)
+#######################################################
+def hidden_transfer_time(kernels, transfers):
+    # Per transfer the time during which a kernel was running on its device
+    start = np.asarray(transfers["start"])
+    end = np.maximum(np.asarray(transfers["end"]), start)
+    hidden = np.zeros(len(start), dtype=np.int64)
+    kernel_device = np.asarray(kernels["deviceId"])
+    transfer_device = np.asarray(transfers["deviceId"])
+    for device in np.unique(transfer_device):
+        with profiling.stage("merge"):
+            selected = np.flatnonzero(kernel_device == device)
+            if len(selected) == 0:
+                continue
+            kernel_start = np.asarray(kernels["start"])[selected]
+            order = np.argsort(kernel_start, kind="stable")
+            kernel_start = kernel_start[order]
+            kernel_end = np.maximum(np.asarray(kernels["end"])[selected][order], kernel_start)
+            period_start, period_end = gpu_utilization.busy_periods(kernel_start, kernel_end)
+            del selected, order, kernel_start, kernel_end
+
+            # Sorted transfers walk the periods in order
+            index = np.flatnonzero(transfer_device == device)
+            index = index[np.argsort(start[index], kind="stable")]
+            hidden[index] = covered_time(period_start, period_end, end[index]) - covered_time(period_start, period_end, start[index])
+            profiling.add_rows(len(period_start) + len(index))
+    return hidden
+#######################################################
+def overlap_summary(transfers, hidden, edges):
+    duration = np.maximum(np.asarray(transfers["end"]) - np.asarray(transfers["start"]), 0)
+    bucket = np.searchsorted(edges, np.asarray(transfers["bytes"]), side="left")
+    copy_kind = np.asarray(transfers["copyKind"])
+    num_buckets = len(edges) + 1
+    rows = []
+    for kind, direction in memcpy_analyze.COPY_KINDS.items():
+        selected = copy_kind == kind
+        if not selected.any():
+            continue
+        kind_bucket = bucket[selected]
+        kind_duration = duration[selected]
+        kind_hidden = hidden[selected]
+        counts = np.bincount(kind_bucket, minlength=num_buckets)
+        total = np.bincount(kind_bucket, weights=kind_duration, minlength=num_buckets)
+        covered = np.bincount(kind_bucket, weights=kind_hidden, minlength=num_buckets)
+        fully = np.bincount(kind_bucket, weights=(kind_hidden >= kind_duration) & (kind_duration > 0), minlength=num_buckets)
+        exposed = np.bincount(kind_bucket, weights=kind_hidden == 0, minlength=num_buckets)
+        for i in np.flatnonzero(counts):
+            rows.append({
+                "direction": direction,
+                "bucket": int(i),
+                "count": int(counts[i]),
+                "transfer_us": total[i] / 1000,
+                "hidden_us": covered[i] / 1000,
+                "hidden_fraction": covered[i] / total[i] if total[i] > 0 else 0.0,
+                "fully_hidden": int(fully[i]),
+                "not_hidden": int(exposed[i]),
+            })
+    return rows
+#######################################################
+def print_overlap(rows, labels):
+    print("%-5s %-7s %10s %16s %16s %8s %12s %12s" % ("kind", "size", "count", "transfer (us)", "hidden (us)", "hidden", "fully hidden", "not hidden"))
+    for row in rows:
+        print("%-5s %-7s %10d %16.1f %16.1f %7.1f%% %12d %12d" % (row["direction"], labels[row["bucket"]], row["count"], row["transfer_us"], row["hidden_us"],
+            100 * row["hidden_fraction"], row["fully_hidden"], row["not_hidden"]))
+#######################################################
+def plot_overlap(rows, labels, render_options=None):
+    directions = [d for d in memcpy_analyze.COPY_KINDS.values() if any(row["direction"] == d for row in rows)]
+    if len(directions) == 0:
+        return
+    series = []
+    for direction in directions:
+        values = np.zeros(len(labels))
+        for row in rows:
+            if row["direction"] == direction:
+                values[row["bucket"]] = 100 * row["hidden_fraction"]
+        series.append(values)
+    render.render_figures([("hist_memcpy_overlap", memcpy_analyze.draw_direction_bars, (labels, directions, series, "Transfer time hidden behind kernels (%)"))], render_options)
+#######################################################
+def analyze_overlap(database_file, edges, use_cache=True, render_options=None, window=None):
+    try:
+        kernels = report_cache.load_kernel_intervals(database_file, use_cache, window)
+        transfers = report_cache.load_memcpy_columns(database_file, use_cache, window)
+    except sqlite3.Error as error:
+        print("Error reading data from SQLite table:", error)
+        sys.exit(1)
+    with profiling.stage("overlap"):
+        hidden = hidden_transfer_time(kernels, transfers)
+    with profiling.stage("summary"):
+        rows = overlap_summary(transfers, hidden, edges)
+    labels = memcpy_analyze.bucket_labels(edges)
+    print_overlap(rows, labels)
+    table_export.export_table("memcpy_overlap", [dict(row, size=labels[row["bucket"]]) for row in rows], render_options)
+    plot_overlap(rows, labels, render_options)
+    return rows
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    nsys_index.add_index_arguments(parser)
+    report_cache.add_cache_arguments(parser)
+    parser.add_argument("--log2-edges", type=memcpy_analyze.parse_log2_edges, default=memcpy_analyze.size_edges(), help="size bucket bounds as LOW:HIGH powers of two, default 12:20 (4KB ... 1MB)")
+    time_window.add_window_arguments(parser)
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    database_file = nsys_index.resolve_report(args)
+    report_reader.check_report(database_file, dict(report_cache.KERNEL_INTERVAL_TABLES, **report_cache.MEMCPY_TABLES))
+    profiling.start_profile(args.profile, args.cprofile)
+    with profiling.stage("analyze_overlap"):
+        analyze_overlap(database_file, args.log2_edges, report_cache.cache_mode(args), render.render_options(args), time_window.window_arguments(database_file, args, parser))
+    profiling.finish_profile()
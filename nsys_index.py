@@ -0,0 +1,123 @@
+#This script creates covering indexes in a report or in a sidecar copy of it.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 nsys_index.py [--sidecar] <sqlite file>
+
+#Note: nsys exports the reports without any index on the columns the
+# scripts filter and join on. This creates covering indexes for them,
+# either in the report itself or in a sidecar copy (<report>.idx.sqlite)
+# that the scripts pick up instead of the report when it is up to date.
+#########################################################################
+import os
+import argparse
+import sqlite3
+#######################################################
+# (index name, table, columns)
+INDEXES = [
+    ("nsys_analyze_kernel_config", "CUPTI_ACTIVITY_KIND_KERNEL",
+     ["shortName", "gridX", "gridY", "gridZ", "blockX", "blockY", "blockZ", "correlationId", "start", "end", "deviceId", "streamId", "contextId"]),
+    ("nsys_analyze_runtime_correlation", "CUPTI_ACTIVITY_KIND_RUNTIME",
+     ["correlationId", "start", "end"]),
+    ("nsys_analyze_memcpy_kind", "CUPTI_ACTIVITY_KIND_MEMCPY",
+     ["copyKind", "bytes", "start", "end"]),
+    # Range scans of the --start/--end/--skip-first time windows
+    ("nsys_analyze_kernel_start", "CUPTI_ACTIVITY_KIND_KERNEL", ["start"]),
+    ("nsys_analyze_memcpy_start", "CUPTI_ACTIVITY_KIND_MEMCPY", ["start"]),
+]
+#######################################################
+def sidecar_path(database_file):
+    return os.path.splitext(database_file)[0] + ".idx.sqlite"
+#######################################################
+def existing_tables(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return set(row[0] for row in cursor.fetchall())
+#######################################################
+def build_indexes(database_file, sidecar=False):
+    if sidecar:
+        # Copy the report into the sidecar, the report itself is only read
+        target_file = sidecar_path(database_file)
+        if os.path.exists(target_file):
+            os.remove(target_file)
+        source = sqlite3.connect("file:" + database_file + "?mode=ro", uri=True)
+        connection = sqlite3.connect(target_file)
+        source.backup(connection)
+        source.close()
+    else:
+        target_file = database_file
+        connection = sqlite3.connect(target_file)
+
+    cursor = connection.cursor()
+    tables = existing_tables(cursor)
+    for name, table, columns in INDEXES:
+        if table not in tables:
+            continue
+        print("Building index", name, "on", table)
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, ', '.join('"%s"' % c for c in columns)))
+    cursor.execute("ANALYZE")
+    connection.commit()
+    connection.close()
+    return target_file
+#######################################################
+def find_indexed_report(database_file):
+    # Prefer a sidecar that was built after the report was last written
+    target_file = sidecar_path(database_file)
+    if os.path.exists(target_file) and os.path.getmtime(target_file) >= os.path.getmtime(database_file):
+        return target_file
+    return database_file
+#######################################################
+def has_leading_index(cursor, table, column):
+    # Whether an index of the table, ours or not, starts with the column,
+    # so that lookups by its values do not read the whole table
+    cursor.execute("SELECT name FROM pragma_index_list(?)", (table,))
+    for (name,) in cursor.fetchall():
+        cursor.execute("SELECT name FROM pragma_index_info(?) WHERE seqno = 0", (name,))
+        if cursor.fetchone() == (column,):
+            return True
+    return False
+#######################################################
+def report_query_plan(cursor, label, query, params=()):
+    cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+    details = [row[-1] for row in cursor.fetchall()]
+    used = sorted(name for name, _, _ in INDEXES if any(name in d for d in details))
+    if used:
+        print("Query plan (%s): using %s" % (label, ", ".join(used)))
+    else:
+        print("Query plan (%s): no report index used, run with --build-index to create them" % label)
+    for detail in details:
+        print("    " + detail)
+    return used
+#######################################################
+def add_index_arguments(parser):
+    parser.add_argument("--build-index", action="store_true", help="create the report indexes before the analysis")
+    parser.add_argument("--sidecar", action="store_true", help="with --build-index, write the indexes to <report>.idx.sqlite")
+#######################################################
+def resolve_report(args):
+    if os.path.isdir(args.database_file):
+        # Arrow/Parquet reports, see report_reader.py
+        if args.build_index:
+            print("Arrow/Parquet reports have no indexes, reading", args.database_file, "as it is")
+        return args.database_file
+    if args.build_index:
+        return build_indexes(args.database_file, args.sidecar)
+    return find_indexed_report(args.database_file)
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    parser.add_argument("--sidecar", action="store_true", help="write the indexes to a copy of the report")
+    args = parser.parse_args()
+
+    print("Indexed report:", build_indexes(args.database_file, args.sidecar))
@@ -0,0 +1,130 @@
+#This module times the stages of a script for --profile and --cprofile.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Stage instrumentation shared by the scripts. The stages (query,
+# fetch, aggregation, outlier filtering, every figure ...) are wrapped in
+# "with profiling.stage(name):" and, with --profile, their wall time, CPU
+# time, rows, allocated bytes and peak traced memory are summed per stage
+# path (e.g. "extract_metrics/fetch") and written as json. Allocations are
+# traced with tracemalloc, which NumPy reports its buffers to. Without
+# --profile stage() returns one shared do-nothing context manager, so the
+# instrumented code pays a function call per stage and nothing else.
+# --cprofile additionally dumps a cProfile/pstats file.
+#########################################################################
+import json
+import time
+import resource
+import tracemalloc
+#######################################################
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+#######################################################
+class Stage:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        profile = self.profile
+        current, peak = tracemalloc.get_traced_memory()
+        if profile["stack"]:
+            # The peak of the enclosing stage so far, before it is reset
+            parent = profile["stack"][-1]
+            parent.child_peak = max(parent.child_peak, peak)
+        self.path = "/".join([stage.name for stage in profile["stack"]] + [self.name])
+        self.rows = 0
+        self.child_peak = 0
+        self.start_memory = current
+        profile["stack"].append(self)
+        tracemalloc.reset_peak()
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, self.child_peak)
+        profile = self.profile
+        profile["stack"].pop()
+        if profile["stack"]:
+            parent = profile["stack"][-1]
+            parent.child_peak = max(parent.child_peak, peak)
+
+        record = profile["stages"].setdefault(self.path, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows": 0, "allocated_bytes": 0, "peak_bytes": 0})
+        record["calls"] += 1
+        record["wall_s"] += wall
+        record["cpu_s"] += cpu
+        record["rows"] += self.rows
+        record["allocated_bytes"] += max(current - self.start_memory, 0)
+        record["peak_bytes"] = max(record["peak_bytes"], peak - self.start_memory)
+        return False
+#######################################################
+NULL_STAGE = NullStage()
+# The running profile, None when profiling is off
+ACTIVE = None
+#######################################################
+def stage(name):
+    if ACTIVE is None:
+        return NULL_STAGE
+    return Stage(ACTIVE, name)
+#######################################################
+def add_rows(num_rows):
+    # Counts rows for the innermost running stage
+    if ACTIVE is not None and ACTIVE["stack"]:
+        ACTIVE["stack"][-1].rows += num_rows
+#######################################################
+def start_profile(profile_file=None, cprofile_file=None):
+    global ACTIVE
+    if profile_file is None and cprofile_file is None:
+        return
+    ACTIVE = {"profile_file": profile_file, "cprofile_file": cprofile_file, "stack": [], "stages": {}, "profiler": None, "start_wall": time.perf_counter()}
+    if profile_file is not None:
+        tracemalloc.start()
+    if cprofile_file is not None:
+        import cProfile
+        ACTIVE["profiler"] = cProfile.Profile()
+        ACTIVE["profiler"].enable()
+#######################################################
+def finish_profile():
+    global ACTIVE
+    if ACTIVE is None:
+        return
+    profile, ACTIVE = ACTIVE, None
+    if profile["profiler"] is not None:
+        profile["profiler"].disable()
+        profile["profiler"].dump_stats(profile["cprofile_file"])
+        print("Wrote", profile["cprofile_file"], "(read it with python3 -m pstats)")
+    if profile["profile_file"] is not None:
+        tracemalloc.stop()
+        result = {
+            "wall_s": time.perf_counter() - profile["start_wall"],
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "stages": profile["stages"],
+        }
+        with open(profile["profile_file"], "w") as f:
+            json.dump(result, f, indent=1)
+        print("Wrote", profile["profile_file"])
+#######################################################
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", metavar="JSON", help="write wall/CPU time, rows and memory of every stage to this json file")
+    parser.add_argument("--cprofile", metavar="PSTATS", help="also dump a cProfile of the whole run to this file")
@@ -0,0 +1,111 @@
+#This module writes the progress and ETA of the long phases of a run to stderr.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Progress of the long phases of a run (the launch scan in rows, the
+# statistics in configs), written to stderr with the rate and an ETA from
+# the rate of the phase so far. On a terminal one line is redrawn a few
+# times per second, otherwise (e.g. the log of a batch job) a line is
+# written every LOG_INTERVAL seconds. Like profiling.stage(), phase() and
+# advance() do nothing while no progress was started, and in the worker
+# processes of -j, which only the parent reports for.
+#########################################################################
+import os
+import sys
+import time
+#######################################################
+TERMINAL_INTERVAL = 0.5
+LOG_INTERVAL = 30
+# The running progress, None when it is off
+ACTIVE = None
+#######################################################
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+#######################################################
+def progress_line(progress, now):
+    elapsed = now - progress["start"]
+    done = progress["done"] - progress["initial"]
+    line = "%s: %d" % (progress["name"], progress["done"])
+    if progress["total"]:
+        line += "/%d %s (%.1f%%)" % (progress["total"], progress["unit"], 100 * min(progress["done"] / progress["total"], 1))
+    else:
+        line += " " + progress["unit"]
+    line += ", elapsed %s" % format_duration(elapsed)
+    if done > 0 and elapsed > 0:
+        line += ", %.0f %s/s" % (done / elapsed, progress["unit"])
+        if progress["total"]:
+            line += ", ETA %s" % format_duration(max(progress["total"] - progress["done"], 0) * elapsed / done)
+    return line
+#######################################################
+def report(now, final=False):
+    progress = ACTIVE
+    line = progress_line(progress, now)
+    if progress["terminal"]:
+        # Redrawn in place, padded over the previous line
+        sys.stderr.write("\r" + line.ljust(progress["width"]) + ("\n" if final else ""))
+        progress["width"] = len(line)
+    else:
+        sys.stderr.write(line + "\n")
+    sys.stderr.flush()
+    progress["last"] = now
+#######################################################
+def running():
+    # Forked workers inherit ACTIVE but stay silent
+    return ACTIVE is not None and ACTIVE["pid"] == os.getpid()
+#######################################################
+def phase(name, total=None, unit="rows", done=0):
+    # Starts a phase of total units, done of which were finished already
+    # (e.g. by a resumed run) and do not count for the rate
+    if not running():
+        return
+    end_phase()
+    now = time.perf_counter()
+    ACTIVE.update(name=name, total=total, unit=unit, done=done, initial=done, start=now, last=now, width=0)
+#######################################################
+def advance(count=1):
+    if not running() or ACTIVE["name"] is None:
+        return
+    ACTIVE["done"] += count
+    now = time.perf_counter()
+    if now - ACTIVE["last"] >= ACTIVE["interval"]:
+        report(now)
+#######################################################
+def end_phase():
+    if not running() or ACTIVE["name"] is None:
+        return
+    report(time.perf_counter(), final=True)
+    ACTIVE["name"] = None
+#######################################################
+def start_progress(mode="auto"):
+    # mode is "auto" (on a terminal only), "on" or "off"
+    global ACTIVE
+    terminal = sys.stderr.isatty()
+    if mode == "off" or (mode == "auto" and not terminal):
+        return
+    ACTIVE = {"terminal": terminal, "interval": TERMINAL_INTERVAL if terminal else LOG_INTERVAL, "name": None, "pid": os.getpid()}
+#######################################################
+def finish_progress():
+    global ACTIVE
+    end_phase()
+    ACTIVE = None
+#######################################################
+def add_progress_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--progress", action="store_const", const="on", dest="progress", default="auto", help="report the progress and ETA on stderr even when it is not a terminal")
+    group.add_argument("--no-progress", action="store_const", const="off", dest="progress", help="do not report the progress")
+#######################################################
+def progress_mode(args):
+    return args.progress
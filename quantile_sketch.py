@@ -0,0 +1,140 @@
+#This module keeps relative-error quantile sketches for many groups at once.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Relative-error quantile sketches (the DDSketch scheme) for many
+# groups at once. A positive value x goes to bin ceil(log_gamma(x)) with
+# gamma = (1 + a) / (1 - a), and every quantile read from the bins is
+# within a relative error a of the exact one. A sketch only keeps the
+# occupied (group, bin) pairs with their counts, so its size depends on
+# the spread of the values and not on how many were added. Sketches are
+# merged by adding counts.
+#########################################################################
+import argparse
+import math
+import numpy as np
+#######################################################
+BIN_BITS = 21
+BIN_OFFSET = 1 << (BIN_BITS - 1)
+# The sketched values are durations in us of int64 ns timestamps, from
+# 1 ns up to 2^63 ns, their bins have to fit in BIN_BITS
+LOG_VALUE_RANGE = (math.log(1e-3), math.log(2 ** 63 / 1000))
+#######################################################
+def bin_range(relative_error):
+    log_gamma = math.log((1 + relative_error) / (1 - relative_error))
+    return math.ceil(LOG_VALUE_RANGE[0] / log_gamma), math.ceil(LOG_VALUE_RANGE[1] / log_gamma)
+#######################################################
+def check_relative_error(relative_error):
+    if not 0 < relative_error < 1:
+        raise ValueError("the relative error must be between 0 and 1, not %g" % relative_error)
+    low, high = bin_range(relative_error)
+    if low < -BIN_OFFSET or high >= BIN_OFFSET:
+        raise ValueError("the relative error %g is too small, the bins of the durations would not fit in %d bits" % (relative_error, BIN_BITS))
+#######################################################
+def parse_relative_error(value):
+    relative_error = float(value)
+    try:
+        check_relative_error(relative_error)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return relative_error
+#######################################################
+def new_sketch(relative_error):
+    check_relative_error(relative_error)
+    return {
+        "gamma": (1 + relative_error) / (1 - relative_error),
+        "keys": np.empty(0, dtype=np.int64),
+        "counts": np.empty(0, dtype=np.int64),
+    }
+#######################################################
+def merge_keys(keys, counts):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+#######################################################
+def update_sketch(sketch, group_ids, values):
+    # Only positive values can be binned, the callers filter the others
+    bins = np.ceil(np.log(values) / math.log(sketch["gamma"])).astype(np.int64)
+    keys = (group_ids.astype(np.int64) << BIN_BITS) | (bins + BIN_OFFSET)
+    keys, counts = merge_keys(keys, np.ones(len(keys), dtype=np.int64))
+    sketch["keys"], sketch["counts"] = merge_keys(np.concatenate((sketch["keys"], keys)), np.concatenate((sketch["counts"], counts)))
+#######################################################
+def remap_groups(sketch, mapping):
+    # mapping[old group id] = new group id, groups mapped together are merged
+    groups = mapping[sketch["keys"] >> BIN_BITS]
+    keys = (groups << BIN_BITS) | (sketch["keys"] & ((1 << BIN_BITS) - 1))
+    sketch["keys"], sketch["counts"] = merge_keys(keys, sketch["counts"])
+#######################################################
+def group_bins(sketch, group):
+    # Representative values (in bin order) and counts of one group
+    low, high = np.searchsorted(sketch["keys"], [group << BIN_BITS, (group + 1) << BIN_BITS])
+    bins = (sketch["keys"][low:high] & ((1 << BIN_BITS) - 1)) - BIN_OFFSET
+    gamma = sketch["gamma"]
+    values = 2 * gamma ** bins.astype(np.float64) / (gamma + 1)
+    return values, sketch["counts"][low:high]
+#######################################################
+def bin_values(sketch):
+    # Representative value of every occupied bin, as in group_bins
+    bins = (sketch["keys"] & ((1 << BIN_BITS) - 1)) - BIN_OFFSET
+    gamma = sketch["gamma"]
+    return 2 * gamma ** bins.astype(np.float64) / (gamma + 1)
+#######################################################
+def group_counts(sketch, num_groups):
+    return np.bincount(sketch["keys"] >> BIN_BITS, weights=sketch["counts"], minlength=num_groups).astype(np.int64)
+#######################################################
+def group_medians(sketch, num_groups):
+    # quantile(..., 0.5) of every group at once, 0 for the groups without
+    # values: the order statistics are searched in the running count of
+    # all bins, offset by the count of the groups before
+    medians = np.zeros(num_groups)
+    if len(sketch["keys"]) == 0:
+        return medians
+    groups = sketch["keys"] >> BIN_BITS
+    totals = group_counts(sketch, num_groups)
+    cumulative = np.cumsum(sketch["counts"])
+    offsets = np.cumsum(totals) - totals
+    last = np.searchsorted(groups, np.arange(num_groups), side="right") - 1
+    rank = (totals - 1) / 2
+    low = np.floor(rank).astype(np.int64)
+    values = bin_values(sketch)
+    below = values[np.minimum(np.searchsorted(cumulative, offsets + low, side="right"), last)]
+    above = values[np.minimum(np.searchsorted(cumulative, offsets + low + 1, side="right"), last)]
+    present = totals > 0
+    medians[present] = (below + (above - below) * (rank - low))[present]
+    return medians
+#######################################################
+def quantile(values, counts, q):
+    # Same interpolation between order statistics as np.percentile's
+    # default (linear) method, with every order statistic read from its bin
+    cumulative = np.cumsum(counts)
+    rank = q * (cumulative[-1] - 1)
+    low = math.floor(rank)
+    below, above = values[np.searchsorted(cumulative, [low, low + 1], side='right').clip(0, len(values) - 1)]
+    return below + (above - below) * (rank - low)
+#######################################################
+def iqr_filtered(values, counts):
+    Q1 = quantile(values, counts, 0.25)
+    Q3 = quantile(values, counts, 0.75)
+    IQR = Q3 - Q1
+    keep = (values >= Q1 - 1.5 * IQR) & (values <= Q3 + 1.5 * IQR)
+    return values[keep], counts[keep]
+#######################################################
+def filtered_medians(sketch, num_groups):
+    # IQR-filtered median of every group, 0 for the groups without values
+    medians = np.zeros(num_groups)
+    for group in range(num_groups):
+        values, counts = group_bins(sketch, group)
+        if len(values):
+            medians[group] = quantile(*iqr_filtered(values, counts), 0.5)
+    return medians
@@ -0,0 +1,144 @@
+#This module renders the figures to PNG or pgf and skips the unchanged ones.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Render stage shared by the scripts. A figure is described by its
+# file name, a module level draw(plt, *args) function returning the figure
+# and the data it plots. The figures are rendered with Agg to PNG by
+# default, or with the pgf backend (pdflatex) when pgf output is asked for,
+# optionally in a process pool. A hash of the draw code, the data and the
+# style of every figure is kept in .render_hashes.json, and figures whose
+# hash and files are unchanged since the last run are not drawn again.
+# With --no-plot nothing is drawn and matplotlib is not imported.
+#########################################################################
+import os
+import json
+import pickle
+import hashlib
+import concurrent.futures
+import table_export
+import profiling
+#######################################################
+DEFAULT_OPTIONS = {
+    "backend": "agg",
+    "formats": ["png"],
+    "jobs": 1,
+    "force": False,
+    "directory": ".",
+    "plot": True,
+    "table_format": None,
+}
+# rcParams of every backend, pgf keeps the LaTeX setup the scripts had
+STYLES = {
+    "agg": {
+        'font.family': 'serif',
+        'font.size': 14,
+    },
+    "pgf": {
+        "pgf.texsystem": "pdflatex",
+        'font.family': 'serif',
+        'font.size': 14,
+        'text.usetex': True,
+        'pgf.rcfonts': False,
+    },
+}
+HASH_FILE = ".render_hashes.json"
+#######################################################
+def pyplot(backend="agg"):
+    # matplotlib is only imported once something is actually drawn
+    import matplotlib
+    matplotlib.use(backend)
+    matplotlib.rcParams.update(STYLES[backend])
+    import matplotlib.pyplot as plt
+    return plt
+#######################################################
+def figure_hash(draw, args, options):
+    digest = hashlib.sha256()
+    digest.update(draw.__module__.encode() + b"." + draw.__qualname__.encode())
+    digest.update(draw.__code__.co_code)
+    digest.update(repr(draw.__code__.co_consts).encode())
+    digest.update(pickle.dumps(args, protocol=4))
+    digest.update(json.dumps([options["backend"], sorted(options["formats"]), STYLES[options["backend"]]]).encode())
+    return digest.hexdigest()
+#######################################################
+def render_figure(name, draw, args, options):
+    with profiling.stage("import matplotlib"):
+        plt = pyplot(options["backend"])
+    with profiling.stage(name):
+        with profiling.stage("draw"):
+            fig = draw(plt, *args)
+        with profiling.stage("savefig"):
+            for extension in options["formats"]:
+                fig.savefig(os.path.join(options["directory"], name + '.' + extension), bbox_inches='tight')
+        plt.close(fig)
+    return name
+#######################################################
+def load_hashes(options):
+    hash_file = os.path.join(options["directory"], HASH_FILE)
+    if not os.path.exists(hash_file):
+        return {}
+    with open(hash_file) as f:
+        return json.load(f)
+#######################################################
+def render_figures(figures, options=None):
+    # figures is a list of (name, draw, args)
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    if not options["plot"]:
+        return
+    hashes = load_hashes(options)
+    pending = []
+    for name, draw, args in figures:
+        digest = figure_hash(draw, args, options)
+        outputs = [os.path.join(options["directory"], name + '.' + extension) for extension in options["formats"]]
+        if not options["force"] and hashes.get(name) == digest and all(os.path.exists(f) for f in outputs):
+            print("Figure", name, "is unchanged, not rendering it again")
+            continue
+        pending.append((name, draw, args, digest))
+
+    with profiling.stage("render"):
+        if options["jobs"] > 1 and len(pending) > 1:
+            # The stages inside the workers are not recorded
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(options["jobs"], len(pending))) as executor:
+                futures = [executor.submit(render_figure, name, draw, args, options) for name, draw, args, _ in pending]
+                for future in futures:
+                    future.result()
+        else:
+            for name, draw, args, _ in pending:
+                render_figure(name, draw, args, options)
+
+    if pending:
+        hashes = load_hashes(options)
+        hashes.update({name: digest for name, _, _, digest in pending})
+        with open(os.path.join(options["directory"], HASH_FILE), "w") as f:
+            json.dump(hashes, f, indent=1, sort_keys=True)
+#######################################################
+def add_render_arguments(parser):
+    parser.add_argument("--formats", default="png", help="comma separated output formats, e.g. png,pgf,pdf,svg (default png)")
+    parser.add_argument("--backend", choices=sorted(STYLES), default=None, help="matplotlib backend, default pgf when pgf output is asked for and agg otherwise")
+    parser.add_argument("--render-jobs", type=int, default=1, help="render the figures in this many processes")
+    parser.add_argument("--force-render", action="store_true", help="render the figures even when their data did not change")
+    table_export.add_export_arguments(parser)
+#######################################################
+def render_options(args):
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    backend = args.backend or ("pgf" if "pgf" in formats else "agg")
+    return {
+        "backend": backend,
+        "formats": formats,
+        "jobs": args.render_jobs,
+        "force": args.force_render,
+        "plot": not args.no_plot,
+        "table_format": args.format,
+    }
@@ -0,0 +1,344 @@
+#This module caches the extracted report columns as memory-mapped .npy files.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: The columns the scripts extract from a report are kept in
+# <report>.cache/ as one .npy file per column, next to a small json file
+# with the fingerprint (path, size, mtime and schema version) of the
+# report they came from. Later runs memory-map them instead of querying
+# the report again, and a cache whose fingerprint does not match the
+# report any more is removed and rebuilt.
+# The cache also records the last rowid (and the start/end of that row)
+# of the tables it was built from. With --incremental a report that only
+# had rows appended since, e.g. a re-export of a running job, is not
+# rebuilt: only the rows after these watermarks are read and appended.
+# Arrow/Parquet reports (see report_reader.py) are read directly.
+#########################################################################
+import os
+import json
+import functools
+import numpy as np
+import profiling
+import time_window
+import report_reader
+#######################################################
+CACHE_SCHEMA_VERSION = 3
+#######################################################
+def cache_dir(database_file):
+    return database_file + ".cache"
+#######################################################
+def report_fingerprint(database_file):
+    stat = os.stat(database_file)
+    return {
+        "path": os.path.abspath(database_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "schema_version": CACHE_SCHEMA_VERSION,
+    }
+#######################################################
+def remove_columns(database_file, name):
+    directory = cache_dir(database_file)
+    if not os.path.isdir(directory):
+        return
+    for file_name in os.listdir(directory):
+        if file_name == name + ".json" or file_name.startswith(name + "."):
+            os.remove(os.path.join(directory, file_name))
+#######################################################
+def read_meta(database_file, name):
+    meta_file = os.path.join(cache_dir(database_file), name + ".json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+#######################################################
+def open_columns(database_file, name, meta):
+    columns = {}
+    for column in meta["columns"]:
+        column_file = os.path.join(cache_dir(database_file), "%s.%s.npy" % (name, column))
+        columns[column] = np.load(column_file, mmap_mode="r")
+    return columns
+#######################################################
+def load_columns(database_file, name):
+    meta = read_meta(database_file, name)
+    if meta is None:
+        return None
+    if meta["fingerprint"] != report_fingerprint(database_file):
+        print("Cache of", name, "columns is stale, rebuilding it")
+        remove_columns(database_file, name)
+        return None
+    return open_columns(database_file, name, meta)
+#######################################################
+def row_signature(cursor, table, rowid):
+    cursor.execute("SELECT start, end FROM %s WHERE rowid = ?" % table, (rowid,))
+    row = cursor.fetchone()
+    return list(row) if row is not None else None
+#######################################################
+def table_watermarks(database_file, tables):
+    # Last rowid of every table, with the start and end of that row to tell
+    # an appended report from a different one later
+    connection = report_reader.connect(database_file)
+    cursor = connection.cursor()
+    try:
+        watermarks = {}
+        for table in tables:
+            cursor.execute("SELECT MAX(rowid) FROM %s" % table)
+            rowid = cursor.fetchone()[0] or 0
+            watermarks[table] = {"rowid": rowid, "signature": row_signature(cursor, table, rowid)}
+    finally:
+        connection.close()
+    return watermarks
+#######################################################
+def watermarks_match(database_file, watermarks):
+    connection = report_reader.connect(database_file)
+    cursor = connection.cursor()
+    try:
+        return all(row_signature(cursor, table, mark["rowid"]) == mark["signature"] for table, mark in watermarks.items())
+    finally:
+        connection.close()
+#######################################################
+def extend_columns(database_file, name, extend):
+    # Appends the rows after the watermarks to a stale cache of a report
+    # that only grew, returns None when the cache cannot be extended
+    meta = read_meta(database_file, name)
+    fingerprint = report_fingerprint(database_file)
+    if meta is None or not meta.get("watermarks") or meta["fingerprint"] == fingerprint:
+        return None
+    if meta["fingerprint"]["path"] != fingerprint["path"] or meta["fingerprint"]["schema_version"] != CACHE_SCHEMA_VERSION:
+        return None
+    if not watermarks_match(database_file, meta["watermarks"]):
+        print("Report changed before the last analysed row, rebuilding the", name, "cache")
+        return None
+
+    watermarks = table_watermarks(database_file, meta["watermarks"])
+    with profiling.stage("cache extend"):
+        columns = extend(database_file, open_columns(database_file, name, meta), meta["watermarks"], watermarks)
+    print("Extended the", name, "cache with the rows after", ', '.join("%s rowid %d" % (table, mark["rowid"]) for table, mark in meta["watermarks"].items()))
+    save_columns(database_file, name, columns, watermarks)
+    return columns
+#######################################################
+def save_columns(database_file, name, columns, watermarks=None):
+    directory = cache_dir(database_file)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        remove_columns(database_file, name)
+        for column, values in columns.items():
+            column_file = os.path.join(directory, "%s.%s.npy" % (name, column))
+            np.save(column_file + ".tmp.npy", np.asarray(values))
+            os.replace(column_file + ".tmp.npy", column_file)
+
+        write_meta(database_file, name, list(columns), watermarks)
+    except OSError as error:
+        print("Could not write the column cache:", error)
+#######################################################
+def write_meta(database_file, name, columns, watermarks=None):
+    # The json file is written last, a cache without it is never read
+    directory = cache_dir(database_file)
+    meta = {"fingerprint": report_fingerprint(database_file), "columns": columns, "watermarks": watermarks}
+    with open(os.path.join(directory, name + ".json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, name + ".json.tmp"), os.path.join(directory, name + ".json"))
+#######################################################
+def cached_columns(database_file, name, extract, use_cache=True, extend=None, tables=()):
+    # extract(database_file) returns a dict of numpy arrays, and
+    # extend(database_file, columns, old watermarks, new watermarks) the
+    # same columns with the rows of tables after the old watermarks appended.
+    # use_cache is False, True or "incremental" (see cache_mode). Arrow and
+    # Parquet reports are columnar already and are never cached
+    if report_reader.is_arrow_report(database_file):
+        use_cache = False
+    if use_cache == "incremental" and extend is not None:
+        columns = extend_columns(database_file, name, extend)
+        if columns is not None:
+            return columns
+    if use_cache:
+        with profiling.stage("cache load"):
+            columns = load_columns(database_file, name)
+        if columns is not None:
+            return columns
+    # The watermarks are taken before the scan, rows appended during it are
+    # read again by the next extension rather than missed
+    watermarks = table_watermarks(database_file, tables) if use_cache and tables else None
+    with profiling.stage(name + " columns"):
+        columns = extract(database_file)
+    if use_cache:
+        with profiling.stage("cache save"):
+            save_columns(database_file, name, columns, watermarks)
+    return columns
+#######################################################
+MEMCPY_COLUMNS = ("bytes", "start", "end", "copyKind", "deviceId")
+KERNEL_INTERVAL_COLUMNS = ("start", "end", "deviceId", "streamId")
+# Columns narrower than int64
+COLUMN_TYPES = {"copyKind": np.int8, "deviceId": np.int32, "streamId": np.int32, "contextId": np.int32}
+# The tables and columns behind them, for report_reader.check_report
+MEMCPY_TABLES = {"CUPTI_ACTIVITY_KIND_MEMCPY": MEMCPY_COLUMNS}
+KERNEL_INTERVAL_TABLES = {"CUPTI_ACTIVITY_KIND_KERNEL": KERNEL_INTERVAL_COLUMNS}
+#######################################################
+def new_rows(old_watermarks, watermarks, table):
+    # The rowid range after the old watermark of a table
+    return {"rowid": (old_watermarks[table]["rowid"] + 1, watermarks[table]["rowid"] + 1)}
+#######################################################
+def memcpy_cache_name(copy_kind=None):
+    # The transfers of one copyKind are cached apart from those of all kinds
+    return "memcpy" if copy_kind is None else "memcpy_kind%d" % copy_kind
+#######################################################
+def memcpy_filter(copy_kind=None):
+    return {"copyKind": [copy_kind]} if copy_kind is not None else None
+#######################################################
+def extract_memcpy_columns(database_file, window=None, copy_kind=None):
+    return report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", MEMCPY_COLUMNS, where=memcpy_filter(copy_kind), ranges={"start": window} if window is not None else None, label="memcpy", dtypes=COLUMN_TYPES)
+#######################################################
+def extend_memcpy_columns(database_file, columns, old_watermarks, watermarks, copy_kind=None):
+    transfers = report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", MEMCPY_COLUMNS, where=memcpy_filter(copy_kind), ranges=new_rows(old_watermarks, watermarks, "CUPTI_ACTIVITY_KIND_MEMCPY"), dtypes=COLUMN_TYPES)
+    return {column: np.concatenate((columns[column], transfers[column])) for column in MEMCPY_COLUMNS}
+#######################################################
+def fresh_columns(database_file, name):
+    # The cached columns when they match the report, a stale cache is left
+    # alone (unlike load_columns)
+    meta = read_meta(database_file, name)
+    if meta is None or meta["fingerprint"] != report_fingerprint(database_file):
+        return None
+    return open_columns(database_file, name, meta)
+#######################################################
+def select_transfers(columns, copy_kind=None, window=None):
+    mask = np.ones(len(columns["start"]), dtype=bool)
+    if copy_kind is not None:
+        mask &= columns["copyKind"] == copy_kind
+    if window is not None:
+        mask &= time_window.window_mask(columns["start"], window)
+    return {column: values[mask] for column, values in columns.items()}
+#######################################################
+def load_memcpy_columns(database_file, use_cache=True, window=None, copy_kind=None):
+    # With a copy_kind only the transfers of that kind are read, through the
+    # copyKind index of --build-index, and cached on their own. A cache of
+    # all the kinds is used instead when there is an up to date one
+    if copy_kind is not None and use_cache:
+        columns = fresh_columns(database_file, "memcpy")
+        if columns is not None:
+            return select_transfers(columns, copy_kind, window)
+    name = memcpy_cache_name(copy_kind)
+    if window is not None:
+        # A slice of the cached columns when there are any, otherwise only
+        # the slice is read from the report and it is not cached
+        columns = load_columns(database_file, name) if use_cache else None
+        if columns is None:
+            return extract_memcpy_columns(database_file, window, copy_kind)
+        return select_transfers(columns, window=window)
+    return cached_columns(database_file, name, functools.partial(extract_memcpy_columns, copy_kind=copy_kind), use_cache,
+        functools.partial(extend_memcpy_columns, copy_kind=copy_kind), ["CUPTI_ACTIVITY_KIND_MEMCPY"])
+#######################################################
+def count_transfers(database_file, copy_kind, last_rowid):
+    connection = report_reader.connect(database_file)
+    try:
+        return connection.execute("SELECT COUNT(*) FROM CUPTI_ACTIVITY_KIND_MEMCPY WHERE copyKind = ? AND rowid <= ?", (copy_kind, last_rowid)).fetchone()[0]
+    finally:
+        connection.close()
+#######################################################
+def stream_memcpy_cache(database_file, copy_kind):
+    # Yields the columns of the transfers of one copyKind in chunks while
+    # they are written to its cache: the rows up to the current watermark
+    # are counted first (an index search with --build-index), the .npy files
+    # are memory-mapped with that length and filled chunk by chunk, so the
+    # whole table is never held in memory. The cache is only completed when
+    # every chunk was read
+    name = memcpy_cache_name(copy_kind)
+    watermarks = table_watermarks(database_file, ["CUPTI_ACTIVITY_KIND_MEMCPY"])
+    last_rowid = watermarks["CUPTI_ACTIVITY_KIND_MEMCPY"]["rowid"]
+    files = {}
+    try:
+        num_rows = count_transfers(database_file, copy_kind, last_rowid)
+        os.makedirs(cache_dir(database_file), exist_ok=True)
+        remove_columns(database_file, name)
+        for column in MEMCPY_COLUMNS:
+            column_file = os.path.join(cache_dir(database_file), "%s.%s.npy" % (name, column))
+            files[column] = (column_file, np.lib.format.open_memmap(column_file + ".tmp.npy", mode="w+", dtype=COLUMN_TYPES.get(column, np.int64), shape=(num_rows,)))
+    except OSError as error:
+        print("Could not write the column cache:", error)
+        files = {}
+    batches = report_reader.iter_column_batches(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", MEMCPY_COLUMNS, where=memcpy_filter(copy_kind),
+        ranges={"rowid": (0, last_rowid + 1)}, label="memcpy", dtypes=COLUMN_TYPES)
+    written = 0
+    for batch in batches:
+        if files and written + len(batch["start"]) <= num_rows:
+            for column, (_, values) in files.items():
+                values[written:written + len(batch["start"])] = batch[column]
+        written += len(batch["start"])
+        yield batch
+    if not files or written != num_rows:
+        return
+    try:
+        for _, values in files.values():
+            values.flush()
+        column_files = [column_file for column_file, _ in files.values()]
+        files = {}
+        for column_file in column_files:
+            os.replace(column_file + ".tmp.npy", column_file)
+        write_meta(database_file, name, list(MEMCPY_COLUMNS), watermarks)
+    except OSError as error:
+        print("Could not write the column cache:", error)
+#######################################################
+def iter_memcpy_chunks(database_file, copy_kind, use_cache=True, chunk_size=1000000, window=None):
+    # Yields (bytes, start, end) of one copyKind, chunk_size rows at a time
+    # from the memory-mapped cache, or report_reader.FETCH_SIZE rows at a
+    # time straight from the report. A run without a cache streams from the
+    # report and, for the whole report, fills the cache of that copyKind as
+    # it goes
+    columns = None
+    if use_cache and not report_reader.is_arrow_report(database_file):
+        columns = fresh_columns(database_file, "memcpy")
+        if columns is None:
+            columns = load_columns(database_file, memcpy_cache_name(copy_kind))
+        if columns is None and window is None:
+            for batch in stream_memcpy_cache(database_file, copy_kind):
+                yield batch["bytes"], batch["start"], batch["end"]
+            return
+    if columns is not None:
+        for i in range(0, len(columns["copyKind"]), chunk_size):
+            mask = columns["copyKind"][i:i+chunk_size] == copy_kind
+            if window is not None:
+                mask &= time_window.window_mask(columns["start"][i:i+chunk_size], window)
+            yield columns["bytes"][i:i+chunk_size][mask], columns["start"][i:i+chunk_size][mask], columns["end"][i:i+chunk_size][mask]
+        return
+
+    batches = report_reader.iter_column_batches(database_file, "CUPTI_ACTIVITY_KIND_MEMCPY", ("bytes", "start", "end"), where=memcpy_filter(copy_kind),
+        ranges={"start": window} if window is not None else None, label="memcpy")
+    for batch in batches:
+        yield batch["bytes"], batch["start"], batch["end"]
+#######################################################
+def extract_kernel_intervals(database_file, window=None):
+    return report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_KERNEL", KERNEL_INTERVAL_COLUMNS, ranges={"start": window} if window is not None else None, label="kernel intervals", dtypes=COLUMN_TYPES)
+#######################################################
+def extend_kernel_intervals(database_file, columns, old_watermarks, watermarks):
+    kernels = report_reader.read_columns(database_file, "CUPTI_ACTIVITY_KIND_KERNEL", KERNEL_INTERVAL_COLUMNS, ranges=new_rows(old_watermarks, watermarks, "CUPTI_ACTIVITY_KIND_KERNEL"), dtypes=COLUMN_TYPES)
+    return {column: np.concatenate((columns[column], kernels[column])) for column in KERNEL_INTERVAL_COLUMNS}
+#######################################################
+def load_kernel_intervals(database_file, use_cache=True, window=None):
+    # start, end, deviceId and streamId of every kernel, like the memcpy
+    # columns above
+    if window is not None:
+        columns = load_columns(database_file, "kernel_intervals") if use_cache else None
+        if columns is None:
+            return extract_kernel_intervals(database_file, window)
+        mask = time_window.window_mask(columns["start"], window)
+        return {column: values[mask] for column, values in columns.items()}
+    return cached_columns(database_file, "kernel_intervals", extract_kernel_intervals, use_cache, extend_kernel_intervals, ["CUPTI_ACTIVITY_KIND_KERNEL"])
+#######################################################
+def add_cache_arguments(parser):
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the column cache next to the report")
+    parser.add_argument("--incremental", action="store_true", help="when the report only had rows appended since the cache was built, read just the new rows")
+#######################################################
+def cache_mode(args):
+    if args.no_cache:
+        return False
+    return "incremental" if args.incremental else True
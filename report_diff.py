@@ -0,0 +1,458 @@
+#This script compares the kernel and memcpy metrics of two reports.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 report_diff.py [--no-cache | --incremental] [-j JOBS] [--log2-edges LOW:HIGH] [--alpha A] [--min-change PCT] [--num-printed N] [--demangle] [--formats png,pgf] [--format json|csv|parquet] [--no-plot] [--profile JSON] [--cprofile PSTATS] <baseline> <candidate>
+
+#Note: Compares two reports, e.g. of the runs before and after a commit.
+# Each of them is reduced once to a summary of per-config statistics
+# (ket, klo, slack, dominance and the 95% intervals of the medians) and
+# of per-bucket memcpy bandwidths, kept with the column cache in
+# <report>.cache/. <baseline> and <candidate> are reports, or the
+# <report>.cache directories of reports that are gone. Kernel configs are
+# matched by name (a 64-bit hash of it) and launch dimensions, the
+# transfers by direction, host memory kind and size bucket, both with one
+# sorted join of packed integer keys, so once the summaries exist the
+# diff itself takes milliseconds. A change is significant when its
+# Benjamini-Hochberg q-value is below --alpha and it is at least
+# --min-change percent.
+#########################################################################
+import os
+import sys
+import math
+import sqlite3
+import hashlib
+import argparse
+import functools
+import numpy as np
+import kernel_metrics
+import memcpy_analyze
+import report_cache
+import report_reader
+import nsys_index
+import render
+import table_export
+import profiling
+#######################################################
+KERNEL_METRICS = ("ket", "klo", "slack")
+# Configs with fewer launches on either side are not tested
+MIN_TEST_LAUNCHES = 10
+MEMCPY_COLUMNS = ("count", "bytes", "bw_mean", "bw_std", "bw_aggregate")
+MEMORY_NAMES = list(memcpy_analyze.MEMORY_KINDS.values()) + ["all"]
+COPY_KIND_IDS = {name: kind for kind, name in memcpy_analyze.COPY_KINDS.items()}
+NUM_PLOTTED = 50
+#######################################################
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little", signed=True)
+#######################################################
+def kernel_summary(database_file, use_cache=True, jobs=1):
+    # Per config: the identity (index of the name, launch dimensions), the
+    # launches and the kernel_metrics statistics with the intervals of the
+    # medians. The names are kept once each, as utf-8 bytes with their
+    # offsets, next to their hashes the configs are joined by
+    if jobs > 1:
+        extract = functools.partial(kernel_metrics.parallel_kernel_columns, jobs=jobs)
+    else:
+        extract = kernel_metrics.extract_kernel_columns
+    columns = report_cache.cached_columns(database_file, "kernel", extract, use_cache, kernel_metrics.extend_kernel_columns, kernel_metrics.KERNEL_TABLES)
+    launches = np.bincount(columns["config_ids"], minlength=len(columns["config_keys"]))
+    intervals = kernel_metrics.sample_intervals(columns, 1.0)
+    config_keys, *statistics, dominant_list = kernel_metrics.column_statistics(columns)
+    name_ids, name_index = np.unique(config_keys[:, 0], return_inverse=True)
+    names = [name.encode() for name in report_reader.decode_strings(report_reader.string_table(database_file), name_ids)]
+    summary = {
+        "identity": np.column_stack((name_index.ravel(), config_keys[:, 1:])).astype(np.int64),
+        "name_hashes": np.array([name_hash(name) for name in names], dtype=np.int64),
+        "name_bytes": np.frombuffer(b"".join(names), dtype=np.uint8),
+        "name_offsets": np.concatenate(([0], np.cumsum([len(name) for name in names], dtype=np.int64))).astype(np.int64),
+        "launches": launches.astype(np.int64),
+        "dominance": np.asarray(dominant_list, dtype=np.float64),
+    }
+    for metric, values in zip(KERNEL_METRICS, statistics):
+        summary[metric] = np.asarray(values, dtype=np.float64)
+        summary[metric + "_low"] = intervals[metric][:, 0]
+        summary[metric + "_high"] = intervals[metric][:, 1]
+    return summary
+#######################################################
+def memcpy_summary(database_file, edges):
+    # The memcpy_analyze summary rows as columns, keyed by (copyKind, host
+    # memory kind, bucket)
+    rows = memcpy_analyze.summarize_memcpy(database_file, edges)
+    summary = {"keys": np.array([(COPY_KIND_IDS[row["direction"]], MEMORY_NAMES.index(row["memory"]), row["bucket"]) for row in rows], dtype=np.int64).reshape(-1, 3)}
+    for column in MEMCPY_COLUMNS:
+        summary[column] = np.array([row[column] for row in rows], dtype=np.float64)
+    return summary
+#######################################################
+def memcpy_summary_name(edges):
+    # The buckets depend on the edges, so does the cached summary
+    return "memcpy_summary_%d_%d" % (edges[0].bit_length() - 1, edges[-1].bit_length() - 1)
+#######################################################
+def summary_report(argument):
+    # The report of a <report>.cache directory, None for a report
+    argument = argument.rstrip(os.sep)
+    if argument.endswith(".cache") and os.path.isdir(argument):
+        return argument[:-len(".cache")]
+    return None
+#######################################################
+def load_summary(argument, name, extract, use_cache=True):
+    # The cached summary of a report, computed and cached when there is
+    # none, or the summary saved in a <report>.cache directory as it is
+    report = summary_report(argument)
+    if report is not None:
+        meta = report_cache.read_meta(report, name)
+        return report_cache.open_columns(report, name, meta) if meta is not None else None
+    return report_cache.cached_columns(argument, name, extract, use_cache)
+#######################################################
+def resolve_argument(argument):
+    # Reports are checked and their indexed sidecar used when there is one
+    if summary_report(argument) is not None:
+        return argument
+    if not os.path.exists(argument):
+        print("No report or summary", argument)
+        sys.exit(1)
+    if not os.path.isdir(argument):
+        argument = nsys_index.find_indexed_report(argument)
+    report_reader.check_report(argument, kernel_metrics.REPORT_TABLES)
+    return argument
+#######################################################
+def has_memcpy(argument):
+    return summary_report(argument) is not None or not report_reader.missing_columns(argument, memcpy_analyze.REPORT_TABLES)
+#######################################################
+def row_hashes(keys):
+    # One 64-bit hash per key row, mixed column by column
+    hashes = np.zeros(len(keys), dtype=np.uint64)
+    for column in range(keys.shape[1]):
+        hashes ^= keys[:, column].astype(np.uint64)
+        hashes *= np.uint64(0x9E3779B97F4A7C15)
+        hashes ^= hashes >> np.uint64(29)
+    return hashes.view(np.int64)
+#######################################################
+def sorted_join(packed, num_a):
+    # One stable sort of the keys of a (the first num_a) and b, where every
+    # matched key of a sits right before its match in b. None when a key
+    # repeats within a or b, which only hash collisions cause
+    order = np.argsort(packed, kind="stable")
+    equal = np.flatnonzero(packed[order[1:]] == packed[order[:-1]])
+    left = order[equal]
+    right = order[equal + 1]
+    if np.any(left >= num_a) or np.any(right < num_a):
+        return None
+    matched = np.zeros(len(packed), dtype=bool)
+    matched[left] = True
+    matched[right] = True
+    return left, right - num_a, np.flatnonzero(~matched[:num_a]), np.flatnonzero(~matched[num_a:])
+#######################################################
+def join_keys(keys_a, keys_b):
+    # Join of two sets of distinct integer key rows on one int64 per row:
+    # the rows of both packed with the same offsets and widths (see
+    # kernel_metrics.pack_config_keys), or their row_hashes when they need
+    # more than 63 bits. The rows of hashed matches are compared, and
+    # np.unique of the rows is the fallback of a collision. Returns the
+    # matched positions in a and b and the unmatched ones
+    keys = np.concatenate((keys_a, keys_b))
+    packed = kernel_metrics.pack_config_keys(keys) if len(keys) > 0 else np.empty(0, dtype=np.int64)
+    hashed = packed is None
+    joined = sorted_join(row_hashes(keys) if hashed else packed, len(keys_a))
+    if joined is None or (hashed and np.any(keys_a[joined[0]] != keys_b[joined[1]])):
+        joined = sorted_join(np.unique(keys, axis=0, return_inverse=True)[1].ravel(), len(keys_a))
+    return joined
+#######################################################
+def config_join_keys(base, candidate):
+    # The names of both summaries are numbered together through their
+    # hashes, so the identities of both use the same name numbers
+    _, names = np.unique(np.concatenate((base["name_hashes"], candidate["name_hashes"])), return_inverse=True)
+    names = names.ravel()
+    keys_a = np.array(base["identity"])
+    keys_b = np.array(candidate["identity"])
+    keys_a[:, 0] = names[:len(base["name_hashes"])][keys_a[:, 0]]
+    keys_b[:, 0] = names[len(base["name_hashes"]):][keys_b[:, 0]]
+    return keys_a, keys_b
+#######################################################
+def p_values(z):
+    # Two-sided p-values of standard normal z scores, nan stays nan. erfc
+    # of |z| / sqrt(2) by the Chebyshev fit of Numerical Recipes (erfcc),
+    # with a relative error below 1.2e-7 for every argument
+    x = np.abs(z) / math.sqrt(2)
+    t = 1 / (1 + 0.5 * x)
+    polynomial = -1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))))))))
+    with np.errstate(over="ignore", invalid="ignore"):
+        return t * np.exp(-x * x + polynomial)
+#######################################################
+def q_values(p):
+    # Benjamini-Hochberg adjusted p-values of the tested (not nan) ones
+    q = np.full(len(p), np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    if len(tested) == 0:
+        return q
+    order = np.argsort(p[tested])
+    ranked = p[tested][order] * len(tested) / np.arange(1, len(tested) + 1)
+    q[tested[order]] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return q
+#######################################################
+def median_se(summary, metric, index):
+    # Standard error of a log10 median from the width of its 95% interval
+    return (summary[metric + "_high"][index] - summary[metric + "_low"][index]) / (2 * report_reader.SAMPLE_Z)
+#######################################################
+def kernel_diff(base, candidate, alpha, min_change):
+    # Deltas of the matched configs: of the log10 medians (log10 of the
+    # ratio of the medians) with the q-values of their z tests, and of the
+    # dominance in us. significant marks the changes of q < alpha and at
+    # least min_change percent in any metric
+    with profiling.stage("join"):
+        index_a, index_b, only_a, only_b = join_keys(*config_join_keys(base, candidate))
+    launches_a = base["launches"][index_a]
+    launches_b = candidate["launches"][index_b]
+    testable = (launches_a >= MIN_TEST_LAUNCHES) & (launches_b >= MIN_TEST_LAUNCHES)
+    diff = {"index_a": index_a, "index_b": index_b, "only_a": only_a, "only_b": only_b, "launches_a": launches_a, "launches_b": launches_b}
+    significant = np.zeros(len(index_a), dtype=bool)
+    with profiling.stage("tests"):
+        for metric in KERNEL_METRICS:
+            delta = candidate[metric][index_b] - base[metric][index_a]
+            se = np.hypot(median_se(base, metric, index_a), median_se(candidate, metric, index_b))
+            z = np.full(len(delta), np.nan)
+            np.divide(delta, se, out=z, where=testable & (se > 0))
+            # Medians whose intervals have no width differ for sure
+            z[testable & (se == 0) & (delta != 0)] = np.inf
+            z[testable & (se == 0) & (delta == 0)] = 0
+            diff[metric + "_delta"] = delta
+            diff[metric + "_q"] = q_values(p_values(z))
+            diff[metric + "_significant"] = (diff[metric + "_q"] < alpha) & (np.abs(percent_change(delta)) >= min_change)
+            significant |= diff[metric + "_significant"]
+    diff["dominance_a"] = base["dominance"][index_a]
+    diff["dominance_b"] = candidate["dominance"][index_b]
+    diff["dominance_delta"] = diff["dominance_b"] - diff["dominance_a"]
+    diff["significant"] = significant
+    return diff
+#######################################################
+def memcpy_diff(base, candidate, alpha, min_change):
+    # Deltas of the mean bandwidth per bucket with the q-values of Welch's
+    # z tests, and of the aggregate bandwidth
+    index_a, index_b, only_a, only_b = join_keys(base["keys"], candidate["keys"])
+    n_a = base["count"][index_a]
+    n_b = candidate["count"][index_b]
+    mean_a = base["bw_mean"][index_a]
+    mean_b = candidate["bw_mean"][index_b]
+    se = np.sqrt(base["bw_std"][index_a] ** 2 / np.maximum(n_a, 1) + candidate["bw_std"][index_b] ** 2 / np.maximum(n_b, 1))
+    testable = (n_a >= 2) & (n_b >= 2) & (se > 0)
+    z = np.full(len(index_a), np.nan)
+    np.divide(mean_b - mean_a, se, out=z, where=testable)
+    q = q_values(p_values(z))
+    change = np.divide(mean_b - mean_a, mean_a, out=np.full(len(index_a), np.inf), where=mean_a > 0) * 100
+    return {"index_a": index_a, "index_b": index_b, "only_a": only_a, "only_b": only_b, "bw_mean_change": change, "bw_mean_q": q,
+        "bw_aggregate_a": base["bw_aggregate"][index_a], "bw_aggregate_b": candidate["bw_aggregate"][index_b],
+        "significant": (q < alpha) & (np.abs(change) >= min_change)}
+#######################################################
+def summary_identities(summary, indices):
+    # (name, launch dimensions) of some configs, decoded from the name bytes
+    offsets = summary["name_offsets"]
+    identities = []
+    for key in summary["identity"][np.asarray(indices, dtype=np.int64)].tolist():
+        name = bytes(summary["name_bytes"][offsets[key[0]]:offsets[key[0] + 1]]).decode()
+        identities.append((name,) + tuple(key[1:]))
+    return identities
+#######################################################
+def percent_change(delta):
+    return (10 ** delta - 1) * 100
+#######################################################
+def empty_kernel_row(identity, status):
+    row = {"kernel": identity, "status": status, "launches_base": None, "launches_candidate": None}
+    for metric in KERNEL_METRICS:
+        row.update(dict.fromkeys((metric + "_log10_us_base", metric + "_log10_us_candidate", metric + "_change_percent", metric + "_q")))
+    row.update(dominance_us_base=None, dominance_us_candidate=None, dominance_delta_us=None, significant=False)
+    return row
+#######################################################
+def kernel_rows(base, candidate, diff):
+    # One row per config of either report, the side a config is missing
+    # from has empty values
+    rows = []
+    identities = summary_identities(base, diff["index_a"])
+    for i, identity in enumerate(identities):
+        row = empty_kernel_row(identity, "both")
+        row.update(launches_base=int(diff["launches_a"][i]), launches_candidate=int(diff["launches_b"][i]))
+        for metric in KERNEL_METRICS:
+            row[metric + "_log10_us_base"] = float(base[metric][diff["index_a"][i]])
+            row[metric + "_log10_us_candidate"] = float(candidate[metric][diff["index_b"][i]])
+            row[metric + "_change_percent"] = float(percent_change(diff[metric + "_delta"][i]))
+            row[metric + "_q"] = None if np.isnan(diff[metric + "_q"][i]) else float(diff[metric + "_q"][i])
+        row["dominance_us_base"] = float(diff["dominance_a"][i])
+        row["dominance_us_candidate"] = float(diff["dominance_b"][i])
+        row["dominance_delta_us"] = float(diff["dominance_delta"][i])
+        row["significant"] = bool(diff["significant"][i])
+        rows.append(row)
+    for summary, indices, status, side in ((base, diff["only_a"], "removed", "base"), (candidate, diff["only_b"], "added", "candidate")):
+        for index, identity in zip(indices.tolist(), summary_identities(summary, indices)):
+            row = empty_kernel_row(identity, status)
+            row.update({"launches_" + side: int(summary["launches"][index]), "dominance_us_" + side: float(summary["dominance"][index])})
+            for metric in KERNEL_METRICS:
+                row[metric + "_log10_us_" + side] = float(summary[metric][index])
+            row["dominance_delta_us"] = float(summary["dominance"][index]) * (1 if status == "added" else -1)
+            rows.append(row)
+    return rows
+#######################################################
+def memcpy_rows(base, candidate, diff, labels):
+    rows = []
+    for i, (a, b) in enumerate(zip(diff["index_a"].tolist(), diff["index_b"].tolist())):
+        copy_kind, memory, bucket = base["keys"][a].tolist()
+        rows.append({
+            "direction": memcpy_analyze.COPY_KINDS[copy_kind],
+            "memory": MEMORY_NAMES[memory],
+            "bucket": bucket,
+            "size": labels[bucket],
+            "count_base": int(base["count"][a]),
+            "count_candidate": int(candidate["count"][b]),
+            "bw_mean_base": float(base["bw_mean"][a]),
+            "bw_mean_candidate": float(candidate["bw_mean"][b]),
+            "bw_mean_change_percent": float(diff["bw_mean_change"][i]),
+            "bw_mean_q": None if np.isnan(diff["bw_mean_q"][i]) else float(diff["bw_mean_q"][i]),
+            "bw_aggregate_base": float(diff["bw_aggregate_a"][i]),
+            "bw_aggregate_candidate": float(diff["bw_aggregate_b"][i]),
+            "significant": bool(diff["significant"][i]),
+        })
+    return rows
+#######################################################
+def print_kernel_diff(base, candidate, diff, num_printed, demangle=False):
+    total_a = float(np.sum(base["dominance"]))
+    total_b = float(np.sum(candidate["dominance"]))
+    print("Kernel configs: %d in both, %d only in the baseline, %d only in the candidate" % (len(diff["index_a"]), len(diff["only_a"]), len(diff["only_b"])))
+    print("Kernel time (sum of the dominance): %.1f us -> %.1f us (%+.2f%%), %+.1f us from the configs of one report only" % (total_a, total_b,
+        (total_b - total_a) / total_a * 100 if total_a > 0 else 0.0, float(np.sum(candidate["dominance"][diff["only_b"]]) - np.sum(base["dominance"][diff["only_a"]]))))
+    changed = np.flatnonzero(diff["significant"])
+    slower = int(np.sum(diff["ket_significant"] & (diff["ket_delta"] > 0)))
+    print("%d configs changed significantly, %d of them with a longer kernel duration" % (len(changed), slower))
+    if len(changed) == 0:
+        return
+    # The changes that cost or save the most kernel time first
+    shown = changed[np.argsort(-np.abs(diff["dominance_delta"][changed]), kind="stable")[:num_printed]]
+    labels = kernel_metrics.identity_labels(summary_identities(base, diff["index_a"][shown]), range(len(shown)), demangle)
+    print("%-40s %15s %10s %10s %10s %10s %18s" % ("kernel", "launches", "ket", "klo", "slack", "ket q", "dominance (us)"))
+    for label, i in zip(labels, shown.tolist()):
+        print("%-40s %15s %9.1f%% %9.1f%% %9.1f%% %10.2g %+18.1f" % (label, "%d>%d" % (diff["launches_a"][i], diff["launches_b"][i]), percent_change(diff["ket_delta"][i]),
+            percent_change(diff["klo_delta"][i]), percent_change(diff["slack_delta"][i]), diff["ket_q"][i], diff["dominance_delta"][i]))
+#######################################################
+def print_memcpy_diff(rows):
+    # Only the rows of all host memory kinds are printed
+    print("%-5s %-7s %10s %10s %12s %12s %9s %10s" % ("kind", "size", "count", "count", "mean MB/s", "mean MB/s", "change", "q"))
+    for row in rows:
+        if row["memory"] == "all":
+            print("%-5s %-7s %10d %10d %12.1f %12.1f %8.1f%% %10s%s" % (row["direction"], row["size"], row["count_base"], row["count_candidate"], row["bw_mean_base"], row["bw_mean_candidate"],
+                row["bw_mean_change_percent"], "-" if row["bw_mean_q"] is None else "%.2g" % row["bw_mean_q"], " *" if row["significant"] else ""))
+#######################################################
+def draw_diff_bar(plt, values, labels, ylabel):
+    # Like kernel_metrics.draw_metric_bar, around zero and without its fixed
+    # tick step, which unchanged metrics (all zero) do not have
+    fig, ax = plt.subplots(1, figsize=(18, 12))
+    x_values = np.arange(1, len(values) + 1)
+    ax.bar(x_values, values, width=1, edgecolor='black', color=['tab:red' if value > 0 else 'tab:green' for value in values])
+    ax.axhline(0, color='black', linewidth=0.8)
+    ax.xaxis.set_ticks(x_values)
+    ax.xaxis.set_ticklabels(labels)
+    ax.tick_params(axis='x', rotation=90)
+    ax.grid(axis='y', linestyle='--', linewidth=0.5, color='gray', alpha=0.5)
+    ax.set_xlabel("Kernel Name")
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.95)
+    return fig
+#######################################################
+def plot_kernel_diff(base, diff, render_options=None, demangle=False):
+    # The configs whose dominance changed the most, in log10 of the ratio
+    # of the medians
+    shown = np.argsort(-np.abs(diff["dominance_delta"]), kind="stable")[:NUM_PLOTTED]
+    if len(shown) == 0:
+        return
+    labels = kernel_metrics.identity_labels(summary_identities(base, diff["index_a"][shown]), range(len(shown)), demangle)
+    render.render_figures([
+        ('diff_ket_bar', draw_diff_bar, (diff["ket_delta"][shown].tolist(), labels, "Kernel Duration, candidate / baseline - Log Base 10")),
+        ('diff_klo_bar', draw_diff_bar, (diff["klo_delta"][shown].tolist(), labels, "Kernel Launch Overhead, candidate / baseline - Log Base 10")),
+        ('diff_slack_bar', draw_diff_bar, (diff["slack_delta"][shown].tolist(), labels, "Slack, candidate / baseline - Log Base 10")),
+        ('diff_dominance_bar', draw_diff_bar, (diff["dominance_delta"][shown].tolist(), labels, "Dominance, candidate - baseline (us)")),
+    ], render_options)
+#######################################################
+def plot_memcpy_diff(rows, labels, render_options=None):
+    directions = [d for d in memcpy_analyze.COPY_KINDS.values() if any(row["direction"] == d for row in rows)]
+    if len(directions) == 0:
+        return
+    series = []
+    for direction in directions:
+        values = np.zeros(len(labels))
+        for row in rows:
+            if row["direction"] == direction and row["memory"] == "all" and math.isfinite(row["bw_mean_change_percent"]):
+                values[row["bucket"]] = row["bw_mean_change_percent"]
+        series.append(values)
+    render.render_figures([("diff_memcpy_bw", memcpy_analyze.draw_direction_bars, (labels, directions, series, "Mean bandwidth change, candidate vs baseline (%)"))], render_options)
+#######################################################
+def diff_reports(base_file, candidate_file, use_cache=True, jobs=1, edges=None, alpha=0.05, min_change=5.0, num_printed=20, render_options=None, demangle=False):
+    edges = edges or memcpy_analyze.size_edges()
+    summaries = []
+    for argument in (base_file, candidate_file):
+        with profiling.stage("kernel summary"):
+            summary = load_summary(argument, "kernel_summary", functools.partial(kernel_summary, use_cache=use_cache, jobs=jobs), use_cache)
+        if summary is None:
+            print("No kernel summary in", argument)
+            sys.exit(1)
+        summaries.append(summary)
+    with profiling.stage("kernel diff"):
+        diff = kernel_diff(*summaries, alpha, min_change)
+    print_kernel_diff(*summaries, diff, num_printed, demangle)
+    options = render_options or {}
+    if options.get("table_format") is not None:
+        table_export.export_table("diff_kernel_table", kernel_rows(*summaries, diff), render_options)
+    plot_kernel_diff(summaries[0], diff, render_options, demangle)
+
+    # Transfers are compared when both reports have any
+    if not (has_memcpy(base_file) and has_memcpy(candidate_file)):
+        print("No memcpy table in both reports, the transfers are not compared")
+        return
+    labels = memcpy_analyze.bucket_labels(edges)
+    summaries = []
+    for argument in (base_file, candidate_file):
+        with profiling.stage("memcpy summary"):
+            summary = load_summary(argument, memcpy_summary_name(edges), functools.partial(memcpy_summary, edges=edges), use_cache)
+        if summary is None:
+            print("No memcpy summary with these --log2-edges in", argument + ", the transfers are not compared")
+            return
+        summaries.append(summary)
+    with profiling.stage("memcpy diff"):
+        diff = memcpy_diff(*summaries, alpha, min_change)
+    rows = memcpy_rows(*summaries, diff, labels)
+    print_memcpy_diff(rows)
+    table_export.export_table("diff_memcpy_table", rows, render_options)
+    plot_memcpy_diff(rows, labels, render_options)
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline", help="report, or <report>.cache directory with its saved summary")
+    parser.add_argument("candidate", help="report, or <report>.cache directory with its saved summary")
+    report_cache.add_cache_arguments(parser)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="scan disjoint row ranges of the kernel table in this many worker processes when a summary is built")
+    parser.add_argument("--log2-edges", type=memcpy_analyze.parse_log2_edges, default=memcpy_analyze.size_edges(), help="size bucket bounds as LOW:HIGH powers of two, default 12:20 (4KB ... 1MB)")
+    parser.add_argument("--alpha", type=float, default=0.05, help="false discovery rate of the significant changes, default 0.05")
+    parser.add_argument("--min-change", type=float, default=5.0, metavar="PCT", help="smallest change in percent that is reported as significant, default 5")
+    parser.add_argument("--num-printed", type=int, default=20, metavar="N", help="number of changed kernel configs printed, default 20")
+    parser.add_argument("--demangle", action="store_true", help="demangle the C++ kernel names of the labels with c++filt")
+    render.add_render_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    base_file = resolve_argument(args.baseline)
+    candidate_file = resolve_argument(args.candidate)
+    profiling.start_profile(args.profile, args.cprofile)
+    try:
+        with profiling.stage("diff_reports"):
+            diff_reports(base_file, candidate_file, report_cache.cache_mode(args), args.jobs, args.log2_edges, args.alpha, args.min_change, args.num_printed, render.render_options(args), args.demangle)
+    except sqlite3.Error as error:
+        print("Error reading data from SQLite table:", error)
+        sys.exit(1)
+    profiling.finish_profile()
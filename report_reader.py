@@ -0,0 +1,460 @@
+#This module reads the columns of sqlite, Arrow and Parquet reports.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 report_reader.py --to-parquet DIR <sqlite file>
+
+#Note: Common reader of the report tables. A report is either the SQLite
+# export of nsys or a directory with one Arrow/Parquet file per table
+# (<table>.parquet or <table>.arrow, as written by nsys export --type
+# parquetdir/arrowdir). read_columns() returns some columns of one table
+# as NumPy arrays: only those columns are read, and the filters (column IN
+# values, and [low, high) ranges such as the time window) are pushed into
+# the SQL WHERE clause or into the Arrow scan, which skips the Parquet row
+# groups whose statistics rule them out. The Arrow chunks of a column are
+# handed to NumPy without a copy and only concatenated when there are
+# several, so no Python tuple is created per row.
+# SQLite reports are opened read-only and immutable, memory mapped, with
+# a large page cache and temporary b-trees in memory, and the rows are
+# fetched with fetchmany into typed per-column arrays, so at most one
+# batch of tuples exists at a time. check_report() tells a report that
+# lacks a table or column the script needs before anything is read.
+# string_table() and decode_strings() read StringIds values by id on
+# demand, into an array indexed by id.
+# sample_rows() draws random blocks of consecutive rowids for --sample,
+# which are then read by rowid like any other filter, so a small sample
+# of a huge table only touches about that fraction of its pages.
+#########################################################################
+import os
+import sys
+import json
+import math
+import argparse
+import sqlite3
+import urllib.parse
+import numpy as np
+import nsys_index
+import profiling
+import progress
+#######################################################
+ARROW_EXTENSIONS = {".parquet": "parquet", ".arrow": "ipc", ".feather": "ipc"}
+# Tables written by --to-parquet
+EXPORT_TABLES = ["StringIds", "CUPTI_ACTIVITY_KIND_KERNEL", "CUPTI_ACTIVITY_KIND_RUNTIME", "CUPTI_ACTIVITY_KIND_MEMCPY"]
+# SQLite caps mmap_size at its compile time limit, the cache size is in KiB
+MMAP_SIZE = 1 << 40
+CACHE_SIZE_KB = 256 * 1024
+FETCH_SIZE = 65536
+# Major versions of the nsys export schema the scripts were checked with
+SCHEMA_VERSIONS = (2, 3)
+# Longer IN lists are passed as JSON, SQLite limits the parameters
+MAX_SQL_VALUES = 500
+# Consecutive rows drawn together by sample_rows, about one or two pages
+SAMPLE_BLOCK_ROWS = 64
+# Rows given by their rowid, as one JSON array parameter
+SQL_ROWS = "rowid IN (SELECT value FROM json_each(?))"
+# Normal quantile of the 95% confidence intervals of --sample
+SAMPLE_Z = 1.96
+#######################################################
+def is_arrow_report(report):
+    return os.path.isdir(report)
+#######################################################
+def arrow_modules():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.compute
+    except ImportError:
+        print("Arrow/Parquet reports need pyarrow (pip install pyarrow)")
+        sys.exit(1)
+    return pyarrow, pyarrow.dataset, pyarrow.compute
+#######################################################
+def arrow_dataset(report, table):
+    pyarrow, dataset, compute = arrow_modules()
+    for extension, file_format in ARROW_EXTENSIONS.items():
+        table_file = os.path.join(report, table + extension)
+        if os.path.exists(table_file):
+            return dataset.dataset(table_file, format=file_format)
+    raise FileNotFoundError("No %s table (.parquet or .arrow) in %s" % (table, report))
+#######################################################
+def sql_filter(where, ranges, rows=None):
+    conditions = []
+    params = []
+    if rows is not None:
+        conditions.append(SQL_ROWS)
+        params.append(json.dumps(np.asarray(rows).tolist()))
+    for column, values in (where or {}).items():
+        if len(values) > MAX_SQL_VALUES:
+            # Long lists travel as one JSON array parameter
+            conditions.append("%s IN (SELECT value FROM json_each(?))" % column)
+            params.append(json.dumps([int(value) for value in values]))
+            continue
+        conditions.append("%s IN (%s)" % (column, ','.join('?' * len(values))))
+        params.extend(int(value) for value in values)
+    for column, (low, high) in (ranges or {}).items():
+        conditions.append("%s >= ? AND %s < ?" % (column, column))
+        params.extend((low, high))
+    if len(conditions) == 0:
+        return "", ()
+    return " WHERE " + " AND ".join(conditions), tuple(params)
+#######################################################
+def arrow_filter(where, ranges):
+    pyarrow, dataset, compute = arrow_modules()
+    expression = None
+    for column, values in (where or {}).items():
+        condition = compute.field(column).isin([int(value) for value in values])
+        expression = condition if expression is None else expression & condition
+    for column, (low, high) in (ranges or {}).items():
+        condition = (compute.field(column) >= low) & (compute.field(column) < high)
+        expression = condition if expression is None else expression & condition
+    return expression
+#######################################################
+def numpy_column(column, dtype=np.int64):
+    # Every chunk (row group) without nulls is a view of its Arrow buffer,
+    # nulls become 0 as they do in the int64 arrays of the SQLite path. A
+    # single chunk is returned as that view when it has the dtype already,
+    # several are concatenated straight into the dtype, the only copy
+    chunks = [chunk.fill_null(0) if chunk.null_count else chunk for chunk in column.chunks]
+    views = [chunk.to_numpy(zero_copy_only=True) for chunk in chunks]
+    if len(views) == 1:
+        return views[0].astype(dtype, copy=False)
+    if len(views) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(views, dtype=dtype, casting="unsafe")
+#######################################################
+def connect(report):
+    # The scripts never write to a report, immutable=1 also lets SQLite
+    # skip the file locking
+    connection = sqlite3.connect("file:%s?mode=ro&immutable=1" % urllib.parse.quote(os.path.abspath(report)), uri=True)
+    connection.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+    connection.execute("PRAGMA cache_size = -%d" % CACHE_SIZE_KB)
+    connection.execute("PRAGMA temp_store = MEMORY")
+    return connection
+#######################################################
+def report_columns(report, tables):
+    # {table: set of columns} of the tables that exist in the report
+    found = {}
+    if is_arrow_report(report):
+        for table in tables:
+            try:
+                found[table] = set(arrow_dataset(report, table).schema.names)
+            except FileNotFoundError:
+                pass
+        return found
+    connection = connect(report)
+    try:
+        cursor = connection.cursor()
+        for table in tables:
+            cursor.execute("PRAGMA table_info(%s)" % table)
+            columns = set(row[1] for row in cursor.fetchall())
+            if columns:
+                found[table] = columns
+    finally:
+        connection.close()
+    return found
+#######################################################
+def schema_version(report):
+    # EXPORT_SCHEMA_VERSION of the nsys export, None when it is not recorded
+    if is_arrow_report(report):
+        return None
+    connection = connect(report)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('META_DATA_EXPORT', 'EXPORT_META_DATA')")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute("SELECT value FROM %s WHERE name = 'EXPORT_SCHEMA_VERSION'" % row[0])
+        row = cursor.fetchone()
+        return str(row[0]) if row is not None else None
+    finally:
+        connection.close()
+#######################################################
+def missing_columns(report, tables):
+    # The tables, and table.column names, of tables the report lacks
+    found = report_columns(report, tables)
+    missing = []
+    for table, columns in tables.items():
+        if table not in found:
+            missing.append(table)
+        else:
+            missing.extend(table + "." + column for column in columns if column not in found[table])
+    return missing
+#######################################################
+def check_report(report, tables):
+    # tables maps the tables a script reads to the columns it needs, a
+    # report without them is rejected before the analysis starts
+    try:
+        missing = missing_columns(report, tables)
+    except sqlite3.Error as error:
+        print("Cannot read the report", report + ":", error)
+        sys.exit(1)
+    if missing:
+        print("The report", report, "lacks", ', '.join(missing))
+        sys.exit(1)
+    version = schema_version(report)
+    if version is not None and version.split(".")[0].isdigit() and int(version.split(".")[0]) not in SCHEMA_VERSIONS:
+        print("The report has export schema version", version + ", the scripts were checked with versions", ', '.join("%d.x" % v for v in SCHEMA_VERSIONS))
+#######################################################
+def fetch_int_columns(cursor, query, num_columns, fetch_size=FETCH_SIZE, params=()):
+    # All the columns as one int64 matrix
+    return np.column_stack(fetch_typed_columns(cursor, query, [np.int64] * num_columns, fetch_size, params)) if num_columns else np.empty((0, 0), dtype=np.int64)
+#######################################################
+def fetch_typed_columns(cursor, query, dtypes, fetch_size=FETCH_SIZE, params=()):
+    # One array per column, fetched fetch_size rows at a time: only one
+    # batch of row tuples exists at a time and every column is joined from
+    # its own batches, so the peak memory is about that of the columns
+    with profiling.stage("query"):
+        cursor.execute(query, params)
+    with profiling.stage("fetch"):
+        chunks = [[np.empty(0, dtype=dtype)] for dtype in dtypes]
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            profiling.add_rows(len(rows))
+            progress.advance(len(rows))
+            batch = np.array(rows, dtype=np.int64)
+            del rows
+            for i, dtype in enumerate(dtypes):
+                chunks[i].append(batch[:, i].astype(dtype))
+        columns = []
+        for i in range(len(dtypes)):
+            columns.append(np.concatenate(chunks[i]))
+            chunks[i] = None
+        return columns
+#######################################################
+def read_columns(report, table, columns, where=None, ranges=None, label=None, dtypes=None, rows=None):
+    # where maps columns to the values they may have, ranges columns to a
+    # [low, high) range, dtypes columns to a type other than int64, and
+    # rows restricts the read to these row numbers (see row_range)
+    column_types = {column: (dtypes or {}).get(column, np.int64) for column in columns}
+    if is_arrow_report(report):
+        with profiling.stage("scan"):
+            if rows is None:
+                result = arrow_dataset(report, table).to_table(columns=list(columns), filter=arrow_filter(where, ranges))
+            else:
+                result = arrow_dataset(report, table).take(np.asarray(rows), columns=list(columns))
+                expression = arrow_filter(where, ranges)
+                if expression is not None:
+                    result = result.filter(expression)
+            profiling.add_rows(result.num_rows)
+        return {column: numpy_column(result.column(column), column_types[column]) for column in columns}
+
+    condition, params = sql_filter(where, ranges, rows)
+    query = "SELECT %s FROM %s%s" % (', '.join(columns), table, condition)
+    connection = connect(report)
+    cursor = connection.cursor()
+    try:
+        if label is not None:
+            nsys_index.report_query_plan(cursor, label, query, params)
+        values = fetch_typed_columns(cursor, query, [column_types[column] for column in columns], params=params)
+    finally:
+        connection.close()
+    return dict(zip(columns, values))
+#######################################################
+def iter_column_batches(report, table, columns, where=None, ranges=None, batch_size=FETCH_SIZE, label=None, dtypes=None):
+    # Yields dicts of at most batch_size rows of the columns
+    column_types = [(dtypes or {}).get(column, np.int64) for column in columns]
+    if is_arrow_report(report):
+        scanner = arrow_dataset(report, table).scanner(columns=list(columns), filter=arrow_filter(where, ranges), batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows == 0:
+                continue
+            profiling.add_rows(batch.num_rows)
+            yield {column: batch.column(i).fill_null(0).to_numpy(zero_copy_only=False).astype(dtype, copy=False) for i, (column, dtype) in enumerate(zip(columns, column_types))}
+        return
+
+    condition, params = sql_filter(where, ranges)
+    query = "SELECT %s FROM %s%s" % (', '.join(columns), table, condition)
+    connection = connect(report)
+    cursor = connection.cursor()
+    try:
+        if label is not None:
+            nsys_index.report_query_plan(cursor, label, query, params)
+        with profiling.stage("query"):
+            cursor.execute(query, params)
+        while True:
+            # Only the fetch itself is timed, not the consumer of the batches
+            with profiling.stage("fetch"):
+                rows = cursor.fetchmany(batch_size)
+                profiling.add_rows(len(rows))
+                if not rows:
+                    break
+                values = np.array(rows, dtype=np.int64)
+            yield {column: values[:, i].astype(dtype, copy=False) for i, (column, dtype) in enumerate(zip(columns, column_types))}
+    finally:
+        connection.close()
+#######################################################
+def read_strings(report, ids):
+    # {id: value} of the StringIds rows with these ids
+    ids = [int(x) for x in ids]
+    strings = {}
+    if is_arrow_report(report):
+        if ids:
+            result = arrow_dataset(report, "StringIds").to_table(columns=["id", "value"], filter=arrow_filter({"id": ids}, None))
+            strings.update(zip(result.column("id").to_pylist(), result.column("value").to_pylist()))
+        return strings
+    connection = connect(report)
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i+500]
+            cursor.execute("SELECT id, value FROM StringIds WHERE id IN (%s)" % ','.join('?' * len(batch)), batch)
+            strings.update(cursor.fetchall())
+    finally:
+        connection.close()
+    return strings
+#######################################################
+def string_table(report):
+    # The StringIds values in an array indexed by id, filled on demand by
+    # decode_strings so only the strings that are printed are ever read
+    return {"report": report, "values": np.empty(0, dtype=object), "loaded": np.zeros(0, dtype=bool)}
+#######################################################
+def decode_strings(strings, ids):
+    # Values of these ids as an object array, None for unknown ids
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return np.empty(0, dtype=object)
+    grow = int(ids.max()) + 1 - len(strings["values"])
+    if grow > 0:
+        strings["values"] = np.concatenate((strings["values"], np.full(grow, None, dtype=object)))
+        strings["loaded"] = np.concatenate((strings["loaded"], np.zeros(grow, dtype=bool)))
+    missing = np.unique(ids[~strings["loaded"][ids]])
+    if len(missing) > 0:
+        with profiling.stage("strings"):
+            found = read_strings(strings["report"], missing)
+            values = np.empty(len(found), dtype=object)
+            values[:] = list(found.values())
+            strings["values"][np.fromiter(found, dtype=np.int64, count=len(found))] = values
+            strings["loaded"][missing] = True
+            profiling.add_rows(len(found))
+    return strings["values"][ids]
+#######################################################
+def string_ids(report, ids):
+    # Which of these ids are in StringIds, and whether two of them share a
+    # value (nsys stores every string once), without reading the values
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) == 0:
+        return ids, False
+    if is_arrow_report(report):
+        pyarrow, dataset, compute = arrow_modules()
+        result = arrow_dataset(report, "StringIds").to_table(columns=["id", "value"], filter=arrow_filter({"id": ids}, None))
+        known = np.unique(numpy_column(result.column("id")))
+        return known, compute.count_distinct(result.column("value")).as_py() < result.num_rows
+    connection = connect(report)
+    try:
+        # The ids travel as one JSON array, so there is no limit on their
+        # number and the values never leave SQLite
+        id_list = json.dumps(ids.tolist())
+        known = np.array([row[0] for row in connection.execute("SELECT id FROM StringIds WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id", (id_list,))], dtype=np.int64)
+        duplicates = connection.execute("SELECT COUNT(*) - COUNT(DISTINCT value) FROM StringIds WHERE id IN (SELECT value FROM json_each(?))", (id_list,)).fetchone()[0]
+    finally:
+        connection.close()
+    return known, duplicates > 0
+#######################################################
+def row_range(report, table):
+    # First and last row number of a table, the rowids of SQLite or the
+    # positions in an Arrow/Parquet table, (None, None) when it is empty
+    if is_arrow_report(report):
+        num_rows = arrow_dataset(report, table).count_rows()
+        return (0, num_rows - 1) if num_rows else (None, None)
+    connection = connect(report)
+    try:
+        return connection.execute("SELECT MIN(rowid), MAX(rowid) FROM %s" % table).fetchone()
+    finally:
+        connection.close()
+#######################################################
+def sample_rows(report, table, fraction, seed=None, block_rows=SAMPLE_BLOCK_ROWS):
+    # Row numbers of a uniform random fraction of the blocks of block_rows
+    # consecutive rows. Whole blocks are looked up by rowid, so only about
+    # that fraction of the pages is read and the table is never sorted.
+    # Returns the rows and the fraction of the blocks actually drawn
+    low, high = row_range(report, table)
+    if low is None:
+        return np.empty(0, dtype=np.int64), fraction
+    num_blocks = (high - low) // block_rows + 1
+    num_sampled = min(max(int(round(fraction * num_blocks)), 1), num_blocks)
+    blocks = np.sort(np.random.default_rng(seed).choice(num_blocks, size=num_sampled, replace=False))
+    rows = (low + blocks[:, None] * block_rows + np.arange(block_rows)).ravel()
+    return rows[rows <= high], num_sampled / num_blocks
+#######################################################
+def count_interval(count, fraction, z=SAMPLE_Z):
+    # Estimate of the number of rows of a group from the count of its
+    # sampled rows, with the normal interval of a binomial sample
+    error = z * math.sqrt(count * (1 - fraction)) / fraction
+    return count / fraction, max(count / fraction - error, count), count / fraction + error
+#######################################################
+def parse_fraction(value):
+    # A fraction as 0.01 or 1%
+    fraction = float(value[:-1]) / 100 if value.endswith("%") else float(value)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError("the fraction must be in (0, 1] or (0%, 100%]")
+    return fraction
+#######################################################
+def add_sample_arguments(parser):
+    parser.add_argument("--sample", type=parse_fraction, metavar="FRACTION", help="only read a uniform random fraction (e.g. 0.01 or 1%%%%) of the rows, in blocks of %d rowids, and report estimates with 95%%%% confidence intervals" % SAMPLE_BLOCK_ROWS)
+    parser.add_argument("--seed", type=int, help="random seed of --sample")
+#######################################################
+def column_range(report, table, column):
+    # MIN and MAX of a column, (None, None) for an empty table
+    if is_arrow_report(report):
+        pyarrow, dataset, compute = arrow_modules()
+        values = arrow_dataset(report, table).to_table(columns=[column]).column(column)
+        if len(values) == 0:
+            return None, None
+        result = compute.min_max(values)
+        return result["min"].as_py(), result["max"].as_py()
+    connection = connect(report)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT MIN(%s), MAX(%s) FROM %s" % (column, column, table))
+        return cursor.fetchone()
+    finally:
+        connection.close()
+#######################################################
+def export_parquet(database_file, directory, tables=EXPORT_TABLES, batch_size=1000000):
+    # Writes the tables of an SQLite report as <directory>/<table>.parquet
+    pyarrow, dataset, compute = arrow_modules()
+    import pyarrow.parquet
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(database_file)
+    cursor = connection.cursor()
+    try:
+        for table in tables:
+            cursor.execute("PRAGMA table_info(%s)" % table)
+            info = cursor.fetchall()
+            if not info:
+                continue
+            names = [row[1] for row in info]
+            schema = pyarrow.schema([(name, pyarrow.string() if "TEXT" in (declared or "").upper() else pyarrow.int64()) for _, name, declared, *_ in info])
+            writer = pyarrow.parquet.ParquetWriter(os.path.join(directory, table + ".parquet"), schema)
+            cursor.execute("SELECT %s FROM %s" % (', '.join('"%s"' % name for name in names), table))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.write_batch(pyarrow.record_batch([pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)], schema=schema))
+            writer.close()
+            print("Wrote", os.path.join(directory, table + ".parquet"))
+    finally:
+        connection.close()
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    parser.add_argument("--to-parquet", required=True, metavar="DIR", help="write the tables the scripts read as Parquet files into this directory")
+    args = parser.parse_args()
+
+    export_parquet(args.database_file, args.to_parquet)
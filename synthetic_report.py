@@ -0,0 +1,157 @@
+#This script generates synthetic nsys reports of a chosen size.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Usage: python3 synthetic_report.py [--kernels N] [--memcpy N] [--configs N] [--names N] [--sizes loguniform|powers|lognormal] <output sqlite file>
+
+#Note: Writes a synthetic report with the nsys tables and columns the
+# scripts read (StringIds, CUPTI_ACTIVITY_KIND_KERNEL, _RUNTIME and
+# _MEMCPY), so they can be run and benchmarked without a GPU trace. Kernel
+# configs are drawn with Zipf-like popularity, every kernel and transfer
+# gets a runtime call with the same correlationId, and the rows are
+# generated and inserted in chunks so 10^8 rows fit in memory.
+#########################################################################
+import os
+import argparse
+import sqlite3
+import numpy as np
+#######################################################
+TABLES = """
+CREATE TABLE StringIds (id INTEGER NOT NULL PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE CUPTI_ACTIVITY_KIND_KERNEL (start INTEGER NOT NULL, end INTEGER NOT NULL, deviceId INTEGER NOT NULL, contextId INTEGER NOT NULL, streamId INTEGER NOT NULL, correlationId INTEGER, globalPid INTEGER, gridX INTEGER NOT NULL, gridY INTEGER NOT NULL, gridZ INTEGER NOT NULL, blockX INTEGER NOT NULL, blockY INTEGER NOT NULL, blockZ INTEGER NOT NULL, shortName INTEGER NOT NULL, demangledName INTEGER);
+CREATE TABLE CUPTI_ACTIVITY_KIND_RUNTIME (start INTEGER NOT NULL, end INTEGER NOT NULL, eventClass INTEGER NOT NULL, globalTid INTEGER, correlationId INTEGER, nameId INTEGER NOT NULL, returnValue INTEGER NOT NULL, callchainId INTEGER);
+CREATE TABLE CUPTI_ACTIVITY_KIND_MEMCPY (start INTEGER NOT NULL, end INTEGER NOT NULL, deviceId INTEGER NOT NULL, contextId INTEGER NOT NULL, streamId INTEGER NOT NULL, correlationId INTEGER, globalPid INTEGER, bytes INTEGER NOT NULL, copyKind INTEGER NOT NULL, deprecatedSrcId INTEGER, srcKind INTEGER, dstKind INTEGER, srcDeviceId INTEGER, srcContextId INTEGER, dstDeviceId INTEGER, dstContextId INTEGER, migrationCause INTEGER, graphNodeId INTEGER, virtualAddress INTEGER);
+"""
+KERNEL_FAMILIES = ["gemm", "reduce", "elementwise", "softmax", "layernorm", "attention", "conv", "transpose"]
+LAUNCH_NAME_ID = 1
+MEMCPY_NAME_ID = 2
+# copyKind 1 HtoD, 2 DtoH, 8 DtoD, 10 PtoP and how often they are drawn
+COPY_KINDS = [1, 2, 8, 10]
+COPY_KIND_WEIGHTS = [0.4, 0.4, 0.15, 0.05]
+SIZE_DISTRIBUTIONS = ("loguniform", "powers", "lognormal")
+#######################################################
+def kernel_configs(rng, num_configs, num_names):
+    # (shortName, gridX, gridY, gridZ, blockX, blockY, blockZ), the string
+    # ids of the kernel names start after the two runtime API names
+    configs = np.empty((num_configs, 7), dtype=np.int64)
+    configs[:, 0] = rng.integers(0, num_names, num_configs) + 3
+    configs[:, 1] = 2 ** rng.integers(0, 14, num_configs)
+    configs[:, 2] = rng.choice([1, 1, 1, 2, 4], num_configs)
+    configs[:, 3] = 1
+    configs[:, 4] = rng.choice([32, 64, 128, 256, 512, 1024], num_configs)
+    configs[:, 5] = rng.choice([1, 1, 2, 4], num_configs)
+    configs[:, 6] = 1
+    return configs
+#######################################################
+def zipf_weights(num, exponent):
+    weights = 1.0 / np.arange(1, num + 1) ** exponent
+    return weights / weights.sum()
+#######################################################
+def transfer_sizes(rng, num, distribution, min_log2, max_log2):
+    if distribution == "loguniform":
+        sizes = 2 ** rng.uniform(min_log2, max_log2, num)
+    elif distribution == "powers":
+        sizes = 2.0 ** rng.integers(min_log2, max_log2 + 1, num)
+    elif distribution == "lognormal":
+        sizes = np.exp(rng.normal((min_log2 + max_log2) / 2 * np.log(2), (max_log2 - min_log2) / 6 * np.log(2), num))
+    else:
+        raise ValueError("Unknown size distribution " + str(distribution))
+    return np.clip(sizes, 1, None).astype(np.int64)
+#######################################################
+def insert_rows(cursor, table, columns):
+    placeholders = ','.join('?' * len(columns))
+    cursor.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders), zip(*[column.tolist() if isinstance(column, np.ndarray) else column for column in columns]))
+#######################################################
+def kernel_chunk(rng, cursor, configs, weights, first_correlation, time, num, num_devices, num_streams):
+    correlation = np.arange(first_correlation, first_correlation + num, dtype=np.int64)
+    # Launch calls follow each other with a gap, an occasional slow launch,
+    # and the kernel starts a slack (which can be negative) after the call
+    runtime_start = time + np.cumsum(rng.integers(100, 5000, num) + rng.integers(2000, 9000, num))
+    runtime_end = runtime_start + rng.integers(2000, 9000, num) + (rng.random(num) < 0.05) * rng.integers(0, 100000, num)
+    kernel_start = runtime_end + rng.integers(-3000, 20000, num)
+    kernel_end = kernel_start + rng.lognormal(9, 1.5, num).astype(np.int64)
+    config = configs[rng.choice(len(configs), num, p=weights)]
+    none = [None] * num
+    zero = np.zeros(num, dtype=np.int64)
+    ones = zero + 1
+    insert_rows(cursor, "CUPTI_ACTIVITY_KIND_RUNTIME", [runtime_start, runtime_end, ones, ones, correlation, zero + LAUNCH_NAME_ID, zero, none])
+    insert_rows(cursor, "CUPTI_ACTIVITY_KIND_KERNEL", [kernel_start, kernel_end, rng.integers(0, num_devices, num), ones, rng.integers(0, num_streams, num) + 7, correlation, ones,
+        config[:, 1], config[:, 2], config[:, 3], config[:, 4], config[:, 5], config[:, 6], config[:, 0], config[:, 0]])
+    return int(runtime_end[-1])
+#######################################################
+def memcpy_chunk(rng, cursor, first_correlation, time, num, size_distribution, min_log2, max_log2, num_devices, num_streams):
+    correlation = np.arange(first_correlation, first_correlation + num, dtype=np.int64)
+    transfer_bytes = transfer_sizes(rng, num, size_distribution, min_log2, max_log2)
+    start = time + np.cumsum(rng.integers(1000, 20000, num))
+    # Bandwidths of roughly 1 to 25 GB/s plus a fixed setup cost
+    end = start + (transfer_bytes / rng.uniform(1, 25, num)).astype(np.int64) + rng.integers(500, 3000, num)
+    kind = rng.choice(COPY_KINDS, num, p=COPY_KIND_WEIGHTS)
+    none = [None] * num
+    zero = np.zeros(num, dtype=np.int64)
+    ones = zero + 1
+    insert_rows(cursor, "CUPTI_ACTIVITY_KIND_RUNTIME", [start - 5000, start - 100, ones, ones, correlation, zero + MEMCPY_NAME_ID, zero, none])
+    insert_rows(cursor, "CUPTI_ACTIVITY_KIND_MEMCPY", [start, end, rng.integers(0, num_devices, num), ones, rng.integers(0, num_streams, num) + 7, correlation, ones, transfer_bytes, kind, none,
+        rng.integers(0, 3, num), rng.integers(0, 3, num), zero, ones, zero, ones, none, none, none])
+    return int(end[-1])
+#######################################################
+def generate_report(database_file, num_kernels=100000, num_memcpy=100000, num_configs=100, num_names=40, zipf_exponent=1.1,
+        size_distribution="loguniform", min_size_log2=4, max_size_log2=24, num_devices=2, num_streams=4, seed=0, chunk_size=1000000):
+    rng = np.random.default_rng(seed)
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    conn = sqlite3.connect(database_file)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=OFF")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.executescript(TABLES)
+
+    names = ["kernel_%s_%d" % (KERNEL_FAMILIES[i % len(KERNEL_FAMILIES)], i) for i in range(num_names)]
+    cursor.executemany("INSERT INTO StringIds VALUES (?,?)", [(LAUNCH_NAME_ID, "cudaLaunchKernel"), (MEMCPY_NAME_ID, "cudaMemcpyAsync")] + [(i + 3, name) for i, name in enumerate(names)])
+    configs = kernel_configs(rng, num_configs, num_names)
+    weights = zipf_weights(num_configs, zipf_exponent)
+
+    correlation = 1
+    time = 1000
+    for first in range(0, num_kernels, chunk_size):
+        num = min(chunk_size, num_kernels - first)
+        time = kernel_chunk(rng, cursor, configs, weights, correlation, time, num, num_devices, num_streams)
+        correlation += num
+    # The transfers are spread over the same time span as the kernels
+    time = 1000
+    for first in range(0, num_memcpy, chunk_size):
+        num = min(chunk_size, num_memcpy - first)
+        time = memcpy_chunk(rng, cursor, correlation, time, num, size_distribution, min_size_log2, max_size_log2, num_devices, num_streams)
+        correlation += num
+    conn.commit()
+    conn.close()
+#######################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_file")
+    parser.add_argument("--kernels", type=int, default=100000, help="number of kernel launches")
+    parser.add_argument("--memcpy", type=int, default=100000, help="number of memory transfers")
+    parser.add_argument("--configs", type=int, default=100, help="number of distinct kernel configs (name and launch dimensions)")
+    parser.add_argument("--names", type=int, default=40, help="number of distinct kernel names")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the Zipf-like popularity of the kernel configs")
+    parser.add_argument("--sizes", choices=SIZE_DISTRIBUTIONS, default="loguniform", help="distribution of the transfer sizes")
+    parser.add_argument("--size-range", default="4:24", metavar="LOW:HIGH", help="transfer sizes from 2^LOW to 2^HIGH bytes")
+    parser.add_argument("--devices", type=int, default=2)
+    parser.add_argument("--streams", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    low, high = (int(x) for x in args.size_range.split(":"))
+    generate_report(args.database_file, args.kernels, args.memcpy, args.configs, args.names, args.zipf, args.sizes, low, high, args.devices, args.streams, args.seed)
+    print("Wrote", args.database_file, "with", args.kernels, "kernels and", args.memcpy, "transfers")
@@ -0,0 +1,70 @@
+#This module exports the metric tables as json, csv or parquet.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Writes the tables behind the figures (one row per kernel config or
+# per transfer size bucket) as json, csv or parquet for dashboards. With
+# --no-plot the figures are skipped, and since the scripts only import
+# matplotlib in the render stage it is then never imported.
+#########################################################################
+import os
+import csv
+import json
+#######################################################
+FORMATS = ("json", "csv", "parquet")
+#######################################################
+def plain_value(value):
+    # NumPy scalars to Python numbers, tuples (e.g. kernel identities) to text
+    if hasattr(value, "item"):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        return ','.join(str(item) for item in value)
+    return value
+#######################################################
+def write_table(name, rows, table_format, directory="."):
+    # rows is a list of dicts with the same keys, in column order
+    rows = [{key: plain_value(value) for key, value in row.items()} for row in rows]
+    file_name = os.path.join(directory, name + '.' + table_format)
+    if table_format == "json":
+        with open(file_name, "w") as f:
+            json.dump(rows, f, indent=1)
+    elif table_format == "csv":
+        with open(file_name, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+    elif table_format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Parquet output needs pyarrow (pip install pyarrow), table", name, "not written")
+            return None
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), file_name)
+    else:
+        raise ValueError("Unknown table format " + str(table_format))
+    print("Wrote", file_name)
+    return file_name
+#######################################################
+def export_table(name, rows, render_options):
+    # The table format and --no-plot travel with the render options
+    table_format = (render_options or {}).get("table_format")
+    if table_format is not None:
+        return write_table(name, rows, table_format, (render_options or {}).get("directory", "."))
+    return None
+#######################################################
+def add_export_arguments(parser):
+    parser.add_argument("--format", choices=FORMATS, default=None, help="also write the computed tables in this format")
+    parser.add_argument("--no-plot", action="store_true", help="do not draw the figures (matplotlib is not imported)")
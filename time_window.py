@@ -0,0 +1,91 @@
+#This module resolves the --start/--end/--skip-first time window of a report.
+#Copyright (C) 2024 Amirreza Barati Sedeh
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+#Note: Time window shared by the scripts. --start/--end take absolute
+# timestamps in ns, or times relative to the first kernel when they start
+# with + (e.g. +2s, +1500ms, +10us), and --skip-first N% drops the first
+# N percent of the kernel timeline. A window is a half-open [start, end)
+# range of ns that kernels and transfers are kept in by their start. It is
+# added to the queries as a range predicate on start, which the start
+# indexes of --build-index turn into a range scan, and cached columns are
+# cut with a mask instead.
+#########################################################################
+import argparse
+import re
+import numpy as np
+import report_reader
+#######################################################
+UNITS = {"ns": 1, "us": 1000, "ms": 1000000, "s": 1000000000}
+# Used as the end of a window without --end
+END_OF_TIME = 2 ** 63 - 1
+#######################################################
+def parse_time(value):
+    # Returns (relative, ns)
+    match = re.fullmatch(r"(\+?)([0-9]*\.?[0-9]+)(ns|us|ms|s)?", value.strip())
+    if match is None:
+        raise ValueError("Cannot parse the time " + value + ", expected e.g. 123456789, +2s or +150ms")
+    relative, number, unit = match.groups()
+    return relative == "+", int(round(float(number) * UNITS[unit or "ns"]))
+#######################################################
+def kernel_time_range(database_file):
+    # First and last kernel start, MIN and MAX only read the ends of the
+    # start index when there is one
+    first, last = report_reader.column_range(database_file, "CUPTI_ACTIVITY_KIND_KERNEL", "start")
+    return first or 0, last or 0
+#######################################################
+def resolve_window(database_file, start=None, end=None, skip_first=None):
+    if start is None and end is None and skip_first is None:
+        return None
+    start = parse_time(start) if start is not None else None
+    end = parse_time(end) if end is not None else None
+    first, last = 0, 0
+    if skip_first is not None or (start is not None and start[0]) or (end is not None and end[0]):
+        first, last = kernel_time_range(database_file)
+
+    low = first + start[1] if start is not None and start[0] else (start[1] if start is not None else 0)
+    high = first + end[1] if end is not None and end[0] else (end[1] if end is not None else END_OF_TIME)
+    if skip_first is not None:
+        low = max(low, first + int((last - first) * skip_first / 100))
+    if low >= high:
+        raise ValueError("The window [%d, %d) ns is empty, its start must be before its end" % (low, high))
+    print("Analysing the window [%d, %s) ns" % (low, high if high != END_OF_TIME else "end"))
+    return low, high
+#######################################################
+def window_condition(column):
+    # SQL range predicate, the parameters are the window itself
+    return "%s >= ? AND %s < ?" % (column, column)
+#######################################################
+def window_mask(start, window):
+    start = np.asarray(start)
+    return (start >= window[0]) & (start < window[1])
+#######################################################
+def parse_percent(value):
+    percent = float(value.rstrip("%"))
+    if not 0 <= percent <= 100:
+        raise argparse.ArgumentTypeError("the percentage must be between 0 and 100, not %r" % value)
+    return percent
+#######################################################
+def add_window_arguments(parser):
+    parser.add_argument("--start", help="analyse from this time on, in ns, or relative to the first kernel with + and a unit (e.g. +2s)")
+    parser.add_argument("--end", help="analyse up to this time, in ns, or relative to the first kernel (e.g. +12s)")
+    parser.add_argument("--skip-first", type=parse_percent, metavar="N%", help="skip the first N percent of the kernel timeline (warmup)")
+#######################################################
+def window_arguments(database_file, args, parser):
+    # A time that cannot be parsed or an empty window is a usage error
+    try:
+        return resolve_window(database_file, args.start, args.end, args.skip_first)
+    except ValueError as error:
+        parser.error(str(error))